@@ -0,0 +1,422 @@
+"""
+coplay.py
+author: garrick
+
+Who has played with whom, and how it went. Scraped PGCRs are folded into
+sparse character x character stats, stored as one CSR structure:
+
+- games[a, b]: activities a and b played on the same team
+- wins[a, b]: how many of those they won
+- efficiency[a, b]: sum of a's efficiency over those games, so
+  efficiency[a, b] / games[a, b] is how well a plays alongside b
+
+Players in an activity count as teammates if they have the same standing
+(won or lost together), which covers both PvP teams and PvE fireteams.
+
+New activities are buffered as (row, col, value) triplets and merged into the
+CSR arrays in batches, so adding is cheap and nothing is ever dense. Merging
+only sorts and looks up the new pairs, then inserts them among the old. Top-k
+teammate queries read from a neighbor index precomputed in one vectorized
+pass over all pairs, and saved with the rest, so a query only has to load.
+The neighbor index is sparse too: each character keeps at most TOP_K
+neighbors per score, at 8 bytes each, and most characters have far fewer
+teammates than that. Adding a few activities only marks the characters in
+them stale; their lists are recomputed from their own pairs when they're
+next queried, and the rest of the index is kept.
+
+    python coplay.py build all_long.csv --output coplay.npz
+    python coplay.py query coplay.npz 2305843009574374200 --by win_rate
+"""
+import argparse
+import array
+import logging
+
+import numpy as np
+import pandas as pd
+
+logger = logging.getLogger(__name__)
+
+
+# Pending pairs to buffer before merging them in
+COMPACT_SIZE = 1 << 22
+# Stale characters to patch neighbor lists for; past this many (e.g. after a
+# bulk add), the neighbor index is rebuilt in one pass instead
+MAX_STALE = 1 << 16
+# Neighbors kept per character in the index
+TOP_K = 50
+# Games together needed before a pair's win rate or efficiency is trusted;
+# rates are shrunk toward the character's average until then
+PRIOR_GAMES = 5
+SCORES = ["games", "win_rate", "efficiency"]
+
+
+def pad(values, n):
+    """values extended with zeros to length n."""
+    if len(values) >= n:
+        return values
+    return np.concatenate([values, np.zeros(n - len(values), dtype=values.dtype)])
+
+
+class CoPlayIndex:
+    def __init__(self):
+        # char_id -> row, and back
+        self.rows = {}
+        self.char_ids = array.array("q")
+        # Per-character totals, for shrinking pair rates. Grown geometrically,
+        # so they're longer than len(self); the extra entries are zeros.
+        self.total_games = np.zeros(0, dtype=np.int64)
+        self.total_wins = np.zeros(0, dtype=np.int64)
+
+        # CSR structure shared by games, wins and efficiency, so they stay
+        # aligned entry for entry. Column indices are sorted within each row.
+        self.indptr = np.zeros(1, dtype=np.int64)
+        self.indices = np.zeros(0, dtype=np.int64)
+        self.games = np.zeros(0, dtype=np.int64)
+        self.wins = np.zeros(0, dtype=np.int64)
+        self.efficiency = np.zeros(0, dtype=np.float64)
+
+        self.pending = {"row": [], "col": [], "won": [], "efficiency": []}
+        self.n_pending = 0
+        # score -> (k, indptr, neighbor rows, neighbor scores), CSR like the
+        # pairs: row i's neighbors, best first, are at indptr[i]:indptr[i + 1]
+        self.neighbors = {}
+        # score -> {row: (neighbor rows, neighbor scores) or None}, for rows
+        # whose lists in self.neighbors are out of date. None until queried.
+        self.stale = {}
+
+    def __len__(self):
+        return len(self.char_ids)
+
+    @property
+    def n_pairs(self):
+        return len(self.indices)
+
+    def _row(self, char_id):
+        row = self.rows.get(char_id)
+        if row is None:
+            row = self.rows[char_id] = len(self.char_ids)
+            self.char_ids.append(char_id)
+        return row
+
+    def add_frame(self, df):
+        """Add activities from long-format rows (one per player per activity)
+        with instance_id, char_id, standing and efficiency columns. Each
+        activity should only be added once.
+        """
+        df = df[["instance_id", "char_id", "standing", "efficiency"]].dropna(
+            subset=["char_id"]
+        )
+        df = df.sort_values(["instance_id", "standing"], kind="stable")
+
+        rows = np.fromiter(
+            (self._row(int(c)) for c in df["char_id"]), dtype=np.int64, count=len(df)
+        )
+        standing = df["standing"].to_numpy(dtype=np.float64, na_value=-1.0)
+        won = standing == 1
+        efficiency = df["efficiency"].to_numpy(dtype=np.float64, na_value=0.0)
+
+        if len(self.total_games) < len(self):
+            capacity = max(len(self), 2 * len(self.total_games))
+            self.total_games = pad(self.total_games, capacity)
+            self.total_wins = pad(self.total_wins, capacity)
+        np.add.at(self.total_games, rows, 1)
+        np.add.at(self.total_wins, rows[won], 1)
+        self._mark_stale(rows)
+
+        # Teams are runs of rows with the same instance and standing. Pair
+        # each row with the one d rows below it in the same run; teams are
+        # small, so this is a handful of vectorized passes.
+        instance_ids = df["instance_id"].to_numpy()
+        team = np.concatenate(
+            [[0], np.cumsum((np.diff(instance_ids) != 0) | (np.diff(standing) != 0))]
+        )
+        d = 1
+        while d < len(team):
+            a = np.nonzero(team[d:] == team[:-d])[0]
+            if not len(a):
+                break
+            b = a + d
+            # Both directions: efficiency is the row player's
+            self._pend(rows[a], rows[b], won[a], efficiency[a])
+            self._pend(rows[b], rows[a], won[b], efficiency[b])
+            d += 1
+
+    def add_activity(self, activity):
+        """Add one activity as returned by data_collection.parse_pgcr, e.g.
+        as PGCRs come in from a crawl.
+        """
+        players = activity["players"]
+        self.add_frame(
+            pd.DataFrame(
+                {
+                    "instance_id": activity["instance_id"],
+                    "char_id": [int(p["char_id"]) for p in players],
+                    "standing": [p.get("standing") for p in players],
+                    "efficiency": [p.get("efficiency") for p in players],
+                }
+            )
+        )
+
+    def _mark_stale(self, rows):
+        """These rows' neighbor lists need recomputing."""
+        for by in list(self.stale):
+            stale = self.stale[by]
+            if len(stale) + len(rows) > MAX_STALE:
+                del self.neighbors[by], self.stale[by]
+            else:
+                stale.update(dict.fromkeys(rows.tolist()))
+
+    def _pend(self, rows, cols, won, efficiency):
+        self.pending["row"].append(rows)
+        self.pending["col"].append(cols)
+        self.pending["won"].append(won)
+        self.pending["efficiency"].append(efficiency)
+        self.n_pending += len(rows)
+        if self.n_pending >= COMPACT_SIZE:
+            self.compact()
+
+    def compact(self):
+        """Merge pending pairs into the CSR arrays."""
+        n = len(self)
+        # New characters without pairs yet get empty rows
+        if len(self.indptr) <= n:
+            self.indptr = np.concatenate(
+                [self.indptr, np.full(n + 1 - len(self.indptr), self.indptr[-1])]
+            )
+        if not self.n_pending:
+            return
+
+        # Pending pairs as (row * n + col) keys, with duplicates summed.
+        # Sorting them orders them by row, then column, like the CSR arrays.
+        keys, inverse = np.unique(
+            np.concatenate(
+                [r * n + c for r, c in zip(self.pending["row"], self.pending["col"])]
+            ),
+            return_inverse=True,
+        )
+        games = np.bincount(inverse).astype(np.int64)
+        wins = np.bincount(inverse, weights=np.concatenate(self.pending["won"])).astype(
+            np.int64
+        )
+        efficiency = np.bincount(
+            inverse, weights=np.concatenate(self.pending["efficiency"])
+        )
+        self.pending = {"row": [], "col": [], "won": [], "efficiency": []}
+        self.n_pending = 0
+
+        # Find each pair among its row's columns, with a binary search per
+        # pair run side by side, so none of the existing entries are touched
+        rows, cols = keys // n, keys % n
+        lo, hi = self.indptr[rows], self.indptr[rows + 1]
+        searching = np.flatnonzero(lo < hi)
+        while len(searching):
+            mid = (lo[searching] + hi[searching]) // 2
+            right = self.indices[mid] < cols[searching]
+            lo[searching[right]] = mid[right] + 1
+            hi[searching[~right]] = mid[~right]
+            searching = searching[lo[searching] < hi[searching]]
+        found = lo < self.indptr[rows + 1]
+        found[found] = self.indices[lo[found]] == cols[found]
+
+        # Add to the pairs we already have, and insert the new ones in order
+        at = lo[found]
+        self.games[at] += games[found]
+        self.wins[at] += wins[found]
+        self.efficiency[at] += efficiency[found]
+        new = ~found
+        at = lo[new]
+        self.games = np.insert(self.games, at, games[new])
+        self.wins = np.insert(self.wins, at, wins[new])
+        self.efficiency = np.insert(self.efficiency, at, efficiency[new])
+        self.indices = np.insert(self.indices, at, cols[new])
+        self.indptr = np.concatenate(
+            [[0], np.cumsum(np.diff(self.indptr) + np.bincount(rows[new], minlength=n))]
+        )
+
+    def pair(self, a, b):
+        """Stats for char a playing alongside char b."""
+        self.compact()
+        i, j = self.rows[a], self.rows[b]
+        start, end = self.indptr[i], self.indptr[i + 1]
+        k = start + np.searchsorted(self.indices[start:end], j)
+        if k == end or self.indices[k] != j:
+            return {"games": 0, "wins": 0, "efficiency": None}
+        return {
+            "games": int(self.games[k]),
+            "wins": int(self.wins[k]),
+            "efficiency": self.efficiency[k] / self.games[k],
+        }
+
+    def _scores(self, by, pairs, rows, group, n_groups):
+        """Score for some stored pairs, all of the pairs of some rows. rows is
+        each pair's row, and group its row's position among those rows.
+        """
+        games = self.games[pairs].astype(np.float64)
+        if by == "games":
+            return games
+
+        if by == "win_rate":
+            values = self.wins[pairs]
+            prior = self.total_wins[rows] / np.maximum(self.total_games[rows], 1)
+        else:
+            values = self.efficiency[pairs]
+            # Efficiency per game over all of a character's pairs
+            prior = (
+                np.bincount(group, weights=values, minlength=n_groups)
+                / np.maximum(np.bincount(group, weights=games, minlength=n_groups), 1)
+            )[group]
+        # Shrink rates from few games toward the character's own average
+        return (values + PRIOR_GAMES * prior) / (games + PRIOR_GAMES)
+
+    def _top_k(self, by, k, rows):
+        """The top-k teammates of some rows (sorted), with one sort over their
+        pairs rather than a loop over rows. Returns how many each row has, and
+        their rows and scores, grouped by row, best first.
+        """
+        starts = self.indptr[rows]
+        counts = self.indptr[rows + 1] - starts
+        offsets = np.cumsum(counts) - counts
+        group = np.repeat(np.arange(len(rows)), counts)
+        pairs = np.arange(counts.sum()) + np.repeat(starts - offsets, counts)
+        scores = self._scores(by, pairs, rows[group], group, len(rows))
+
+        # Sort by row, then score descending; keep each row's first k
+        order = np.lexsort((-scores, group))
+        keep = order[np.arange(len(order)) - offsets[group[order]] < k]
+        return (
+            np.minimum(counts, k),
+            self.indices[pairs[keep]].astype(np.int32),
+            scores[keep].astype(np.float32),
+        )
+
+    def build_neighbors(self, by="games", k=TOP_K):
+        """Precompute every character's top-k teammates by a score."""
+        self.compact()
+        counts, neighbor_rows, neighbor_scores = self._top_k(
+            by, k, np.arange(len(self))
+        )
+        indptr = np.concatenate([[0], np.cumsum(counts)])
+        self.neighbors[by] = (k, indptr, neighbor_rows, neighbor_scores)
+        self.stale[by] = {}
+
+    def teammates(self, char_id, k=10, by="games"):
+        """Up to k (char_id, score) pairs, best first, from the neighbor
+        index (built on first use). Characters in activities added since are
+        recomputed from their own pairs.
+        """
+        self.compact()
+        built = self.neighbors.get(by)
+        if built is None or built[0] < k:
+            self.build_neighbors(by, max(k, TOP_K))
+        built_k, indptr, neighbor_rows, neighbor_scores = self.neighbors[by]
+
+        row = self.rows.get(char_id)
+        if row is None:
+            return []
+        stale = self.stale[by]
+        if row in stale:
+            if stale[row] is None:
+                _, rows, scores = self._top_k(by, built_k, np.array([row]))
+                stale[row] = (rows, scores)
+            neighbor_rows, neighbor_scores = stale[row]
+            start, end = 0, min(len(neighbor_rows), k)
+        else:
+            start = indptr[row]
+            end = min(indptr[row + 1], start + k)
+        return [
+            (self.char_ids[j], float(score))
+            for j, score in zip(neighbor_rows[start:end], neighbor_scores[start:end])
+        ]
+
+    def save(self, path):
+        """Save everything, with a neighbor index for every score."""
+        self.compact()
+        neighbors = {}
+        for by in SCORES:
+            if by not in self.neighbors:
+                self.build_neighbors(by)
+            elif self.stale[by]:
+                self.build_neighbors(by, self.neighbors[by][0])
+            k, indptr, neighbor_rows, neighbor_scores = self.neighbors[by]
+            neighbors[f"neighbors_{by}_k"] = k
+            neighbors[f"neighbors_{by}_indptr"] = indptr
+            neighbors[f"neighbors_{by}_rows"] = neighbor_rows
+            neighbors[f"neighbors_{by}_scores"] = neighbor_scores
+        np.savez(
+            path,
+            char_ids=np.asarray(self.char_ids),
+            total_games=self.total_games[: len(self)],
+            total_wins=self.total_wins[: len(self)],
+            indptr=self.indptr,
+            indices=self.indices,
+            games=self.games,
+            wins=self.wins,
+            efficiency=self.efficiency,
+            **neighbors,
+        )
+
+    @classmethod
+    def load(cls, path):
+        index = cls()
+        with np.load(path) as f:
+            index.char_ids = array.array("q", f["char_ids"].tobytes())
+            index.rows = {c: i for i, c in enumerate(index.char_ids)}
+            for name in [
+                "total_games",
+                "total_wins",
+                "indptr",
+                "indices",
+                "games",
+                "wins",
+                "efficiency",
+            ]:
+                setattr(index, name, f[name])
+            # Indexes saved before neighbors were get them rebuilt on query
+            for by in SCORES:
+                if f"neighbors_{by}_k" in f:
+                    index.neighbors[by] = (
+                        int(f[f"neighbors_{by}_k"]),
+                        f[f"neighbors_{by}_indptr"],
+                        f[f"neighbors_{by}_rows"],
+                        f[f"neighbors_{by}_scores"],
+                    )
+                    index.stale[by] = {}
+        return index
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+
+    parser = argparse.ArgumentParser(description="Build and query a co-play index")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    build = subparsers.add_parser("build", help="Index long-format crawl outputs")
+    build.add_argument("sources", nargs="+", help="Long-format .csv/.parquet files")
+    build.add_argument("--output", default="coplay.npz")
+    build.add_argument(
+        "--update", action="store_true", help="Add to an existing --output"
+    )
+
+    query = subparsers.add_parser("query", help="Top teammates for a character")
+    query.add_argument("index")
+    query.add_argument("char_id", type=int)
+    query.add_argument("-k", type=int, default=10)
+    query.add_argument("--by", choices=SCORES, default="games")
+    args = parser.parse_args()
+
+    if args.command == "build":
+        from dataset import Dataset
+
+        index = CoPlayIndex.load(args.output) if args.update else CoPlayIndex()
+        for source in args.sources:
+            index.add_frame(
+                Dataset(source).load(
+                    ["instance_id", "char_id", "standing", "efficiency"]
+                )
+            )
+        index.save(args.output)
+        logger.info(f"{len(index)} characters, {index.n_pairs} pairs")
+    else:
+        index = CoPlayIndex.load(args.index)
+        for char_id, score in index.teammates(args.char_id, k=args.k, by=args.by):
+            print(f"{char_id}\t{score:.4f}")
@@ -0,0 +1,130 @@
+"""
+asyncpool.py
+author: garrick
+
+Asyncio counterpart to threadpool.py. Instead of one OS thread per in-flight
+request, a fixed number of coroutines share a single event loop and a single
+aiohttp session, so thousands of requests can be outstanding at once. Jobs are
+rate-limited with the same TokenBucket as ThreadPool.
+"""
+import asyncio
+import logging
+import time
+
+import aiohttp
+from tqdm import tqdm
+
+from metrics import METRICS
+from ratelimit import TokenBucket
+
+logger = logging.getLogger(__name__)
+
+
+MAX_CONCURRENCY = 1000
+
+
+class AsyncPool:
+    """
+    Args:
+      hedge_session (bool): Also open a second session, on connections of its
+        own, for hedged copies of requests (see retry.Hedger), so they don't
+        queue behind the slow requests they're hedging. func is then called
+        with it as a third argument.
+    """
+
+    def __init__(
+        self,
+        max_concurrency=MAX_CONCURRENCY,
+        timeout=1,
+        limiter=None,
+        metrics=METRICS,
+        progress=True,
+        hedge_session=False,
+    ):
+        self.max_concurrency = max_concurrency
+        self.progress = progress
+        self.timeout = timeout
+        self.limiter = limiter if limiter is not None else TokenBucket()
+        self.metrics = metrics
+        self.hedge_session = hedge_session
+
+    async def _pull(self, items):
+        """Async iterables (e.g. RetryQueue.feed_async) can suspend partway
+        through producing an item, so workers take turns pulling from them.
+        """
+        async with self.pull_lock:
+            return await items.__anext__()
+
+    async def _items(self, items):
+        if not hasattr(items, "__anext__"):
+            # All workers pull from the same iterator. This is safe without a
+            # lock since only one coroutine runs at a time on the event loop.
+            for item in items:
+                yield item
+            return
+
+        while True:
+            try:
+                yield await self._pull(items)
+            except StopAsyncIteration:
+                return
+
+    async def _worker(self, func, items, sessions):
+        async for item in self._items(items):
+            # Make sure we can fire request according to rate-limiter
+            waiting = time.perf_counter()
+            await self.limiter.acquire_async()
+            started = time.perf_counter()
+
+            await func(sessions[0], item, *sessions[1:])
+            finished = time.perf_counter()
+            self.pbar.update(1)
+
+            self.metrics.observe("pool.rate_limit_wait", started - waiting)
+            self.metrics.observe("pool.job", finished - started)
+
+    def _session(self, headers):
+        # The timeout covers waiting for one of the connector's connections
+        connector = aiohttp.TCPConnector(limit=self.max_concurrency)
+        timeout = aiohttp.ClientTimeout(total=self.timeout)
+        return aiohttp.ClientSession(
+            headers=headers, connector=connector, timeout=timeout
+        )
+
+    async def _run(self, func, items, headers):
+        self.pull_lock = asyncio.Lock()
+        sessions = [self._session(headers)]
+        if self.hedge_session:
+            sessions.append(self._session(headers))
+        try:
+            workers = [
+                self._worker(func, items, sessions) for _ in range(self.max_concurrency)
+            ]
+            await asyncio.gather(*workers)
+        finally:
+            for session in sessions:
+                await session.close()
+
+    def run(self, func, items, headers=None, total=None):
+        """Run func(session, item) for every item, with up to max_concurrency
+        calls in flight at once. Blocks until all items are processed.
+
+        Args:
+          func (coroutine function): Called with the shared aiohttp session and
+            one item (and the hedge session, if any). Responsible for
+            handling its own result.
+          items (iterable or async iterable): Work items, consumed lazily.
+          headers (dict): Headers sent with every request made on the session.
+          total (int): Number of items, for the progress bar. Defaults to
+            len(items) if items has a length.
+        """
+        if total is None and hasattr(items, "__len__"):
+            total = len(items)
+        if not hasattr(items, "__anext__"):
+            items = iter(items)
+
+        logger.debug(f"Running with {self.max_concurrency} concurrent requests...")
+        self.pbar = tqdm(total=total, disable=not self.progress)
+        asyncio.run(self._run(func, items, headers))
+        self.pbar.close()
+        logger.debug("All jobs done!")
@@ -0,0 +1,47 @@
+"""
+bench_client.py
+author: garrick
+
+Benchmark requests/sec through Client with and without connection pooling,
+against a local stub server, so no API quota is used. Locally there's no TLS
+and next to no network latency, so the real-world gap from skipping handshakes
+is larger than what this shows.
+
+    python bench_client.py --requests 2000 --threads 16
+"""
+import argparse
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from client import Client
+from mock_server import MockServer
+
+
+def run(url, n_requests, n_threads, pooled):
+    client = Client(pool_size=n_threads, pooled=pooled)
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=n_threads) as executor:
+        for r in executor.map(lambda _: client.get(url), range(n_requests)):
+            r.raise_for_status()
+    elapsed = time.perf_counter() - start
+
+    client.close()
+    return n_requests / elapsed
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark pooled vs unpooled HTTP")
+    parser.add_argument("--requests", type=int, default=2000)
+    parser.add_argument("--threads", type=int, default=16)
+    args = parser.parse_args()
+
+    server = MockServer().start()
+    url = server.url + "Destiny2/Manifest/"
+
+    for pooled in [False, True]:
+        rate = run(url, args.requests, args.threads, pooled)
+        label = "pooled" if pooled else "unpooled"
+        print(f"{label:>8}: {rate:8.1f} req/s")
+
+    server.stop()
@@ -0,0 +1,172 @@
+"""
+bench_crawl.py
+author: garrick
+
+Offline throughput benchmark for the crawl engines. Runs each execution mode
+over the same ID range against mock_server.py (in its own process) and reports
+requests/sec, p50/p99 latency per PGCR, and CPU time per request.
+
+    python bench_crawl.py --ids 2000 --latency 0.05 --rate 1000
+    python bench_crawl.py --modes threaded async --throttle-rate 0.01
+"""
+import argparse
+import os
+import socket
+import tempfile
+import time
+from multiprocessing import Process
+from os.path import join
+
+import numpy as np
+
+# The scraper wants an API key at import; the mock server doesn't check it
+os.environ.setdefault("BUNGIE_NET_API_KEY", "mock")
+
+import data_collection as dc
+from client import Client
+from manifest_store import ManifestStore
+from mock_server import Faults, serve, write_manifest
+from ratelimit import TokenBucket
+
+MODES = {
+    "sequential": dc.scrape_pgcrs,
+    "threaded": dc.scrape_pgcrs_multithreaded,
+    "async": dc.scrape_pgcrs_async,
+}
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def wait_for_port(port, timeout=10):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=0.1).close()
+            return
+        except OSError:
+            time.sleep(0.05)
+    raise RuntimeError(f"Mock server didn't come up on port {port}")
+
+
+def timed(func, latencies):
+    def wrapper(*args):
+        start = time.perf_counter()
+        result = func(*args)
+        latencies.append(time.perf_counter() - start)
+        return result
+
+    return wrapper
+
+
+def timed_async(func, latencies):
+    async def wrapper(*args):
+        start = time.perf_counter()
+        result = await func(*args)
+        latencies.append(time.perf_counter() - start)
+        return result
+
+    return wrapper
+
+
+def bench(mode, api_url, start_id, n_ids, rate, out_dir):
+    """Crawl n_ids PGCRs with the given mode. Returns a dict of results."""
+    dc.API_URL = api_url
+    dc.STARTING_ACTIVITY_ID = start_id
+    dc.ENDING_ACTIVITY_ID = start_id + n_ids
+    dc.RATE_LIMITER = TokenBucket(rate=rate, burst=max(1, int(rate // 10)))
+    dc.CLIENT = Client(dc.HEADERS)
+
+    # Time each PGCR end to end: request, response, and parsing
+    latencies = []
+    scrape_pgcr, scrape_pgcr_async = dc.scrape_pgcr, dc.scrape_pgcr_async
+    dc.scrape_pgcr = timed(scrape_pgcr, latencies)
+    dc.scrape_pgcr_async = timed_async(scrape_pgcr_async, latencies)
+
+    start_cpu = time.process_time()
+    start = time.perf_counter()
+    try:
+        MODES[mode](output=join(out_dir, f"{mode}.csv"))
+    finally:
+        dc.scrape_pgcr, dc.scrape_pgcr_async = scrape_pgcr, scrape_pgcr_async
+        dc.CLIENT.close()
+    elapsed = time.perf_counter() - start
+    cpu = time.process_time() - start_cpu
+
+    latencies = np.array(latencies)
+    return {
+        "mode": mode,
+        "requests": len(latencies),
+        "req/s": len(latencies) / elapsed,
+        "p50 ms": 1000 * np.percentile(latencies, 50),
+        "p99 ms": 1000 * np.percentile(latencies, 99),
+        "cpu ms/req": 1000 * cpu / len(latencies),
+    }
+
+
+def print_results(results):
+    columns = ["mode", "requests", "req/s", "p50 ms", "p99 ms", "cpu ms/req"]
+    print("".join(f"{c:>12}" for c in columns))
+    for result in results:
+        print(
+            "".join(
+                f"{result[c]:>12.2f}"
+                if isinstance(result[c], float)
+                else f"{result[c]:>12}"
+                for c in columns
+            )
+        )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark crawl engines offline")
+    parser.add_argument("--modes", nargs="+", choices=list(MODES), default=list(MODES))
+    parser.add_argument("--ids", type=int, default=1000)
+    parser.add_argument("--start-id", type=int, default=dc.STARTING_ACTIVITY_ID)
+    parser.add_argument(
+        "--rate", type=float, default=1000, help="Rate limit to crawl under"
+    )
+    parser.add_argument("--latency", type=float, default=0.02)
+    parser.add_argument("--jitter", type=float, default=0)
+    parser.add_argument("--throttle-rate", type=float, default=0)
+    parser.add_argument("--timeout-rate", type=float, default=0)
+    parser.add_argument("--malformed-rate", type=float, default=0)
+    parser.add_argument("--missing-rate", type=float, default=0)
+    args = parser.parse_args()
+
+    faults = Faults(
+        latency=args.latency,
+        jitter=args.jitter,
+        throttle_rate=args.throttle_rate,
+        timeout_rate=args.timeout_rate,
+        malformed_rate=args.malformed_rate,
+        missing_rate=args.missing_rate,
+    )
+    port = free_port()
+    server = Process(target=serve, args=(faults, None, port), daemon=True)
+    server.start()
+    wait_for_port(port)
+
+    results = []
+    with tempfile.TemporaryDirectory() as out_dir:
+        manifest_path = join(out_dir, "Manifest.content")
+        write_manifest(manifest_path)
+        dc.INDEX = ManifestStore(manifest_path)
+
+        for mode in args.modes:
+            results.append(
+                bench(
+                    mode,
+                    f"http://127.0.0.1:{port}/Platform/",
+                    args.start_id,
+                    args.ids,
+                    args.rate,
+                    out_dir,
+                )
+            )
+
+    server.terminate()
+    print_results(results)
@@ -0,0 +1,170 @@
+"""
+bench_threadpool.py
+author: garrick
+
+Microbenchmarks for ThreadPool's own overhead, with no network involved, so
+we can tell whether the pool is ever what's holding a crawl back. At each
+worker count it measures:
+
+- no-op jobs/sec and CPU time per job: pure scheduling overhead
+- sleeping jobs/sec, as a fraction of the ideal workers / sleep time: how
+  well the pool keeps workers busy when jobs wait on I/O, like requests do
+- wake latency: from schedule() on an idle pool to the job starting
+
+concurrent.futures.ThreadPoolExecutor runs the same jobs as a reference.
+Rate limiting is effectively off, so only the pool is measured.
+
+    python bench_threadpool.py --workers 1 8 32 100 --jobs 20000
+"""
+import argparse
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from metrics import Metrics
+from ratelimit import TokenBucket
+from threadpool import ThreadPool
+
+# Sleeping jobs per worker, so start and finish stragglers don't dominate
+SLEEP_ROUNDS = 20
+
+
+def unlimited():
+    return TokenBucket(rate=1e12, burst=1e12)
+
+
+class Pool:
+    """ThreadPool, with the interface the benchmarks use."""
+
+    def __init__(self, workers):
+        self.pool = ThreadPool(
+            limiter=unlimited(), metrics=Metrics(), progress=False, num_workers=workers
+        )
+
+    def map(self, func, items):
+        self.pool.map(func, items)
+
+    def submit(self, func, *args):
+        self.pool.schedule(func, *args)
+
+    def close(self):
+        self.pool.shutdown()
+
+
+class Executor:
+    """concurrent.futures.ThreadPoolExecutor, for reference."""
+
+    def __init__(self, workers):
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        # Start every thread up front, as ThreadPool does
+        list(self.executor.map(time.sleep, [0.01] * workers))
+
+    def map(self, func, items):
+        for _ in self.executor.map(func, items):
+            pass
+
+    def submit(self, func, *args):
+        self.executor.submit(func, *args)
+
+    def close(self):
+        self.executor.shutdown()
+
+
+def noop(_):
+    pass
+
+
+def throughput(make_pool, workers, n_jobs, func=noop):
+    """Jobs/sec and CPU seconds per job, not counting starting the
+    threads.
+    """
+    pool = make_pool(workers)
+    start, cpu_start = time.perf_counter(), time.process_time()
+    pool.map(func, range(n_jobs))
+    pool.close()
+    elapsed = time.perf_counter() - start
+    cpu = time.process_time() - cpu_start
+    return n_jobs / elapsed, cpu / n_jobs
+
+
+def wake_latency(make_pool, workers, n_samples):
+    """Seconds from scheduling a job on an idle pool to it starting, one
+    sample per job.
+    """
+    pool = make_pool(workers)
+    latencies = []
+    started = threading.Event()
+
+    def job(scheduled):
+        latencies.append(time.perf_counter() - scheduled)
+        started.set()
+
+    for _ in range(n_samples):
+        started.clear()
+        pool.submit(job, time.perf_counter())
+        started.wait()
+        # Let the worker go back to waiting
+        time.sleep(0.001)
+    pool.close()
+    return np.array(latencies)
+
+
+def run(name, make_pool, workers, n_jobs, sleep, n_samples):
+    noop_rate, noop_cpu = throughput(make_pool, workers, n_jobs)
+
+    sleep_rate, _ = throughput(
+        make_pool, workers, workers * SLEEP_ROUNDS, func=lambda _: time.sleep(sleep)
+    )
+    efficiency = sleep_rate / (workers / sleep)
+
+    latencies = wake_latency(make_pool, workers, n_samples)
+    return {
+        "pool": name,
+        "workers": workers,
+        "noop_rate": noop_rate,
+        "noop_cpu_us": noop_cpu * 1e6,
+        "sleep_efficiency": efficiency,
+        "wake_p50_us": np.percentile(latencies, 50) * 1e6,
+        "wake_p99_us": np.percentile(latencies, 99) * 1e6,
+    }
+
+
+def print_results(results):
+    print(
+        f"{'pool':>10} {'workers':>7} {'noop/s':>10} {'cpu us/job':>10} "
+        f"{'sleep eff':>9} {'wake p50':>9} {'wake p99':>9}"
+    )
+    for r in results:
+        print(
+            f"{r['pool']:>10} {r['workers']:>7} {r['noop_rate']:>10.0f} "
+            f"{r['noop_cpu_us']:>10.1f} {r['sleep_efficiency']:>9.1%} "
+            f"{r['wake_p50_us']:>8.0f}u {r['wake_p99_us']:>8.0f}u"
+        )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark ThreadPool overhead")
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 8, 32, 100])
+    parser.add_argument("--jobs", type=int, default=20000, help="No-op jobs per run")
+    parser.add_argument(
+        "--sleep", type=float, default=0.005, help="Seconds per sleeping job"
+    )
+    parser.add_argument("--samples", type=int, default=200, help="Wake latency samples")
+    parser.add_argument(
+        "--no-reference", action="store_true", help="Skip the ThreadPoolExecutor runs"
+    )
+    args = parser.parse_args()
+
+    pools = {"ThreadPool": Pool}
+    if not args.no_reference:
+        pools["Executor"] = Executor
+
+    results = []
+    for workers in args.workers:
+        for name, make_pool in pools.items():
+            results.append(
+                run(name, make_pool, workers, args.jobs, args.sleep, args.samples)
+            )
+    print_results(results)
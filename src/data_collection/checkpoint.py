@@ -0,0 +1,105 @@
+"""
+checkpoint.py
+author: garrick
+
+Persistent record of which instance IDs a crawl has finished, so a crawl that
+dies partway through can be restarted without re-fetching anything.
+
+State is one byte per ID in a memory-mapped .npy file (10M IDs is 10MB), plus
+a small JSON file recording the ID range it covers. A byte per ID rather than
+packed bits means workers can mark IDs from many threads without a lock, and
+marks land on disk in place without rewriting the file.
+"""
+import json
+import logging
+import os
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+
+# States
+PENDING = 0  # Not tried yet
+DONE = 1  # Row written (or filtered out)
+FAILED = 2  # Network error, timeout, throttled, etc. Retried on restart.
+MISSING = 3  # The API answered, but there's no PGCR for this ID
+
+# How many IDs to scan at a time when looking for work
+BLOCK_SIZE = 1 << 20
+
+
+class Checkpoint:
+    """Map from instance ID to crawl state over [start, end).
+
+    Args:
+      path (str): Path to the .npy state file. Created if it doesn't exist.
+      start (int): First instance ID in the range.
+      end (int): One past the last instance ID in the range.
+    """
+
+    def __init__(self, path, start, end):
+        self.path = path
+        self.meta_path = path + ".json"
+        self.start = start
+        self.end = end
+
+        if os.path.exists(path):
+            with open(self.meta_path) as f:
+                meta = json.load(f)
+            if (meta["start"], meta["end"]) != (start, end):
+                raise ValueError(
+                    f"Checkpoint {path} covers [{meta['start']}, {meta['end']}), "
+                    f"not [{start}, {end})"
+                )
+            self.states = np.lib.format.open_memmap(path, mode="r+")
+            logger.info(f"Resuming from checkpoint: {self.summary()}")
+        else:
+            self.states = np.lib.format.open_memmap(
+                path, mode="w+", dtype=np.uint8, shape=(end - start,)
+            )
+            with open(self.meta_path, "w") as f:
+                json.dump({"start": start, "end": end}, f)
+
+    def mark(self, instance_id, state):
+        self.states[instance_id - self.start] = state
+
+    def mark_written(self, df):
+        """Mark every row of a chunk that has made it to disk as DONE. Meant to
+        be passed as a Sink's on_flush callback, so an ID is never DONE before
+        its row is safely written. Parquet sinks need close_chunks for that,
+        since an unclosed Parquet file can't be read back.
+        """
+        ids = df["instance_id"].to_numpy(dtype=np.int64)
+        self.states[ids - self.start] = DONE
+        self.flush()
+
+    def flush(self):
+        self.states.flush()
+
+    def pending(self, newest_first=False):
+        """Yield IDs that still need fetching: never tried, or failed last
+        time. Scans the map a block at a time so memory stays flat.
+
+        Args:
+          newest_first (bool): Yield in decreasing order instead.
+        """
+        offsets = range(0, len(self.states), BLOCK_SIZE)
+        for offset in reversed(offsets) if newest_first else offsets:
+            block = self.states[offset : offset + BLOCK_SIZE]
+            todo = np.flatnonzero((block == PENDING) | (block == FAILED))
+            for i in todo[::-1] if newest_first else todo:
+                yield self.start + offset + int(i)
+
+    def n_pending(self):
+        return int(
+            np.count_nonzero(self.states == PENDING)
+            + np.count_nonzero(self.states == FAILED)
+        )
+
+    def summary(self):
+        counts = np.bincount(self.states, minlength=4)
+        return (
+            f"{counts[DONE]} done, {counts[MISSING]} missing, "
+            f"{counts[FAILED]} failed, {counts[PENDING]} pending"
+        )
@@ -0,0 +1,91 @@
+"""
+client.py
+author: garrick
+
+Shared HTTP client for Bungie API calls. Every thread gets its own
+requests.Session, but all sessions share one connection pool, so connections
+(and their TCP+TLS handshakes) are reused across requests and threads instead
+of being set up for every call.
+"""
+import os
+import threading
+
+import requests
+from dotenv import load_dotenv
+from requests.adapters import HTTPAdapter
+
+# Max connections kept open at once. Matches the number of ThreadPool workers
+# so no worker has to wait on a connection.
+POOL_SIZE = 100
+# Seconds to wait on a request, unless a call says otherwise
+TIMEOUT = 10
+
+
+def get_headers():
+    """Get X-API-Key and place in header for all requests"""
+    api_key = get_api_keys()[0]
+    headers = {"X-API-Key": api_key}
+    return headers
+
+
+def get_api_keys():
+    """All API keys we may crawl with. Rate limits apply per key, so set
+    BUNGIE_NET_API_KEYS to a comma-separated list to crawl with several.
+    Falls back to BUNGIE_NET_API_KEY.
+    """
+    dotenv_path = os.path.normpath(
+        os.path.join(os.path.dirname(os.path.realpath(__file__)), "../..", ".env")
+    )
+    load_dotenv(dotenv_path)
+
+    keys = os.environ.get("BUNGIE_NET_API_KEYS")
+    if keys:
+        return [key.strip() for key in keys.split(",") if key.strip()]
+    return [os.environ["BUNGIE_NET_API_KEY"]]
+
+
+class Client:
+    """Pooled, keep-alive HTTP client.
+
+    Args:
+      headers (dict): Sent with every request, e.g. from get_headers().
+      pool_size (int): Max connections kept open per host.
+      timeout (float): Default per-call timeout in seconds.
+      pooled (bool): If False, every call opens a fresh connection, like
+        calling requests.get directly. Only useful for benchmarking.
+    """
+
+    def __init__(self, headers=None, pool_size=POOL_SIZE, timeout=TIMEOUT, pooled=True):
+        self.headers = {"Accept-Encoding": "gzip", **(headers or {})}
+        self.timeout = timeout
+        self.pooled = pooled
+
+        # urllib3's pools are thread-safe; block instead of opening extra
+        # connections beyond pool_size
+        self.adapter = HTTPAdapter(
+            pool_connections=4, pool_maxsize=pool_size, pool_block=True
+        )
+        self.local = threading.local()
+
+    def session(self):
+        session = getattr(self.local, "session", None)
+        if session is None:
+            session = requests.Session()
+            session.headers.update(self.headers)
+            session.mount("http://", self.adapter)
+            session.mount("https://", self.adapter)
+            self.local.session = session
+        return session
+
+    def get(self, url, timeout=None, **kwargs):
+        if timeout is None:
+            timeout = self.timeout
+
+        if not self.pooled:
+            headers = {**self.headers, **kwargs.pop("headers", {})}
+            return requests.get(url, headers=headers, timeout=timeout, **kwargs)
+
+        return self.session().get(url, timeout=timeout, **kwargs)
+
+    def close(self):
+        self.adapter.close()
@@ -0,0 +1,446 @@
+"""
+compact.py
+author: garrick
+
+Merge any number of crawl outputs (CSV or Parquet, wide or long, overlapping
+or not) into one dataset sorted by instance_id, keeping one copy of each
+activity. When outputs disagree about an activity, the one listed first wins.
+
+    python compact.py all.csv all_100k.csv gambit.csv pass_*.csv -o all.compact
+
+Crawl outputs aren't in ID order, so each is first cut into sorted runs of
+--run-rows rows. The runs are then merged a block at a time: every run holds
+its next block of rows, everything up to the smallest last ID among those
+blocks is taken from all of them, sorted, and deduplicated at once. Memory
+stays at about a block per run no matter how big the inputs are.
+
+The output directory holds Parquet partitions of --partition-rows rows, and
+an index.json with an entry per row group: its ID range and period range.
+Compacted reads just the row groups a lookup can touch:
+
+    data = Compacted("all.compact")
+    data.ids(8400554258, 8400564258)   # by instance ID
+    data.between("2022-09-01", "2022-09-02")   # by period
+"""
+import argparse
+import json
+import logging
+import os
+import shutil
+import time
+
+import numpy as np
+import pandas as pd
+
+from id_index import parse_time
+from sinks import ParquetSink, arrow_to_frame, read_chunks
+
+logger = logging.getLogger(__name__)
+
+
+# Rows per sorted run; the most held in memory while cutting runs
+RUN_ROWS = 200000
+# Rows read from each run at a time while merging
+BLOCK_ROWS = 10000
+PARTITION_ROWS = 100000
+# Rows per row group, the unit lookups read
+ROW_GROUP_ROWS = 10000
+# Columns that aren't float64 (see data_collection.PGCR_COLUMNS and
+# LONG_COLUMNS); any column ending in char_id is an int64 too, even in older
+# outputs that stored them as str
+INT_COLUMNS = {"instance_id", "player_index"}
+STR_COLUMNS = {"period", "director_activity_name"}
+INDEX_FILE = "index.json"
+EPOCH = pd.Timestamp(0, tz="UTC")
+
+
+def infer_columns(path):
+    """Column name -> dtype of a crawl output, as for a Sink. Works for
+    outputs from before the current schema too.
+    """
+    if path.endswith(".parquet"):
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        fields = [(f.name, f.type) for f in pq.read_schema(path)]
+        is_str = {name: pa.types.is_string(t) for name, t in fields}
+    else:
+        sample = pd.read_csv(path, index_col=0, nrows=1000, dtype=str)
+        numeric = sample.apply(pd.to_numeric, errors="coerce").notna() | sample.isna()
+        is_str = {name: not numeric[name].all() for name in sample.columns}
+
+    columns = {}
+    for name, string in is_str.items():
+        if name in INT_COLUMNS or name.endswith("char_id"):
+            columns[name] = "int64"
+        elif string or name in STR_COLUMNS:
+            columns[name] = "str"
+        else:
+            columns[name] = "float64"
+    return columns
+
+
+def merged_columns(paths):
+    """Every column of every output, in order of first appearance. Outputs
+    must all be wide or all be long.
+    """
+    columns = {}
+    long = set()
+    for path in paths:
+        found = infer_columns(path)
+        if "instance_id" not in found:
+            raise ValueError(f"{path} has no instance_id column")
+        long.add("player_index" in found)
+        for name, dtype in found.items():
+            columns.setdefault(name, dtype)
+    if len(long) > 1:
+        raise ValueError("Can't compact wide and long outputs together")
+    return columns
+
+
+def sort_runs(paths, columns, run_dir, run_rows=RUN_ROWS):
+    """Cut every output into sorted Parquet runs, in input order. Returns
+    the run paths, the input each came from (its index in paths), and the
+    rows read.
+    """
+    runs = []
+    sources = []
+    n_rows = 0
+    for source, path in enumerate(paths):
+        for chunk in read_chunks(path, columns, run_rows):
+            chunk = chunk.sort_values("instance_id", kind="stable")
+            run = os.path.join(run_dir, f"run{len(runs):05d}.parquet")
+            with ParquetSink(run, columns, chunk_size=run_rows) as sink:
+                sink.write_frame(chunk)
+            runs.append(run)
+            sources.append(source)
+            n_rows += len(chunk)
+        logger.info(f"Sorted {path} into {len(runs)} runs so far")
+    return runs, sources, n_rows
+
+
+def blocks(run, block_rows=BLOCK_ROWS):
+    """A sorted run's rows, about block_rows at a time, never splitting one
+    ID's rows (e.g. a long output's players) across blocks.
+    """
+    import pyarrow.parquet as pq
+
+    carry = None
+    for batch in pq.ParquetFile(run).iter_batches(batch_size=block_rows):
+        block = arrow_to_frame(batch)
+        if carry is not None:
+            block = pd.concat([carry, block], ignore_index=True)
+        ids = block["instance_id"].to_numpy()
+        cut = np.searchsorted(ids, ids[-1], side="left")
+        if cut == 0:
+            carry = block
+            continue
+        carry = block.iloc[cut:]
+        yield block.iloc[:cut]
+    if carry is not None and len(carry):
+        yield carry
+
+
+def dedupe(df, source, long):
+    """Keep the first copy of each activity from rows sorted by (ID, input).
+    A long output's activity is all of its rows from the first input that has
+    it.
+    """
+    ids = df["instance_id"].to_numpy()
+    starts = np.r_[True, ids[1:] != ids[:-1]]
+    if not long:
+        return df[starts]
+
+    # Input of each ID's first copy, spread over all of that ID's rows
+    first = np.maximum.accumulate(np.where(starts, np.arange(len(ids)), 0))
+    df = df[source == source[first]]
+    # An input may still repeat a player, e.g. from a resumed crawl
+    return df[~df.duplicated(["instance_id", "player_index"])]
+
+
+def merge_runs(runs, sources, long, block_rows=BLOCK_ROWS):
+    """Yield the rows of sorted runs as sorted, deduplicated DataFrames. Among
+    copies of an ID, earlier inputs come first, and within an input, earlier
+    runs and rows do.
+    """
+    readers = [blocks(run, block_rows) for run in runs]
+    # Run -> its current block, in run order
+    heads = {}
+    for i, reader in enumerate(readers):
+        block = next(reader, None)
+        if block is not None:
+            heads[i] = block
+
+    while heads:
+        # Every run's rows up to here are in memory; at least one run's block
+        # is used up each time
+        frontier = min(block["instance_id"].iat[-1] for block in heads.values())
+        taken = []
+        taken_sources = []
+        for i, block in list(heads.items()):
+            n = np.searchsorted(block["instance_id"].to_numpy(), frontier, "right")
+            taken.append(block.iloc[:n])
+            taken_sources.append(np.full(n, sources[i]))
+            if n < len(block):
+                heads[i] = block.iloc[n:]
+            else:
+                block = next(readers[i], None)
+                if block is None:
+                    del heads[i]
+                else:
+                    heads[i] = block
+
+        df = pd.concat(taken, ignore_index=True)
+        source = np.concatenate(taken_sources)
+        # Stable, so runs and rows keep their order within an input
+        order = np.lexsort((source, df["instance_id"].to_numpy()))
+        yield dedupe(df.iloc[order].reset_index(drop=True), source[order], long)
+
+
+def periods(column):
+    """Period strings to unix timestamps (NaN where missing)."""
+    times = pd.to_datetime(column, utc=True, errors="coerce")
+    return (times - EPOCH).dt.total_seconds().to_numpy()
+
+
+class PartitionWriter:
+    """Writes merged rows as Parquet partitions of row groups, and indexes
+    each row group.
+    """
+
+    def __init__(self, dir, columns, partition_rows, row_group_rows):
+        self.dir = dir
+        self.columns = columns
+        self.partition_rows = partition_rows
+        self.row_group_rows = row_group_rows
+        self.entries = []
+        self.pending = []
+        self.n_pending = 0
+        self.sink = None
+        self.n_partitions = 0
+        self.n_row_groups = 0
+
+    def write(self, df):
+        self.pending.append(df)
+        self.n_pending += len(df)
+        if self.n_pending >= self.row_group_rows:
+            self._flush(final=False)
+
+    def _flush(self, final):
+        if not self.n_pending:
+            return
+        df = pd.concat(self.pending, ignore_index=True)
+        n = len(df) if final else len(df) // self.row_group_rows * self.row_group_rows
+        for start in range(0, n, self.row_group_rows):
+            self._write_row_group(df.iloc[start : start + self.row_group_rows])
+        self.pending = [df.iloc[n:]]
+        self.n_pending = len(df) - n
+
+    def _write_row_group(self, df):
+        if self.sink is None or self.sink.n_written >= self.partition_rows:
+            if self.sink is not None:
+                self.sink.close()
+            name = f"part{self.n_partitions:05d}.parquet"
+            self.sink = ParquetSink(
+                os.path.join(self.dir, name), self.columns, on_flush=self._index
+            )
+            self.n_partitions += 1
+            self.n_row_groups = 0
+        self.sink.write_frame(df)
+        self.n_row_groups += 1
+
+    def _index(self, df):
+        ids = df["instance_id"].to_numpy()
+        times = periods(df["period"])
+        known = times[~np.isnan(times)]
+        self.entries.append(
+            {
+                "file": os.path.basename(self.sink.path),
+                "row_group": self.n_row_groups,
+                "rows": len(df),
+                "first_id": int(ids[0]),
+                "last_id": int(ids[-1]),
+                "first_period": int(known.min()) if len(known) else None,
+                "last_period": int(known.max()) if len(known) else None,
+            }
+        )
+
+    def close(self):
+        self._flush(final=True)
+        if self.sink is not None:
+            self.sink.close()
+
+
+def compact(
+    paths,
+    output,
+    run_rows=RUN_ROWS,
+    block_rows=BLOCK_ROWS,
+    partition_rows=PARTITION_ROWS,
+    row_group_rows=ROW_GROUP_ROWS,
+):
+    """Merge crawl outputs into a compacted dataset directory at output,
+    replacing it if it exists. Returns (rows read, rows written).
+    """
+    columns = merged_columns(paths)
+    long = "player_index" in columns
+
+    # Built alongside and moved into place at the end, so a failed compaction
+    # leaves any previous one alone
+    building = output.rstrip(os.sep) + ".building"
+    if os.path.exists(building):
+        shutil.rmtree(building)
+    run_dir = os.path.join(building, "runs")
+    os.makedirs(run_dir)
+
+    runs, sources, n_in = sort_runs(paths, columns, run_dir, run_rows)
+    writer = PartitionWriter(building, columns, partition_rows, row_group_rows)
+    for df in merge_runs(runs, sources, long, block_rows):
+        writer.write(df)
+    writer.close()
+    shutil.rmtree(run_dir)
+
+    n_out = sum(entry["rows"] for entry in writer.entries)
+    index = {
+        "columns": columns,
+        "sources": [os.path.abspath(path) for path in paths],
+        "rows": n_out,
+        "row_groups": writer.entries,
+    }
+    with open(os.path.join(building, INDEX_FILE), "w") as f:
+        json.dump(index, f, indent=1)
+
+    if os.path.exists(output):
+        shutil.rmtree(output)
+    os.replace(building, output)
+    return n_in, n_out
+
+
+class Compacted:
+    """A dataset written by compact().
+
+    Args:
+      dir (str): The compacted dataset's directory.
+    """
+
+    def __init__(self, dir):
+        self.dir = dir
+        with open(os.path.join(dir, INDEX_FILE)) as f:
+            meta = json.load(f)
+        self.columns = meta["columns"]
+        self.index = pd.DataFrame(
+            meta["row_groups"],
+            columns=[
+                "file",
+                "row_group",
+                "rows",
+                "first_id",
+                "last_id",
+                "first_period",
+                "last_period",
+            ],
+        )
+
+    def __len__(self):
+        return int(self.index["rows"].sum())
+
+    def _read(self, entries, columns=None):
+        import pyarrow.parquet as pq
+
+        frames = [
+            arrow_to_frame(
+                pq.ParquetFile(os.path.join(self.dir, file)).read_row_groups(
+                    list(group["row_group"]), columns=columns
+                )
+            )
+            for file, group in entries.groupby("file", sort=True)
+        ]
+        if not frames:
+            return pd.DataFrame(
+                {name: pd.Series(dtype=object) for name in columns or self.columns}
+            )
+        return pd.concat(frames, ignore_index=True)
+
+    def _with(self, columns, name):
+        # Lookups filter on a column, so read it even if it wasn't asked for
+        if columns is None or name in columns:
+            return columns
+        return [*columns, name]
+
+    def frame(self, columns=None):
+        """Everything, sorted by instance_id."""
+        return self._read(self.index, columns)
+
+    def ids(self, first, last=None, columns=None):
+        """Rows with first <= instance_id <= last (just first if last isn't
+        given).
+        """
+        last = first if last is None else last
+        touched = self.index[
+            (self.index["last_id"] >= first) & (self.index["first_id"] <= last)
+        ]
+        df = self._read(touched, self._with(columns, "instance_id"))
+        df = df[df["instance_id"].between(first, last)]
+        return df.reset_index(drop=True)[columns or list(df.columns)]
+
+    def between(self, start, end, columns=None):
+        """Rows played in [start, end). Takes anything id_index.parse_time
+        does, e.g. "2022-09-01" or a unix timestamp.
+        """
+        start, end = parse_time(start), parse_time(end)
+        touched = self.index[
+            (self.index["last_period"] >= start) & (self.index["first_period"] < end)
+        ]
+        df = self._read(touched, self._with(columns, "period"))
+        times = periods(df["period"])
+        df = df[(times >= start) & (times < end)]
+        return df.reset_index(drop=True)[columns or list(df.columns)]
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+
+    parser = argparse.ArgumentParser(
+        description="Merge crawl outputs into one sorted, deduplicated, indexed "
+        "dataset"
+    )
+    parser.add_argument(
+        "inputs",
+        nargs="+",
+        help="Crawl outputs (CSV or Parquet); earlier ones win on duplicate IDs",
+    )
+    parser.add_argument(
+        "-o", "--output", required=True, help="Directory to write, e.g. all.compact"
+    )
+    parser.add_argument(
+        "--run-rows",
+        type=int,
+        default=RUN_ROWS,
+        help="Rows sorted in memory at a time",
+    )
+    parser.add_argument(
+        "--block-rows",
+        type=int,
+        default=BLOCK_ROWS,
+        help="Rows read from each sorted run at a time while merging",
+    )
+    parser.add_argument("--partition-rows", type=int, default=PARTITION_ROWS)
+    parser.add_argument(
+        "--row-group-rows",
+        type=int,
+        default=ROW_GROUP_ROWS,
+        help="Rows per indexed row group; lookups read whole row groups",
+    )
+    args = parser.parse_args()
+
+    start = time.time()
+    n_in, n_out = compact(
+        args.inputs,
+        args.output,
+        run_rows=args.run_rows,
+        block_rows=args.block_rows,
+        partition_rows=args.partition_rows,
+        row_group_rows=args.row_group_rows,
+    )
+    print(f"time: {time.time() - start}")
+    print(f"rows: {n_in} read, {n_out} written, {n_in - n_out} duplicates dropped")
@@ -1,21 +1,38 @@
 # Collect data from the Bungie API.
+import argparse
+import asyncio
 import json
 import logging
+import multiprocessing
 import os
-import pickle
+import queue
+import threading
 import time
-from os.path import dirname, join, normpath, realpath
 from urllib.parse import urljoin
 
-import pandas as pd
+import aiohttp
 import requests
-from dotenv import load_dotenv
-
+from tqdm import tqdm
+
+from asyncpool import MAX_CONCURRENCY, AsyncPool
+from checkpoint import DONE, FAILED, MISSING, Checkpoint
+from client import POOL_SIZE, Client, get_api_keys, get_headers
+from feature_store import SNAPSHOT_INTERVAL, FeatureStore, snapshot_path
+from filters import ActivityFilter
+from id_index import IDIndex, ProbeError
+from manifest_store import ManifestStore
+from metrics import METRICS, HTTPReporter, JSONReporter, LogReporter
+from pgcr_cache import PGCRCache
+from ratelimit import BURST_SIZE, N_REQUESTS_PER_SECOND, TokenBucket
+from retry import HEDGE_BUDGET, MAX_ATTEMPTS, RETRY_BUDGET, Hedger, RetryQueue
+from sinks import CHUNK_SIZE, merge_outputs, open_sink, output_files
 from threadpool import ThreadPool
 
 logging.basicConfig(level=logging.INFO)
 logging.getLogger("threadpool").setLevel(logging.DEBUG)
+logging.getLogger("asyncpool").setLevel(logging.DEBUG)
 logging.getLogger("urllib3.connectionpool").setLevel(logging.WARNING)
+logger = logging.getLogger(__name__)
 
 # Constants
 STARTING_ACTIVITY_ID = 8400554258
@@ -24,38 +41,115 @@ STARTING_ACTIVITY_ID = 8400554258
 # ENDING_ACTIVITY_ID = STARTING_ACTIVITY_ID + int(10000)  # 10K
 ENDING_ACTIVITY_ID = STARTING_ACTIVITY_ID + int(100000)  # 100K
 # ENDING_ACTIVITY_ID = STARTING_ACTIVITY_ID + int(1e6)  # 1M
-
-# TODO pull out into common utils
-def get_headers():
-    """Get X-API-Key and place in header for all requests"""
-    dotenv_path = os.path.normpath(
-        os.path.join(os.path.dirname(os.path.realpath(__file__)), "../..", ".env")
-    )
-    load_dotenv(dotenv_path)
-
-    api_key = os.environ["BUNGIE_NET_API_KEY"]
-    headers = {"X-API-Key": api_key}
-    return headers
+OUTPUT_PATH = "test.csv"
+
+# What to pull out of each PGCR entry's "values". Maps our column name to the
+# stat's key in the API. Every stat is read as values[key]["basic"]["value"].
+PLAYER_STATS = {
+    "kills": "kills",
+    "deaths": "deaths",
+    "assists": "assists",
+    "kdr": "killsDeathsRatio",
+    "kda": "killsDeathsAssists",
+    "efficiency": "efficiency",
+    "score": "score",
+    # The API marks 1 as defeat, 0 as victory; we invert that
+    "standing": "standing",
+    "team_score": "teamScore",
+    # In seconds
+    "activity_duration": "activityDurationSeconds",
+}
+# Stats that need fixing up after they're read
+STAT_TRANSFORMS = {"standing": lambda value: 1 - value}
+
+# Output columns and their dtypes.
+PLAYER_COLUMNS = {
+    "char_id": "int64",
+    **{name: "float64" for name in PLAYER_STATS},
+}
+ACTIVITY_COLUMNS = {
+    "instance_id": "int64",
+    "period": "str",
+    "director_activity_name": "str",
+}
+
+# Wide format: one row per activity. Each player gets a block of columns, up
+# to MAX_PLAYERS players, so every row has the same columns regardless of
+# lobby size. Entries past that (PGCRs list everyone who joined or left, so
+# there can be more than a full lobby) are dropped and counted; raise it with
+# --max-players.
+MAX_PLAYERS = 12
+
+
+def wide_columns(max_players):
+    """Per-player keys and output columns for the wide format. Keys are
+    precomputed so rows aren't built with f-strings, e.g. keys[0]["kills"] is
+    "player1_kills".
+    """
+    keys = [
+        {name: f"player{i + 1}_{name}" for name in PLAYER_COLUMNS}
+        for i in range(max_players)
+    ]
+    columns = {
+        **ACTIVITY_COLUMNS,
+        **{
+            player_keys[name]: dtype
+            for player_keys in keys
+            for name, dtype in PLAYER_COLUMNS.items()
+        },
+    }
+    return keys, columns
 
 
-def load_manifest():
-    # TODO: check and abort if no manifest found
-    DATA_DIR = normpath(join(dirname(realpath(__file__)), "../data"))
-    manifest_path = join(DATA_DIR, "manifest.pickle")
+WIDE_KEYS, PGCR_COLUMNS = wide_columns(MAX_PLAYERS)
+# Only the first activity with too many players is logged; the rest are counted
+WARNED_PLAYERS_DROPPED = False
 
-    with open(manifest_path, "rb") as data:
-        return pickle.load(data)
+# Long format: one row per player per activity
+LONG_COLUMNS = {
+    **ACTIVITY_COLUMNS,
+    "player_index": "int64",
+    **PLAYER_COLUMNS,
+}
 
 
-INDEX = load_manifest()
+# Definitions are read lazily, only when looked up
+INDEX = ManifestStore()
 HEADERS = get_headers()
+# Keep-alive connections shared by every request
+CLIENT = Client(HEADERS)
+# Shared by every request so throttling backs off all workers at once
+RATE_LIMITER = TokenBucket()
+# Set to a Checkpoint to record which IDs are finished and skip them on restart
+CHECKPOINT = None
+# Crawl from the end of the ID range back, so the most recent activities are
+# fetched first if the crawl is cut short
+NEWEST_FIRST = False
+# Raw responses we've already downloaded, if caching (see pgcr_cache.py)
+CACHE = None
+# Set to a RetryQueue to try failed PGCR fetches again, and a Hedger to send
+# second copies of slow ones (see retry.py)
+RETRIES = None
+HEDGER = None
+# Hedges go out on their own connections, not queued behind the slow requests
+# they're hedging for one of CLIENT's
+HEDGE_CLIENT = None
+# Per-character rolling features to update as PGCRs come in, if kept (see
+# feature_store.py)
+FEATURES = None
 API_URL = "https://www.bungie.net/Platform/"
+# PlatformErrorCodes. Not found is the only answer that means there's nothing
+# to fetch; any other error (bad API key, maintenance, ...) is retried.
+PGCR_NOT_FOUND = 1653  # DestinyPGCRNotFound
+# PerEndpointRequestThrottleExceeded, ThrottleLimitExceeded{,Minutes,
+# Momentarily,Seconds}. These can come with ThrottleSeconds 0.
+THROTTLE_ERROR_CODES = {31, 35, 36, 37, 38}
 GET_ACTIVITY_HISTORY = "Destiny2/{membershipType}/Account/{destinyMembershipId}/Character/{characterId}/Stats/Activities/"
 GET_POST_GAME_CARNAGE_REPORT = "Destiny2/Stats/PostGameCarnageReport/{activityId}/"
 # TODO: get character stats
 # TODO: get weapon stats per weapon
 
-# r = requests.get(path, headers=HEADERS)
+# r = CLIENT.get(path)
 # print(json.dumps(r.json(), indent=4))  # Example of prettyprint
 
 
@@ -91,108 +185,53 @@ def get_activity_values(activity):
     return activity["values"]
 
 
-def get_value_kills(values):
-    if "kills" in values:
-        return values["kills"]["basic"]["value"]
-    else:
-        return None
-
-
-def get_value_deaths(values):
-    if "deaths" in values:
-        return values["deaths"]["basic"]["value"]
-    else:
-        return None
-
-
-def get_value_assists(values):
-    # NOTE: takes in values object from activity summary
-    if "assists" in values:
-        return values["assists"]["basic"]["value"]
-    else:
-        return None
-
-
-def get_value_score(values):
-    if "score" in values:
-        return values["score"]["basic"]["value"]
+def get_value(values, key):
+    # Read one stat out of an activity's or entry's values, e.g. "kills",
+    # "completed" (1 if completed), or "opponentsDefeated"
+    if key in values:
+        return values[key]["basic"]["value"]
     else:
         return None
 
 
-def get_value_completed(values):
-    # 1 if completed, NOTE haven't seen not completed but assuming it's 0
-    if "completed" in values:
-        return values["completed"]["basic"]["value"]
-    else:
-        return None
-
-
-def get_value_opponents_defeated(values):
-    # TODO what is the difference between this and kills?
-    if "opponentsDefeated" in values:
-        return values["opponentsDefeated"]["basic"]["value"]
-    else:
-        return None
-
-
-def get_value_combat_efficiency(values):
-    if "efficiency" in values:
-        return values["efficiency"]["basic"]["value"]
-    else:
-        return None
-
-
-def get_value_kdr(values):
-    if "killsDeathsRatio" in values:
-        return values["killsDeathsRatio"]["basic"]["value"]
-    else:
-        return None
-
-
-def get_value_kda(values):
-    if "killsDeathsAssists" in values:
-        return values["killsDeathsAssists"]["basic"]["value"]
-    else:
-        return None
-
-
-def get_value_activity_duration(values, in_units_of="seconds"):
-    # Returns activity duration in seconds
-    # TODO allow translation to other units if need be
-    if "activityDurationSeconds" in values:
-        return values["activityDurationSeconds"]["basic"]["value"]
-    else:
-        return None
-
-
-def get_value_team(values):
-    if "team" in values:
-        return values["team"]["basic"]["value"]
-    else:
-        return None
+def get_activity_history_page(character_data, page=0, count=25, mode=None):
+    """One page of a character's activity history, newest first. Returns the
+    page's activities ([] once past the last page), or None if the request
+    failed.
 
+    Args:
+      character_data (dict): membershipType, destinyMembershipId and
+        characterId of the character.
+      page (int): Which page, from 0.
+      count (int): Activities per page, up to 250.
+      mode (int): Only activities of this DestinyActivityModeType.
+    """
+    path = urljoin(API_URL, GET_ACTIVITY_HISTORY.format(**character_data))
+    params = {"count": count, "page": page}
+    if mode is not None:
+        params["mode"] = mode
 
-def get_value_standing(values):
-    # The API marks 1 as defeat, 0 as victory; we invert that
-    if "standing" in values:
-        return 1 - values["standing"]["basic"]["value"]
-    else: 
+    try:
+        r = CLIENT.get(path, params=params)
+    except requests.RequestException:
+        METRICS.incr("errors.connection")
         return None
+    try:
+        body = r.json()
+    except ValueError:
+        body = None
 
-
-def get_value_team_score(values):
-    if "teamScore" in values:
-        return values["teamScore"]["basic"]["value"]
-    else:
+    response, _ = check_body(character_data["characterId"], r.status_code, body)
+    if response is None:
         return None
+    METRICS.incr("history.ok")
+    # Past the last page, Response comes back empty
+    return response.get("activities", [])
 
 
 def get_activity_history(character_data, params=None):
-    path = urljoin(API_URL, GET_ACTIVITY_HISTORY.format(**character_data))
-    r = requests.get(path, headers=HEADERS, params=params)
-
-    activities = r.json()["Response"]["activities"]
+    params = params or {}
+    activities = get_activity_history_page(character_data, **params) or []
     print(f"{len(activities)} activities found")
 
     history = []
@@ -205,7 +244,7 @@ def get_activity_history(character_data, params=None):
         id = get_activity_instance_id(activity)
 
         # TODO: filter and bucket activities. get more. use recent activities as features per player
-        # print(f"{period}, {activity_name}, victory?: {get_value_standing(values)}, kills: {get_value_kills(values)}, oppDef: {get_value_opponents_defeated(values)}")
+        # print(f"{period}, {activity_name}, victory?: {get_value(values, 'standing')}, kills: {get_value(values, 'kills')}, oppDef: {get_value(values, 'opponentsDefeated')}")
         print(f"{period}, {activity_name}, {id}")
         history.append(
             {
@@ -219,128 +258,994 @@ def get_activity_history(character_data, params=None):
     return history
 
 
-def scrape_pgcr(instance_id):
+def scrape_pgcr(instance_id, filter=None):
     """Given an instance id, make a request to Platform API, scrape data from
-    the JSON response, and assembler and return a dict mapping column names to
-    values.
+    the JSON response, and return it as parsed by parse_pgcr.
 
     Args:
       instance_id (int): The ID of the activity instance. Activities are 
         numbered in roughly increasing order and uniquely identify an activity.
+      filter (ActivityFilter): If given, activities it rejects are skipped
+        (returning None) before they're parsed.
     """
     path = urljoin(
         API_URL, GET_POST_GAME_CARNAGE_REPORT.format(**{"activityId": instance_id})
     )
+    start = time.perf_counter()
     try:
-        r = requests.get(path, headers=HEADERS, timeout=1)
-    except requests.ConnectionError:
-        # A connection error occurred. Probably some network issue.
-        return None
+        if HEDGER is not None:
+            r = HEDGER.call(CLIENT.get, path, timeout=1, hedge_with=HEDGE_CLIENT.get)
+        else:
+            r = CLIENT.get(path, timeout=1)
     except requests.Timeout:
         # A timeout error occurred
+        METRICS.incr("errors.timeout")
+        record_state(instance_id, FAILED)
+        return None
+    except requests.RequestException:
+        # A connection error occurred (refused, reset, dropped mid-body...).
+        # Probably some network issue.
+        METRICS.incr("errors.connection")
+        record_state(instance_id, FAILED)
         return None
+    METRICS.observe("pgcr.request", time.perf_counter() - start)
+
+    return handle_response(instance_id, r.status_code, r.content, filter)
+
+
+async def scrape_pgcr_async(session, instance_id, filter=None, hedge_session=None):
+    """Same as scrape_pgcr, but makes the request on a shared aiohttp session
+    so it can be run from AsyncPool.
+
+    Args:
+      session (aiohttp.ClientSession): Session carrying the API key headers.
+      instance_id (int): The ID of the activity instance.
+      filter (ActivityFilter): As for scrape_pgcr.
+      hedge_session (aiohttp.ClientSession): Where hedges go, if HEDGER is
+        set; defaults to session.
+    """
+    path = urljoin(
+        API_URL, GET_POST_GAME_CARNAGE_REPORT.format(**{"activityId": instance_id})
+    )
+
+    async def get(session=session):
+        async with session.get(path) as r:
+            return r.status, await r.read()
+
+    async def hedge():
+        return await get(hedge_session or session)
+
+    start = time.perf_counter()
+    try:
+        if HEDGER is not None:
+            status, content = await HEDGER.call_async(get, hedge_with=hedge)
+        else:
+            status, content = await get()
+    except asyncio.TimeoutError:
+        # A timeout error occurred. Checked first, since aiohttp's read
+        # timeouts are ClientErrors too.
+        METRICS.incr("errors.timeout")
+        record_state(instance_id, FAILED)
+        return None
+    except aiohttp.ClientError:
+        # A connection error occurred. Probably some network issue.
+        METRICS.incr("errors.connection")
+        record_state(instance_id, FAILED)
+        return None
+    METRICS.observe("pgcr.request", time.perf_counter() - start)
+
+    return handle_response(instance_id, status, content, filter)
+
+
+def handle_response(instance_id, status, content, filter=None, cached=False):
+    """Filter, decode, check and parse a PGCR response body. The filter runs
+    first on the raw bytes, then on the activity details, so rejected
+    activities skip JSON decoding where possible and entry parsing always.
+    Successful responses fresh off the network go into CACHE, filtered out or
+    not, so they can be re-extracted later with a different filter.
+
+    Args:
+      instance_id (int): The ID of the activity instance.
+      status (int): HTTP status code.
+      content (bytes): Undecoded response body.
+      filter (ActivityFilter): Optional; see scrape_pgcr.
+      cached (bool): Whether content came from CACHE.
+    """
+    start = time.perf_counter()
+    cache = CACHE if not cached else None
+    if filter is not None and not filter.accepts_raw(content):
+        # Only a real PGCR has an activity to reject, so this was a success.
+        # Cache hits sent no request, so they say nothing about our rate.
+        if not cached:
+            RATE_LIMITER.succeeded()
+        if cache is not None:
+            cache.put(instance_id, content)
+        return skip(instance_id)
 
     try:
-        pgcr = r.json()["Response"]
-    except json.JSONDecodeError:
+        body = json.loads(content)
+    except ValueError:
         # This can mean we've gone over our request rate limit, or something else
-        print(f"Error: got status {r.status_code}")
-        # print(f"Error {r['ErrorStatus']} ({r['ErrorCode']}): {r['Message']}")
-        # print(f"Throttle seconds {r['ThrottleSeconds']}")
-        # raise RuntimeError
+        body = None
 
-        # Just return silently
+    pgcr = check_response(instance_id, status, body, cached=cached)
+    if pgcr is None:
         return None
+    if cache is not None:
+        cache.put(instance_id, content)
+    if filter is not None and not filter.accepts(pgcr):
+        return skip(instance_id)
 
-    period = get_activity_period(pgcr)
-    director_activity_name = get_director_activity_name(pgcr)
+    entry = parse_pgcr(instance_id, pgcr)
+    METRICS.observe("pgcr.parse", time.perf_counter() - start)
+    return entry
 
-    # TODO: different games have different values; our implementation should be robust to this
-    # if director_activity_name != "Gambit":
-    #     return {
-    #         "instance_id": instance_id,
-    #         "period": period,
-    #         "director_activity_name": director_activity_name,
-    #     }
 
-    entries = pgcr["entries"]
-    # print(f"Activity {instance_id} has {len(entries)} entries...")
+def skip(instance_id):
+    METRICS.incr("pgcr.filtered")
+    record_state(instance_id, DONE)
+    return None
 
-    player_entries = {}
-    for i, entry in enumerate(entries):
-        # TODO handle extended and other props
-        characterId = entry["characterId"]
-        player_entries[f"player{i + 1}_char_id"] = characterId
 
-        # Values (kills, assists, etc.)
-        if "values" not in entry: 
-            continue
-        
-        values = entry["values"]
-        player_entries[f"player{i + 1}_kills"] = get_value_kills(values)
-        player_entries[f"player{i + 1}_deaths"] = get_value_deaths(values)
-        player_entries[f"player{i + 1}_assists"] = get_value_assists(values)
-        player_entries[f"player{i + 1}_kdr"] = get_value_kdr(values)
-        player_entries[f"player{i + 1}_kda"] = get_value_kda(values)
-        player_entries[f"player{i + 1}_efficiency"] = get_value_combat_efficiency(
-            values
+def probe_period(instance_id):
+    """Fetch just the period of a PGCR, or None if there isn't one. Raises
+    ProbeError if the request failed, so IDIndex never remembers a failure as
+    a miss.
+    """
+    path = urljoin(
+        API_URL, GET_POST_GAME_CARNAGE_REPORT.format(**{"activityId": instance_id})
+    )
+    RATE_LIMITER.acquire()
+    try:
+        r = CLIENT.get(path)
+    except requests.RequestException as e:
+        raise ProbeError(repr(e)) from e
+    try:
+        body = r.json()
+    except ValueError:
+        body = None
+
+    pgcr, state = check_body(instance_id, r.status_code, body)
+    if pgcr is not None:
+        return get_activity_period(pgcr)
+    if state == MISSING:
+        return None
+    raise ProbeError(f"status {r.status_code}")
+
+
+def check_response(instance_id, status, body, cached=False):
+    """Inspect a PGCR response with check_body, and record the instance's
+    state if it failed. Returns the "Response" object on success, otherwise
+    None.
+
+    Args:
+      instance_id (int): The ID of the activity instance.
+      status (int): HTTP status code.
+      body (dict): Decoded JSON body, or None if it wasn't JSON.
+      cached (bool): Whether the body came from CACHE rather than the API.
+    """
+    response, state = check_body(instance_id, status, body, cached=cached)
+    if response is None:
+        record_state(instance_id, state)
+        return None
+
+    METRICS.incr("pgcr.ok")
+    return response
+
+
+def check_body(label, status, body, cached=False):
+    """Inspect any Platform API response, reporting throttling to
+    RATE_LIMITER. Returns (the "Response" object, None) on success, otherwise
+    logs why and returns (None, MISSING) if the API says there's no such
+    PGCR, or (None, FAILED) for any other error, so it's retried.
+
+    Args:
+      label: What was requested, for logging (e.g. an instance ID).
+      status (int): HTTP status code.
+      body (dict): Decoded JSON body, or None if it wasn't JSON.
+      cached (bool): The body was replayed from CACHE, so no request was
+        sent and RATE_LIMITER isn't told anything.
+    """
+    if body is None:
+        # Throttled responses sometimes come back as an HTML error page
+        METRICS.incr("errors.non_json")
+        if status == 429 and not cached:
+            METRICS.incr("errors.throttled")
+            RATE_LIMITER.throttled()
+        logger.warning(f"{label}: got status {status} with non-JSON body")
+        return None, FAILED
+
+    throttle_seconds = body.get("ThrottleSeconds", 0)
+    error_code = body.get("ErrorCode")
+    throttled = (
+        status == 429 or throttle_seconds > 0 or error_code in THROTTLE_ERROR_CODES
+    )
+    if throttled and not cached:
+        METRICS.incr("errors.throttled")
+        RATE_LIMITER.throttled(throttle_seconds)
+
+    if error_code != 1 or "Response" not in body:
+        # 1 is Success; anything else carries a status and message
+        logger.warning(
+            f"{label}: {body.get('ErrorStatus')} ({error_code}): "
+            f"{body.get('Message')}"
         )
-        player_entries[f"player{i + 1}_score"] = get_value_score(values)
+        if error_code == PGCR_NOT_FOUND and not throttled:
+            METRICS.incr("errors.missing")
+            return None, MISSING
+        if not throttled:
+            METRICS.incr("errors.api")
+        return None, FAILED
+
+    if not cached:
+        RATE_LIMITER.succeeded()
+    return body["Response"], None
+
+
+def parse_pgcr(instance_id, pgcr):
+    """Scrape data from the Response of a PGCR request. Returns a dict with
+    the activity columns plus "players", a list of dicts mapping each of
+    PLAYER_COLUMNS to a value, in entry order. Use to_wide or to_long to turn
+    it into output rows.
+
+    Args:
+      instance_id (int): The ID of the activity instance.
+      pgcr (dict): The "Response" object of the PGCR JSON.
+    """
+    period = get_activity_period(pgcr)
+    director_activity_name = get_director_activity_name(pgcr)
 
-        player_entries[f"player{i + 1}_standing"] = get_value_standing(values)
-        player_entries[f"player{i + 1}_team_score"] = get_value_team_score(values)
-        player_entries[
-            f"player{i + 1}_activity_duration"
-        ] = get_value_activity_duration(values)
+    entries = pgcr["entries"]
+    # print(f"Activity {instance_id} has {len(entries)} entries...")
 
-    # Return dict
     return {
         "instance_id": instance_id,
         "period": period,
         "director_activity_name": director_activity_name,
-        **player_entries,
+        "players": [parse_entry(entry) for entry in entries],
     }
 
 
-def scrape_pgcrs(filter=None):
-    data = []  # List of dicts
+def parse_entry(entry):
+    # TODO handle extended and other props
+    player = {"char_id": int(entry["characterId"])}
 
-    for instance_id in range(STARTING_ACTIVITY_ID, ENDING_ACTIVITY_ID):
-        entry = scrape_pgcr(instance_id)
-        if filter is None or entry["director_activity_name"] == filter:
-            data.append(entry)
+    # Values (kills, assists, etc.). Different activities report different
+    # stats; ones that aren't there are left out.
+    values = entry.get("values")
+    if values is None:
+        return player
 
-    df = pd.DataFrame(data)
-    df.to_csv("test.csv")
+    for name, key in PLAYER_STATS.items():
+        stat = values.get(key)
+        if stat is not None:
+            player[name] = stat["basic"]["value"]
 
+    for name, transform in STAT_TRANSFORMS.items():
+        if name in player:
+            player[name] = transform(player[name])
 
-# TODO: filter only activities we want/attributes we want
-def scrape_pgcrs_multithreaded(filter=None):
-    data = []  # List of dicts
-    t = ThreadPool()
+    return player
 
-    for instance_id in range(STARTING_ACTIVITY_ID, ENDING_ACTIVITY_ID):
-        # Create a closure
-        def make_func(id):
-            def func():
-                entry = scrape_pgcr(id)
-                if entry == None:
-                    return  # Error happened/malformed entry
-                if filter is None or entry["director_activity_name"] == filter:
-                    data.append(entry)
 
-            return func
+def to_wide(activity):
+    """One row for the activity, with player{i}_ columns for each player."""
+    row = {
+        "instance_id": activity["instance_id"],
+        "period": activity["period"],
+        "director_activity_name": activity["director_activity_name"],
+    }
+    players = activity["players"]
+    for keys, player in zip(WIDE_KEYS, players):
+        for name, value in player.items():
+            row[keys[name]] = value
+
+    dropped = len(players) - len(WIDE_KEYS)
+    if dropped > 0:
+        global WARNED_PLAYERS_DROPPED
+        if not WARNED_PLAYERS_DROPPED:
+            WARNED_PLAYERS_DROPPED = True
+            logger.warning(
+                f"Activity {activity['instance_id']} has {len(players)} players; "
+                f"only {len(WIDE_KEYS)} fit in a wide row (see --max-players)"
+            )
+        METRICS.incr("wide.players_dropped", dropped)
+    return [row]
+
+
+def to_long(activity):
+    """One row per player in the activity."""
+    rows = []
+    for i, player in enumerate(activity["players"]):
+        rows.append(
+            {
+                "instance_id": activity["instance_id"],
+                "period": activity["period"],
+                "director_activity_name": activity["director_activity_name"],
+                "player_index": i,
+                **player,
+            }
+        )
+    return rows
+
+
+# Output formats: how to turn a parsed PGCR into rows, and the rows' columns
+FORMATS = {
+    "wide": (to_wide, PGCR_COLUMNS),
+    "long": (to_long, LONG_COLUMNS),
+}
+
+
+def set_max_players(max_players):
+    """Resize the wide format to max_players player blocks."""
+    global MAX_PLAYERS, WIDE_KEYS, PGCR_COLUMNS
+    MAX_PLAYERS = max_players
+    WIDE_KEYS, PGCR_COLUMNS = wide_columns(max_players)
+    FORMATS["wide"] = (to_wide, PGCR_COLUMNS)
+
+
+def record_state(instance_id, state):
+    if CHECKPOINT is not None:
+        CHECKPOINT.mark(instance_id, state)
+    if state == FAILED and RETRIES is not None:
+        RETRIES.failed(instance_id)
+
+
+def with_retries(ids, asynchronous=False, stop=None):
+    """ids, with retries of failed ones mixed in if RETRIES is set. Jobs must
+    call finish() on each ID when they're done with it.
+    """
+    if RETRIES is None:
+        return ids
+    return RETRIES.feed_async(ids) if asynchronous else RETRIES.feed(ids, stop)
+
+
+def finish(instance_id):
+    if RETRIES is not None:
+        RETRIES.finished(instance_id)
+
+
+def crawl_ids():
+    """Instance IDs to fetch: the whole range, or only what's left to do if
+    there's a checkpoint. Returns (ids, total).
+    """
+    if CHECKPOINT is None:
+        ids = range(STARTING_ACTIVITY_ID, ENDING_ACTIVITY_ID)
+        return ids[::-1] if NEWEST_FIRST else ids, len(ids)
+    return CHECKPOINT.pending(NEWEST_FIRST), CHECKPOINT.n_pending()
+
+
+def priority(instance_id):
+    """ThreadPool priority of an ID, so retries queue by recency too."""
+    return -instance_id if NEWEST_FIRST else 0
+
+
+def open_output(output, chunk_size, format):
+    # IDs are only marked done once their rows are on disk, in a closed file
+    on_flush = CHECKPOINT.mark_written if CHECKPOINT is not None else None
+    _, columns = FORMATS[format]
+    return open_sink(
+        output,
+        columns,
+        chunk_size,
+        on_flush=on_flush,
+        close_chunks=on_flush is not None,
+    )
+
+
+def make_filter(
+    names=None, modes=None, period_start=None, period_end=None, min_players=None
+):
+    """Build an ActivityFilter, or None if nothing is filtered on. Activity
+    names are resolved to their hashes once here, so nothing is localized
+    per PGCR.
+
+    Args:
+      names (list): Activity names to keep, e.g. ["Gambit"].
+      Other args as for ActivityFilter.
+    """
+    hashes = None
+    if names:
+        hashes = set()
+        for name in names:
+            named = INDEX.hashes_named("DestinyActivityDefinition", name)
+            if not named:
+                logger.warning(f"No activities named {name!r} in the manifest")
+            hashes |= named
+
+    if all(
+        arg is None for arg in (hashes, modes, period_start, period_end, min_players)
+    ):
+        return None
+    return ActivityFilter(
+        activity_hashes=hashes,
+        modes=modes,
+        period_start=period_start,
+        period_end=period_end,
+        min_players=min_players,
+    )
+
+
+def handle_entry(instance_id, entry, sink, format):
+    if entry == None:
+        return  # Error happened/malformed/filtered out entry
+
+    if FEATURES is not None:
+        FEATURES.update(entry)
+
+    to_rows, _ = FORMATS[format]
+    rows = to_rows(entry)
+    if not rows:
+        # Nothing to write (no players), so it won't be marked on flush
+        record_state(instance_id, DONE)
+    for row in rows:
+        sink.write(row)
+
+
+def extract_cached(instance_id, filter, sink, format):
+    """Extract one PGCR from CACHE. Returns False if it isn't cached."""
+    content = CACHE.get(instance_id)
+    if content is None:
+        return False
+    METRICS.incr("cache.hit")
+    entry = handle_response(instance_id, 200, content, filter, cached=True)
+    handle_entry(instance_id, entry, sink, format)
+    return True
 
-        # Needed to create a new scope around the current value of instance_id
-        t.schedule(make_func(instance_id))
 
-    t.shutdown()
+def through_cache(ids, filter, sink, format):
+    """Extract whatever's cached as it comes up, and pass on only the IDs we
+    still need to fetch, so cache hits never wait on the rate limiter.
+    """
+    if CACHE is None:
+        yield from ids
+        return
+
+    for instance_id in ids:
+        if not extract_cached(instance_id, filter, sink, format):
+            yield instance_id
+
+
+def scrape_pgcrs(filter=None, output=OUTPUT_PATH, chunk_size=CHUNK_SIZE, format="wide"):
+    ids, _ = crawl_ids()
+
+    with open_output(output, chunk_size, format) as sink:
+        ids = with_retries(through_cache(ids, filter, sink, format))
+        for instance_id in ids:
+            RATE_LIMITER.acquire()
+            try:
+                entry = scrape_pgcr(instance_id, filter)
+                handle_entry(instance_id, entry, sink, format)
+            finally:
+                finish(instance_id)
+
+
+def scrape_pgcrs_multithreaded(
+    filter=None,
+    output=OUTPUT_PATH,
+    chunk_size=CHUNK_SIZE,
+    format="wide",
+    progress=True,
+    deadline=None,
+    max_requests=None,
+):
+    """Fetch the crawl range on a ThreadPool. Stops early, keeping everything
+    fetched so far, after deadline seconds, max_requests requests, or
+    Ctrl-C. With a checkpoint, the rest is picked up on the next run.
+    """
+    t = ThreadPool(
+        limiter=RATE_LIMITER,
+        progress=progress,
+        deadline=deadline,
+        max_jobs=max_requests,
+    )
+    ids, total = crawl_ids()
+
+    with open_output(output, chunk_size, format) as sink:
+
+        def func(instance_id):
+            try:
+                entry = scrape_pgcr(instance_id, filter)
+                handle_entry(instance_id, entry, sink, format)
+            finally:
+                finish(instance_id)
+
+        # IDs are handed to workers lazily as queue slots free up. Waiting on
+        # retries happens here, in the thread feeding the pool.
+        ids = with_retries(through_cache(ids, filter, sink, format), stop=t.cancelled)
+        try:
+            t.map(func, ids, total=total, priority=priority)
+        except KeyboardInterrupt:
+            t.cancel("interrupted")
+        # Lets running jobs finish, so their rows are flushed with the rest
+        t.shutdown()
+
+
+def scrape_pgcrs_async(
+    filter=None,
+    max_concurrency=MAX_CONCURRENCY,
+    output=OUTPUT_PATH,
+    chunk_size=CHUNK_SIZE,
+    format="wide",
+    progress=True,
+):
+    pool = AsyncPool(
+        max_concurrency=max_concurrency,
+        limiter=RATE_LIMITER,
+        progress=progress,
+        hedge_session=HEDGER is not None,
+    )
+    ids, total = crawl_ids()
+
+    with open_output(output, chunk_size, format) as sink:
+
+        async def func(session, instance_id, hedge_session=None):
+            try:
+                entry = await scrape_pgcr_async(
+                    session, instance_id, filter, hedge_session
+                )
+                handle_entry(instance_id, entry, sink, format)
+            finally:
+                finish(instance_id)
+
+        ids = with_retries(through_cache(ids, filter, sink, format), asynchronous=True)
+        pool.run(func, ids, headers=HEADERS, total=total)
+
+
+def reextract_pgcrs(
+    filter=None, output=OUTPUT_PATH, chunk_size=CHUNK_SIZE, format="wide", progress=True
+):
+    """Rebuild a dataset from CACHE alone, without touching the network. Only
+    cached IDs in the crawl range are extracted.
+    """
+    with open_output(output, chunk_size, format) as sink:
+        ids = CACHE.ids(STARTING_ACTIVITY_ID, ENDING_ACTIVITY_ID)
+        for instance_id in tqdm(ids, disable=not progress):
+            extract_cached(instance_id, filter, sink, format)
+
+
+def shard_path(path, i):
+    root, ext = os.path.splitext(path)
+    return f"{root}.shard{i}{ext}"
+
+
+def scrape_shard(config, progress_queue):
+    """Crawl one shard of the ID range in a worker process, with its own API
+    key and rate budget. Runs with the threaded or async engine, and
+    periodically sends a metrics snapshot back to the coordinator.
+
+    Args:
+      config (dict): Shard settings from scrape_pgcrs_sharded.
+      progress_queue (multiprocessing.Queue): Receives (shard, snapshot).
+    """
+    global API_URL, HEADERS, CLIENT, RATE_LIMITER, CHECKPOINT, CACHE, RETRIES
+    global HEDGER, HEDGE_CLIENT
+    global STARTING_ACTIVITY_ID, ENDING_ACTIVITY_ID
+
+    # This process is spawned fresh, so set everything up from config
+    API_URL = config["api_url"]
+    HEADERS = {"X-API-Key": config["key"]}
+    CLIENT = Client(HEADERS, pool_size=config["pool_size"])
+    RATE_LIMITER = TokenBucket(rate=config["rate"], burst=config["burst"])
+    STARTING_ACTIVITY_ID, ENDING_ACTIVITY_ID = config["start"], config["end"]
+    set_max_players(config["max_players"])
+    if config["checkpoint"] is not None:
+        CHECKPOINT = Checkpoint(
+            config["checkpoint"], STARTING_ACTIVITY_ID, ENDING_ACTIVITY_ID
+        )
+    if config["cache"] is not None:
+        CACHE = PGCRCache(config["cache"])
+    if config["retries"] is not None:
+        RETRIES = RetryQueue(**config["retries"])
+    if config["hedge"] is not None:
+        HEDGER = Hedger(limiter=RATE_LIMITER, **config["hedge"])
+        HEDGE_CLIENT = Client(HEADERS, pool_size=config["pool_size"])
+
+    shard = config["shard"]
+    done = threading.Event()
+
+    def report_progress():
+        while not done.wait(1):
+            progress_queue.put((shard, METRICS.snapshot()))
+
+    reporter = threading.Thread(target=report_progress, daemon=True)
+    reporter.start()
+
+    output = {
+        "filter": config["filter"],
+        "output": config["output"],
+        "chunk_size": config["chunk_size"],
+        "format": config["format"],
+        "progress": False,
+    }
+    if config["engine"] == "async":
+        scrape_pgcrs_async(max_concurrency=config["max_concurrency"], **output)
+    else:
+        scrape_pgcrs_multithreaded(**output)
+
+    done.set()
+    reporter.join()
+    if CHECKPOINT is not None:
+        CHECKPOINT.flush()
+    if CACHE is not None:
+        CACHE.close()
+    if HEDGER is not None:
+        HEDGER.close()
+    progress_queue.put((shard, METRICS.snapshot()))
+
+
+def scrape_pgcrs_sharded(
+    keys,
+    processes_per_key=1,
+    engine="threaded",
+    filter=None,
+    output=OUTPUT_PATH,
+    chunk_size=CHUNK_SIZE,
+    format="wide",
+    rate=N_REQUESTS_PER_SECOND,
+    burst=BURST_SIZE,
+    checkpoint=None,
+    cache=None,
+    retries=None,
+    hedge=None,
+    max_concurrency=MAX_CONCURRENCY,
+    pool_size=POOL_SIZE,
+):
+    """Split the ID range into contiguous shards, one per worker process, and
+    crawl them in parallel. Each key gets processes_per_key workers, which
+    split that key's rate budget between them. Shard outputs are merged into
+    output at the end. Shards can share one cache directory. retries and
+    hedge are keyword arguments for each shard's RetryQueue and Hedger, or
+    None for none.
+    """
+    n_shards = len(keys) * processes_per_key
+    n_ids = ENDING_ACTIVITY_ID - STARTING_ACTIVITY_ID
+    bounds = [STARTING_ACTIVITY_ID + n_ids * i // n_shards for i in range(n_shards + 1)]
+
+    configs = []
+    for i in range(n_shards):
+        configs.append(
+            {
+                "shard": i,
+                "key": keys[i // processes_per_key],
+                "api_url": API_URL,
+                "start": bounds[i],
+                "end": bounds[i + 1],
+                "engine": engine,
+                "filter": filter,
+                "output": shard_path(output, i),
+                "chunk_size": chunk_size,
+                "format": format,
+                "max_players": MAX_PLAYERS,
+                "rate": rate / processes_per_key,
+                "burst": burst,
+                "checkpoint": shard_path(checkpoint, i) if checkpoint else None,
+                "cache": cache,
+                "retries": retries,
+                "hedge": hedge,
+                "max_concurrency": max_concurrency,
+                "pool_size": pool_size,
+            }
+        )
+
+    # Spawn rather than fork; forking a process with threads running is unsafe
+    context = multiprocessing.get_context("spawn")
+    progress_queue = context.Queue()
+    workers = [
+        context.Process(target=scrape_shard, args=(config, progress_queue))
+        for config in configs
+    ]
+    for worker in workers:
+        worker.start()
+    logger.info(f"Started {n_shards} shards across {len(keys)} API keys")
+
+    # Merge progress from every shard into one bar
+    snapshots = {}
+    pbar = tqdm(total=None if checkpoint else n_ids)
+    while any(worker.is_alive() for worker in workers) or not progress_queue.empty():
+        try:
+            shard, snapshot = progress_queue.get(timeout=0.5)
+        except queue.Empty:
+            continue
+        snapshots[shard] = snapshot
+        # Fetched through the pool, or served straight from the cache
+        n_done = sum(
+            s["histograms"].get("pool.job", {}).get("count", 0)
+            + s["counters"].get("cache.hit", 0)
+            for s in snapshots.values()
+        )
+        pbar.update(n_done - pbar.n)
+    pbar.close()
 
-    df = pd.DataFrame(data)
-    df.to_csv("test.csv")
+    for worker in workers:
+        worker.join()
+    failed = [i for i, worker in enumerate(workers) if worker.exitcode != 0]
+
+    counters = {}
+    for snapshot in snapshots.values():
+        for name, n in snapshot["counters"].items():
+            counters[name] = counters.get(name, 0) + n
+    logger.info(" ".join(f"{name}={n}" for name, n in sorted(counters.items())))
+
+    # Merge whatever the shards wrote, even if some failed, so nothing is lost
+    _, columns = FORMATS[format]
+    paths = [config["output"] for config in configs]
+    paths = [path for path in paths if output_files(path)]
+    merge_outputs(paths, output, columns, chunk_size)
+    for path in paths:
+        for file in output_files(path):
+            os.remove(file)
+
+    if failed:
+        raise RuntimeError(f"Shards {failed} exited with errors")
 
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Scrape PGCRs from the Bungie API")
+    parser.add_argument(
+        "--mode",
+        choices=["sequential", "threaded", "async", "sharded", "reextract"],
+        default="threaded",
+        help="How to fan out requests; reextract rebuilds output from --cache "
+        "without any requests",
+    )
+    parser.add_argument(
+        "--engine",
+        choices=["threaded", "async"],
+        default="threaded",
+        help="What each shard process runs (sharded mode only)",
+    )
+    parser.add_argument(
+        "--processes-per-key",
+        type=int,
+        default=1,
+        help="Shard processes per API key, splitting its rate (sharded mode only)",
+    )
+    parser.add_argument(
+        "--filter",
+        action="append",
+        default=None,
+        help="Only keep activities with this name (repeatable)",
+    )
+    parser.add_argument(
+        "--activity-mode",
+        type=int,
+        action="append",
+        default=None,
+        help="Only keep activities of this DestinyActivityModeType, e.g. 63 "
+        "for Gambit (repeatable)",
+    )
+    parser.add_argument(
+        "--period-start",
+        default=None,
+        help="Only keep activities played at or after this time (ISO, UTC)",
+    )
+    parser.add_argument(
+        "--period-end",
+        default=None,
+        help="Only keep activities played before this time (ISO, UTC)",
+    )
+    parser.add_argument(
+        "--min-players",
+        type=int,
+        default=None,
+        help="Only keep activities with at least this many players",
+    )
+    parser.add_argument(
+        "--max-concurrency",
+        type=int,
+        default=MAX_CONCURRENCY,
+        help="Requests in flight at once (async mode only)",
+    )
+    parser.add_argument(
+        "--rate",
+        type=float,
+        default=N_REQUESTS_PER_SECOND,
+        help="Sustained requests per second allowed by our API quota",
+    )
+    parser.add_argument(
+        "--burst",
+        type=int,
+        default=BURST_SIZE,
+        help="Requests that may go out back-to-back after an idle period",
+    )
+    parser.add_argument(
+        "--output",
+        default=OUTPUT_PATH,
+        help="Where to write rows; .csv is appended to, .parquet is columnar",
+    )
+    parser.add_argument(
+        "--chunk-size",
+        type=int,
+        default=CHUNK_SIZE,
+        help="Rows buffered in memory before being written out",
+    )
+    parser.add_argument(
+        "--checkpoint",
+        default=None,
+        help="Record progress here (.npy) and resume from it if it exists",
+    )
+    parser.add_argument(
+        "--cache",
+        default=None,
+        help="Directory of raw PGCRs to read before fetching and to save "
+        "fetched PGCRs to",
+    )
+    parser.add_argument(
+        "--newest-first",
+        action="store_true",
+        help="Crawl from the end of the range back, most recent activities first",
+    )
+    parser.add_argument(
+        "--deadline",
+        type=float,
+        default=None,
+        help="Stop cleanly after this many minutes, keeping what's been fetched "
+        "(threaded mode)",
+    )
+    parser.add_argument(
+        "--max-requests",
+        type=int,
+        default=None,
+        help="Stop cleanly after this many PGCR requests (threaded mode)",
+    )
+    parser.add_argument(
+        "--max-attempts",
+        type=int,
+        default=MAX_ATTEMPTS,
+        help="Tries per PGCR before giving up on it; 1 to never retry",
+    )
+    parser.add_argument(
+        "--retry-budget",
+        type=float,
+        default=RETRY_BUDGET,
+        help="Retries allowed per ID tried, across the crawl",
+    )
+    parser.add_argument(
+        "--hedge-after",
+        type=float,
+        default=None,
+        help="Send a second request for a PGCR that hasn't answered after this "
+        "many seconds (off by default)",
+    )
+    parser.add_argument(
+        "--hedge-budget",
+        type=float,
+        default=HEDGE_BUDGET,
+        help="Hedged requests allowed per request, for --hedge-after",
+    )
+    parser.add_argument(
+        "--features",
+        default=None,
+        help="Keep per-character rolling features here (.npz), adding to it if "
+        "it exists. Activities are added each time they're extracted, so use "
+        "with --checkpoint when resuming",
+    )
+    parser.add_argument(
+        "--features-interval",
+        type=float,
+        default=SNAPSHOT_INTERVAL,
+        help="Seconds between snapshots of --features during the crawl",
+    )
+    parser.add_argument(
+        "--format",
+        choices=list(FORMATS),
+        default="wide",
+        help="wide: one row per activity; long: one row per player per activity",
+    )
+    parser.add_argument(
+        "--max-players",
+        type=int,
+        default=MAX_PLAYERS,
+        help="Players per wide row; later entries are dropped (wide format only)",
+    )
+    parser.add_argument(
+        "--api-url",
+        default=API_URL,
+        help="Platform API root, e.g. a mock_server.py for testing",
+    )
+    parser.add_argument(
+        "--pool-size",
+        type=int,
+        default=POOL_SIZE,
+        help="Keep-alive connections to hold open (threaded/sequential modes)",
+    )
+    parser.add_argument(
+        "--start-time",
+        default=None,
+        help="Crawl activities from this time on (ISO, UTC), found by probing",
+    )
+    parser.add_argument(
+        "--end-time",
+        default=None,
+        help="Crawl activities before this time (ISO, UTC), found by probing",
+    )
+    parser.add_argument(
+        "--id-index",
+        default="id_index.sqlite",
+        help="Where to cache probed (ID, period) pairs for --start/end-time",
+    )
+    parser.add_argument(
+        "--metrics",
+        choices=["off", "log", "json", "http"],
+        default="log",
+        help="Where to report crawl metrics",
+    )
+    parser.add_argument(
+        "--metrics-file", default="metrics.json", help="For --metrics json"
+    )
+    parser.add_argument(
+        "--metrics-port", type=int, default=9100, help="For --metrics http"
+    )
+    parser.add_argument(
+        "--metrics-interval", type=float, default=10, help="Seconds between reports"
+    )
+    args = parser.parse_args()
+
+    API_URL = args.api_url
+    RATE_LIMITER = TokenBucket(rate=args.rate, burst=args.burst)
+    CLIENT = Client(HEADERS, pool_size=args.pool_size)
+    set_max_players(args.max_players)
+    if args.start_time is not None or args.end_time is not None:
+        id_index = IDIndex(args.id_index, probe_period, anchor=STARTING_ACTIVITY_ID)
+        if args.start_time is not None:
+            STARTING_ACTIVITY_ID = id_index.lookup(args.start_time)
+        if args.end_time is not None:
+            ENDING_ACTIVITY_ID = id_index.lookup(args.end_time)
+        id_index.close()
+        print(
+            f"Crawling IDs {STARTING_ACTIVITY_ID} to {ENDING_ACTIVITY_ID} "
+            f"({id_index.n_probes} probes)"
+        )
+
+    # Sharded crawls keep one checkpoint per shard instead
+    if args.checkpoint is not None and args.mode != "sharded":
+        CHECKPOINT = Checkpoint(
+            args.checkpoint, STARTING_ACTIVITY_ID, ENDING_ACTIVITY_ID
+        )
+
+    filter = make_filter(
+        names=args.filter,
+        modes=args.activity_mode,
+        period_start=args.period_start,
+        period_end=args.period_end,
+        min_players=args.min_players,
+    )
+
+    if args.cache is not None:
+        CACHE = PGCRCache(args.cache)
+    elif args.mode == "reextract":
+        parser.error("--mode reextract needs --cache")
+
+    if args.mode != "threaded" and (
+        args.deadline is not None or args.max_requests is not None
+    ):
+        parser.error("--deadline and --max-requests need --mode threaded")
+    if args.newest_first and args.mode == "sharded":
+        parser.error("--newest-first doesn't work with --mode sharded")
+    NEWEST_FIRST = args.newest_first
+
+    # Set up after probing for --start/end-time, whose failures aren't retried
+    retries = None
+    if args.max_attempts > 1:
+        retries = {"max_attempts": args.max_attempts, "budget": args.retry_budget}
+        RETRIES = RetryQueue(**retries)
+    hedge = None
+    if args.hedge_after is not None:
+        hedge = {"after": args.hedge_after, "budget": args.hedge_budget}
+        HEDGER = Hedger(limiter=RATE_LIMITER, **hedge)
+        HEDGE_CLIENT = Client(HEADERS)
+
+    if args.features is not None:
+        # Shards are separate processes, with nowhere to share one store
+        if args.mode == "sharded":
+            parser.error("--features doesn't work with --mode sharded")
+        if os.path.exists(snapshot_path(args.features)):
+            FEATURES = FeatureStore.restore(args.features)
+        else:
+            FEATURES = FeatureStore()
+        FEATURES.start_snapshots(args.features, args.features_interval)
+
     # TODO: crawl over characters and collect relevant data
     character_data = {
         "membershipType": "3",
@@ -352,16 +1257,83 @@ if __name__ == "__main__":
     params = {"count": 10}
     history = get_activity_history(character_data, params=params)
 
+    reporter = None
+    if args.metrics == "log":
+        reporter = LogReporter(interval=args.metrics_interval)
+    elif args.metrics == "json":
+        reporter = JSONReporter(args.metrics_file, interval=args.metrics_interval)
+    elif args.metrics == "http":
+        reporter = HTTPReporter(args.metrics_port)
+    if reporter is not None:
+        reporter.start()
+
     # Add rudimentary timing...
     start_time = time.time()
     start_perf_ctr = time.perf_counter()
 
-    # scrape_pgcrs()
-    # scrape_pgcrs_multithreaded(filter="Gambit")
-    # scrape_pgcrs_multithreaded(filter="Control")
-    scrape_pgcrs_multithreaded()
+    # e.g. --mode threaded --filter Gambit
+    output = {
+        "output": args.output,
+        "chunk_size": args.chunk_size,
+        "format": args.format,
+    }
+    if args.mode == "sequential":
+        scrape_pgcrs(filter=filter, **output)
+    elif args.mode == "threaded":
+        scrape_pgcrs_multithreaded(
+            filter=filter,
+            deadline=args.deadline * 60 if args.deadline is not None else None,
+            max_requests=args.max_requests,
+            **output,
+        )
+    elif args.mode == "sharded":
+        scrape_pgcrs_sharded(
+            get_api_keys(),
+            processes_per_key=args.processes_per_key,
+            engine=args.engine,
+            filter=filter,
+            rate=args.rate,
+            burst=args.burst,
+            checkpoint=args.checkpoint,
+            cache=args.cache,
+            retries=retries,
+            hedge=hedge,
+            max_concurrency=args.max_concurrency,
+            pool_size=args.pool_size,
+            **output,
+        )
+    elif args.mode == "reextract":
+        reextract_pgcrs(filter=filter, **output)
+    else:
+        scrape_pgcrs_async(
+            filter=filter, max_concurrency=args.max_concurrency, **output
+        )
 
     time_elapsed = time.time() - start_time
     perf_ctr_elapsed = time.perf_counter() - start_perf_ctr
     print(f"time: {time_elapsed}")
     print(f"perf time: {perf_ctr_elapsed}")
+
+    if reporter is not None:
+        reporter.stop()
+
+    if CHECKPOINT is not None:
+        CHECKPOINT.flush()
+        print(f"checkpoint: {CHECKPOINT.summary()}")
+
+    if RETRIES is not None and args.mode != "sharded":
+        print(f"retries: {RETRIES.summary()}")
+
+    players_dropped = METRICS.snapshot()["counters"].get("wide.players_dropped")
+    if players_dropped:
+        print(f"dropped {players_dropped} players past --max-players {MAX_PLAYERS}")
+
+    if HEDGER is not None:
+        HEDGER.close()
+
+    if CACHE is not None:
+        CACHE.close()
+
+    if FEATURES is not None:
+        FEATURES.stop_snapshots(args.features)
+        print(f"features: {len(FEATURES)} characters")
@@ -0,0 +1,311 @@
+"""
+feature_store.py
+author: garrick
+
+Per-character features kept up to date as PGCRs come in, so training and
+recommendation code can read them without recomputing anything. For every
+character it keeps:
+
+- rolling means of each stat over their last WINDOW activities, from a ring
+  buffer and running sums
+- exponentially decayed means of each stat, with a half-life in days of
+  play time, so recent form counts for more
+- a decayed activity mix: the share of their recent activities that were each
+  of the first MAX_ACTIVITIES activity names seen (the rest share one slot)
+
+A stat an activity doesn't report (e.g. standing in most PvE) is skipped for
+that activity rather than counted as 0: every mean keeps its own count or
+weight per stat, and is NaN until the character has a value for it.
+
+Each update costs the same no matter how much history a character has. State
+is a handful of numpy arrays with a row per character, which grow as needed
+and can be snapshotted to disk (periodically, with start_snapshots) and
+restored.
+"""
+import array
+import json
+import logging
+import os
+import threading
+
+import numpy as np
+import pandas as pd
+
+from id_index import parse_period
+
+logger = logging.getLogger(__name__)
+
+
+# Stats tracked per character, as named by data_collection.PLAYER_STATS.
+# standing is 1 for a win, so its means are win rates.
+STATS = ["kills", "deaths", "assists", "kdr", "efficiency", "score", "standing"]
+# Activities in each character's rolling window
+WINDOW = 10
+# Days for a decayed stat's weight to halve
+HALF_LIFE = 14
+# Activity names tracked separately in the activity mix
+MAX_ACTIVITIES = 31
+OTHER_ACTIVITY = "(other)"
+# Rows to allocate at first; doubles when full
+INITIAL_CAPACITY = 1 << 12
+# Seconds between snapshots with start_snapshots
+SNAPSHOT_INTERVAL = 300
+# Per-character arrays, one row each; see FeatureStore._allocate
+ARRAYS = [
+    "ring",
+    "ring_present",
+    "ring_sums",
+    "ring_counts",
+    "n_seen",
+    "decayed_sums",
+    "decayed_weight",
+    "activity_weight",
+    "last_day",
+    "mix",
+]
+# Bumped when ARRAYS change, so old snapshots aren't misread
+SNAPSHOT_VERSION = 2
+SECONDS_PER_DAY = 86400
+
+
+def snapshot_path(path):
+    """path with the .npz suffix np.savez would add anyway, so what's saved
+    is found again.
+    """
+    return path if path.endswith(".npz") else path + ".npz"
+
+
+class FeatureStore:
+    """
+    Args:
+      window (int): Activities in each rolling window.
+      half_life (float): Days for decayed weights to halve.
+      max_activities (int): Activity names tracked in the activity mix.
+    """
+
+    def __init__(
+        self, window=WINDOW, half_life=HALF_LIFE, max_activities=MAX_ACTIVITIES
+    ):
+        self.window = window
+        self.half_life = half_life
+        self.decay = np.log(2) / half_life
+        self.max_activities = max_activities
+        self.lock = threading.Lock()
+
+        self.rows = {}
+        self.char_ids = array.array("q")
+        self.activities = {OTHER_ACTIVITY: 0}
+
+        self.capacity = 0
+        self._allocate(INITIAL_CAPACITY)
+
+        self.snapshot_stopped = threading.Event()
+        self.snapshot_thread = None
+
+    def __len__(self):
+        return len(self.char_ids)
+
+    def _allocate(self, capacity):
+        """Grow every per-character array to capacity rows."""
+        n_stats = len(STATS)
+        shapes = {
+            # Last window values of each stat, written round-robin, and
+            # which of them the activity actually reported
+            "ring": ((self.window, n_stats), np.float32),
+            "ring_present": ((self.window, n_stats), np.bool_),
+            "ring_sums": ((n_stats,), np.float64),
+            "ring_counts": ((n_stats,), np.int64),
+            # Activities seen; also where the next ring write goes
+            "n_seen": ((), np.int64),
+            "decayed_sums": ((n_stats,), np.float64),
+            # Decayed weight of the activities that reported each stat, and
+            # of all activities (for the mix)
+            "decayed_weight": ((n_stats,), np.float64),
+            "activity_weight": ((), np.float64),
+            # Time the decayed sums were last brought up to date
+            "last_day": ((), np.float64),
+            "mix": ((self.max_activities + 1,), np.float64),
+        }
+        for name, (shape, dtype) in shapes.items():
+            grown = np.zeros((capacity, *shape), dtype=dtype)
+            if self.capacity:
+                grown[: self.capacity] = getattr(self, name)
+            setattr(self, name, grown)
+        self.capacity = capacity
+
+    def _row(self, char_id):
+        row = self.rows.get(char_id)
+        if row is None:
+            row = self.rows[char_id] = len(self.char_ids)
+            self.char_ids.append(char_id)
+            if row >= self.capacity:
+                self._allocate(2 * self.capacity)
+        return row
+
+    def _activity(self, name):
+        slot = self.activities.get(name)
+        if slot is None:
+            if len(self.activities) > self.max_activities:
+                return 0
+            slot = self.activities[name] = len(self.activities)
+        return slot
+
+    def update(self, activity):
+        """Fold in one activity, as returned by data_collection.parse_pgcr.
+        Safe to call from many threads.
+        """
+        day = parse_period(activity["period"]) / SECONDS_PER_DAY
+        players = activity["players"]
+        values = np.array(
+            [
+                [np.nan if player.get(stat) is None else player[stat] for stat in STATS]
+                for player in players
+            ],
+            dtype=np.float64,
+        )
+        # Missing stats are stored as 0 but left out of every count and
+        # weight, so they don't drag means toward 0
+        present = ~np.isnan(values)
+        values = np.where(present, values, 0.0)
+
+        with self.lock:
+            slot = self._activity(activity["director_activity_name"])
+            for player, x, p in zip(players, values, present):
+                self._update(self._row(int(player["char_id"])), x, p, slot, day)
+
+    def _update(self, row, x, present, slot, day):
+        # Rolling: swap the oldest value in the ring for this one
+        # (differencing the stored float32s, so the sums don't drift)
+        i = self.n_seen[row] % self.window
+        old = self.ring[row, i].copy()
+        self.ring[row, i] = x
+        self.ring_sums[row] += self.ring[row, i] - old
+        self.ring_counts[row] += present.astype(np.int64) - self.ring_present[row, i]
+        self.ring_present[row, i] = present
+        self.n_seen[row] += 1
+
+        # Decayed: bring the sums up to this activity's time, then add it.
+        # Activities can arrive out of order; an older one is discounted
+        # instead.
+        last = self.last_day[row]
+        seen = self.activity_weight[row] > 0
+        if not seen or day >= last:
+            factor = np.exp(-self.decay * (day - last)) if seen else 0.0
+            self.decayed_sums[row] *= factor
+            self.decayed_weight[row] *= factor
+            self.activity_weight[row] *= factor
+            self.mix[row] *= factor
+            self.last_day[row] = day
+            weight = 1.0
+        else:
+            weight = np.exp(-self.decay * (last - day))
+        self.decayed_sums[row] += weight * x
+        self.decayed_weight[row] += weight * present
+        self.activity_weight[row] += weight
+        self.mix[row, slot] += weight
+
+    def frame(self, char_ids=None):
+        """Current features as a DataFrame indexed by char_id, for every
+        character or just char_ids. Decayed features are as of each
+        character's latest activity. A stat a character has no values for is
+        NaN.
+        """
+        with self.lock:
+            if char_ids is None:
+                rows = np.arange(len(self.char_ids))
+                index = np.asarray(self.char_ids)
+            else:
+                rows = np.array([self.rows[c] for c in char_ids], dtype=np.int64)
+                index = np.asarray(char_ids, dtype=np.int64)
+
+            counts = self.ring_counts[rows]
+            rolling = np.where(
+                counts > 0, self.ring_sums[rows] / np.maximum(counts, 1), np.nan
+            )
+            weight = self.decayed_weight[rows]
+            decayed = np.where(
+                weight > 0,
+                self.decayed_sums[rows] / np.where(weight > 0, weight, 1),
+                np.nan,
+            )
+            activity_weight = self.activity_weight[rows][:, None]
+            mix = self.mix[rows] / np.where(activity_weight > 0, activity_weight, 1)
+            n_seen = self.n_seen[rows].copy()
+            names = sorted(self.activities, key=self.activities.get)
+
+        columns = {"n_activities": n_seen}
+        for j, stat in enumerate(STATS):
+            columns[f"{stat}_last{self.window}"] = rolling[:, j]
+        for j, stat in enumerate(STATS):
+            columns[f"{stat}_decayed"] = decayed[:, j]
+        for slot, name in enumerate(names):
+            columns[f"mix_{name}"] = mix[:, slot]
+        return pd.DataFrame(columns, index=pd.Index(index, name="char_id"))
+
+    def features(self, char_id):
+        """Current features of one character, as a dict."""
+        return self.frame([char_id]).iloc[0].to_dict()
+
+    def snapshot(self, path):
+        """Save everything to path (.npz added if missing), consistently even
+        while updates are coming in. Written to a temporary file first, so a
+        crash mid-snapshot leaves the last one intact.
+        """
+        path = snapshot_path(path)
+        with self.lock:
+            n = len(self.char_ids)
+            arrays = {name: getattr(self, name)[:n].copy() for name in ARRAYS}
+            char_ids = np.asarray(self.char_ids).copy()
+            meta = {
+                "version": SNAPSHOT_VERSION,
+                "window": self.window,
+                "half_life": self.half_life,
+                "max_activities": self.max_activities,
+                "activities": self.activities,
+            }
+        tmp_path = path + ".tmp.npz"
+        np.savez(tmp_path, char_ids=char_ids, meta=json.dumps(meta), **arrays)
+        os.replace(tmp_path, path)
+
+    def start_snapshots(self, path, interval=SNAPSHOT_INTERVAL):
+        """Snapshot to path every interval seconds on a background thread, so
+        a crash loses at most that much, until stop_snapshots.
+        """
+
+        def run():
+            while not self.snapshot_stopped.wait(interval):
+                self.snapshot(path)
+
+        self.snapshot_thread = threading.Thread(target=run, daemon=True)
+        self.snapshot_thread.start()
+
+    def stop_snapshots(self, path):
+        """Stop periodic snapshots and take a last one."""
+        self.snapshot_stopped.set()
+        if self.snapshot_thread is not None:
+            self.snapshot_thread.join()
+        self.snapshot(path)
+
+    @classmethod
+    def restore(cls, path):
+        path = snapshot_path(path)
+        with np.load(path) as f:
+            meta = json.loads(str(f["meta"]))
+            if meta.get("version") != SNAPSHOT_VERSION:
+                raise ValueError(
+                    f"{path} is from an older FeatureStore; delete it to start over"
+                )
+            store = cls(meta["window"], meta["half_life"], meta["max_activities"])
+            store.activities = meta["activities"]
+
+            char_ids = f["char_ids"]
+            store.char_ids = array.array("q", char_ids.tobytes())
+            store.rows = {c: i for i, c in enumerate(store.char_ids)}
+            capacity = INITIAL_CAPACITY
+            while capacity < len(char_ids):
+                capacity *= 2
+            store._allocate(capacity)
+            for name in ARRAYS:
+                getattr(store, name)[: len(char_ids)] = f[name]
+        logger.info(f"Restored features for {len(char_ids)} characters")
+        return store
@@ -0,0 +1,117 @@
+"""
+filters.py
+author: garrick
+
+Activity filters checked as early as possible, so PGCRs we don't want cost
+next to nothing. Everything is in terms of manifest hashes and mode numbers,
+so no names are localized per PGCR. Checks happen in two stages:
+
+1. accepts_raw: on the undecoded response body, by pulling the
+   directorActivityHash and period out with a regex. Most rejections happen
+   here, before any JSON is decoded.
+2. accepts: on the decoded PGCR's activityDetails, for modes and player
+   counts, before any per-entry work.
+"""
+import datetime
+import re
+
+from id_index import PERIOD_FORMAT, parse_time
+
+# activityDetails comes before entries in a PGCR, and entries don't have
+# these keys, so the first match is the activity's
+DIRECTOR_HASH_RE = re.compile(rb'"directorActivityHash"\s*:\s*(\d+)')
+PERIOD_RE = re.compile(rb'"period"\s*:\s*"([^"]+)"')
+
+
+def to_period(time):
+    """Format a time the way PGCRs do, so periods compare as plain strings."""
+    dt = datetime.datetime.fromtimestamp(parse_time(time), datetime.timezone.utc)
+    return dt.strftime(PERIOD_FORMAT)
+
+
+class ActivityFilter:
+    """Which PGCRs to keep. Every condition given must hold.
+
+    Args:
+      activity_hashes (iterable): directorActivityHashes to keep.
+      modes (iterable): DestinyActivityModeType numbers; keep the activity if
+        its mode or any of its modes is one of these.
+      period_start: Keep activities at or after this time.
+      period_end: Keep activities before this time.
+      min_players (int): Keep activities with at least this many entries.
+    """
+
+    def __init__(
+        self,
+        activity_hashes=None,
+        modes=None,
+        period_start=None,
+        period_end=None,
+        min_players=None,
+    ):
+        self.activity_hashes = (
+            frozenset(int(h) for h in activity_hashes)
+            if activity_hashes is not None
+            else None
+        )
+        self.modes = frozenset(modes) if modes is not None else None
+        self.period_start = (
+            to_period(period_start) if period_start is not None else None
+        )
+        self.period_end = to_period(period_end) if period_end is not None else None
+        self.min_players = min_players
+
+    def _period_ok(self, period):
+        if self.period_start is not None and period < self.period_start:
+            return False
+        if self.period_end is not None and period >= self.period_end:
+            return False
+        return True
+
+    def accepts_raw(self, content):
+        """Check the raw response body. Returns False only if the PGCR is
+        definitely rejected; anything we can't tell here (including error
+        responses) passes through to accepts.
+
+        Args:
+          content (bytes): Undecoded JSON body.
+        """
+        if self.activity_hashes is not None:
+            match = DIRECTOR_HASH_RE.search(content)
+            if match is not None and int(match.group(1)) not in self.activity_hashes:
+                return False
+
+        if self.period_start is not None or self.period_end is not None:
+            match = PERIOD_RE.search(content)
+            if match is not None and not self._period_ok(match.group(1).decode()):
+                return False
+
+        return True
+
+    def accepts(self, pgcr):
+        """Check a decoded PGCR, looking only at activity-level fields.
+
+        Args:
+          pgcr (dict): The "Response" object of the PGCR JSON.
+        """
+        details = pgcr["activityDetails"]
+
+        if (
+            self.activity_hashes is not None
+            and details["directorActivityHash"] not in self.activity_hashes
+        ):
+            return False
+
+        if self.modes is not None:
+            modes = set(details.get("modes", []))
+            modes.add(details.get("mode"))
+            if self.modes.isdisjoint(modes):
+                return False
+
+        if not self._period_ok(pgcr["period"]):
+            return False
+
+        if self.min_players is not None and len(pgcr["entries"]) < self.min_players:
+            return False
+
+        return True
@@ -0,0 +1,216 @@
+"""
+id_index.py
+author: garrick
+
+Find instance IDs by time. Instance IDs increase roughly with the time an
+activity was played, so the first ID at or after some time can be found with
+a handful of PGCR probes: bracket the time, then alternate interpolation and
+bisection steps until the bracket closes. Every probe is saved to a small
+SQLite file, so later lookups start from everything we've already seen and
+often need no requests at all.
+"""
+import datetime
+import logging
+import sqlite3
+
+logger = logging.getLogger(__name__)
+
+
+# Where to start looking if the index is empty
+ANCHOR_ID = 8400554258
+# First step when expanding a bracket outward; doubles each time
+INITIAL_STEP = 10000
+# Consecutive missing IDs to skip before giving up on a spot
+MAX_GAP = 25
+# Tries per probe that can't tell whether an ID has a PGCR
+PROBE_ATTEMPTS = 3
+PERIOD_FORMAT = "%Y-%m-%dT%H:%M:%SZ"
+
+
+class ProbeError(Exception):
+    """A probe couldn't tell whether an ID has a PGCR (timed out, throttled,
+    server error, ...), as opposed to finding there isn't one.
+    """
+
+
+def parse_period(period):
+    """PGCR period string to a UTC unix timestamp."""
+    dt = datetime.datetime.strptime(period, PERIOD_FORMAT)
+    return int(dt.replace(tzinfo=datetime.timezone.utc).timestamp())
+
+
+def parse_time(value):
+    """ISO date or datetime (assumed UTC if no zone given) to a unix timestamp."""
+    if isinstance(value, (int, float)):
+        return int(value)
+    if isinstance(value, str):
+        value = datetime.datetime.fromisoformat(value.replace("Z", "+00:00"))
+    if value.tzinfo is None:
+        value = value.replace(tzinfo=datetime.timezone.utc)
+    return int(value.timestamp())
+
+
+class IDIndex:
+    """Persistent map of probed (instance ID, period) pairs.
+
+    Args:
+      path (str): SQLite file to keep probes in. Created if needed.
+      probe (callable): Takes an instance ID and returns its PGCR's period
+        string, or None if there's no PGCR for that ID. Raises ProbeError if
+        it couldn't tell.
+      anchor (int): ID to start from when the index is empty.
+    """
+
+    def __init__(self, path, probe, anchor=ANCHOR_ID):
+        self.db = sqlite3.connect(path)
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS probes "
+            "(instance_id INTEGER PRIMARY KEY, period INTEGER);"
+        )
+        self.probe = probe
+        self.anchor = anchor
+        # Requests made, for reporting
+        self.n_probes = 0
+
+    def _period(self, instance_id):
+        """Period of one ID (None if missing), from the index or a probe."""
+        row = self.db.execute(
+            "SELECT period FROM probes WHERE instance_id = ?;", (instance_id,)
+        ).fetchone()
+        if row is not None:
+            return row[0]
+
+        for attempt in range(PROBE_ATTEMPTS):
+            self.n_probes += 1
+            try:
+                period = self.probe(instance_id)
+                break
+            except ProbeError as e:
+                logger.warning(f"Probe of {instance_id} failed: {e}")
+        else:
+            # Not remembered: a guess here would skew every later lookup
+            raise ProbeError(
+                f"Couldn't tell whether {instance_id} has a PGCR after "
+                f"{PROBE_ATTEMPTS} tries"
+            )
+        if period is not None:
+            period = parse_period(period)
+
+        # Remember misses too, so we never ask twice. Only real misses get
+        # here; failed probes raise above.
+        self.db.execute(
+            "INSERT OR REPLACE INTO probes VALUES (?, ?);", (instance_id, period)
+        )
+        self.db.commit()
+        return period
+
+    def _find(self, instance_id, limit=None):
+        """First (id, period) with a PGCR at or after instance_id, skipping at
+        most MAX_GAP missing IDs and never reaching limit. None if not found.
+        """
+        end = instance_id + MAX_GAP
+        if limit is not None:
+            end = min(end, limit)
+
+        for i in range(instance_id, end):
+            period = self._period(i)
+            if period is not None:
+                return i, period
+        return None
+
+    def _known(self, query, args):
+        return self.db.execute(query, args).fetchone()
+
+    def _bracket(self, t):
+        """Return (lo, hi) probes with lo's period < t <= hi's period."""
+        lo = self._known(
+            "SELECT instance_id, period FROM probes WHERE period < ? "
+            "ORDER BY instance_id DESC LIMIT 1;",
+            (t,),
+        )
+        hi = None
+        if lo is not None:
+            hi = self._known(
+                "SELECT instance_id, period FROM probes WHERE period >= ? "
+                "AND instance_id > ? ORDER BY instance_id LIMIT 1;",
+                (t, lo[0]),
+            )
+        else:
+            hi = self._known(
+                "SELECT instance_id, period FROM probes WHERE period >= ? "
+                "ORDER BY instance_id LIMIT 1;",
+                (t,),
+            )
+
+        if lo is None and hi is None:
+            start = self._find(self.anchor)
+            if start is None:
+                raise RuntimeError(f"No PGCRs found near anchor {self.anchor}")
+            if start[1] < t:
+                lo = start
+            else:
+                hi = start
+
+        # Walk outward, doubling the step, until we've got both ends
+        step = INITIAL_STEP
+        while hi is None:
+            probe = self._find(lo[0] + step)
+            if probe is None:
+                # Past the newest activity, or a big gap; the end is no later
+                return lo, (lo[0] + step, t)
+            if probe[1] < t:
+                lo = probe
+            else:
+                hi = probe
+            step *= 2
+
+        while lo is None:
+            probe = self._find(max(0, hi[0] - step), limit=hi[0])
+            if probe is None or probe[1] < t:
+                lo = probe if probe is not None else (hi[0] - step, t - 1)
+            else:
+                hi = probe
+            step *= 2
+
+        return lo, hi
+
+    def lookup(self, time, tolerance=0):
+        """First instance ID of an activity played at or after time.
+
+        Args:
+          time: Unix timestamp, datetime, or ISO string (UTC if no zone).
+          tolerance (int): Stop once the answer is known to within this many
+            IDs. Crawls starting a few IDs early cost a few requests; probing
+            for the exact ID can cost more.
+        """
+        t = parse_time(time)
+        lo, hi = self._bracket(t)
+
+        bisect = False
+        while hi[0] - lo[0] > tolerance + 1:
+            if bisect or hi[1] == lo[1]:
+                guess = (lo[0] + hi[0]) // 2
+            else:
+                # Assume IDs are handed out at a steady rate between lo and hi
+                fraction = (t - lo[1]) / (hi[1] - lo[1])
+                guess = lo[0] + int(fraction * (hi[0] - lo[0]))
+            guess = min(max(guess, lo[0] + 1), hi[0] - 1)
+            # Interpolation converges fast on smooth stretches; bisecting every
+            # other step bounds the worst case
+            bisect = not bisect
+
+            probe = self._find(guess, limit=hi[0])
+            if probe is None:
+                # Nothing between guess and hi, so the answer is before guess
+                # (or hi itself)
+                hi = (guess, hi[1])
+            elif probe[1] < t:
+                lo = probe
+            else:
+                hi = probe
+
+        logger.info(f"Found ID {hi[0]} for {time} ({self.n_probes} probes so far)")
+        return hi[0]
+
+    def close(self):
+        self.db.close()
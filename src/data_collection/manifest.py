@@ -1,47 +1,46 @@
 # Fetch and save manifest for reference localization.
 # Some code adapted from http://destinydevs.github.io/BungieNetPlatform/docs/Manifest
+# Definitions are looked up straight from the downloaded database; see
+# manifest_store.py.
+import argparse
+import hashlib
 import json
 import os
-import sqlite3
 import zipfile
-from os.path import dirname, join, normpath, realpath
+from os.path import dirname, exists, join, normpath, realpath, splitext
 from urllib.parse import urljoin
-import pickle
 
-import requests
-from dotenv import load_dotenv
+from client import Client, get_headers
 
-
-def get_headers():
-    """Get X-API-Key and place in header for all requests"""
-    dotenv_path = os.path.normpath(
-        os.path.join(os.path.dirname(os.path.realpath(__file__)), "../..", ".env")
-    )
-    load_dotenv(dotenv_path)
-
-    api_key = os.environ["BUNGIE_NET_API_KEY"]
-    headers = {"X-API-Key": api_key}
-    return headers
-
-
-HEADERS = get_headers()
+CLIENT = Client(get_headers())
 API_URL = "https://www.bungie.net/platform/"
 CONTENT_URL = "http://www.bungie.net"
 GET_MANIFEST = "Destiny2/Manifest/"
 DATA_DIR = normpath(join(dirname(realpath(__file__)), "../data"))
+CONTENT_PATH = join(DATA_DIR, "Manifest.content")
+# Version and content path of the manifest we last downloaded. Only written
+# once Manifest.content is complete, so an interrupted download is redone.
+VERSION_PATH = join(DATA_DIR, "manifest_version.json")
 
 
-def get_manifest():
-
+def get_manifest(force=False):
+    """Download and extract the manifest database, unless the version we
+    already have is current. Returns True if a new manifest was downloaded.
+    """
     path = urljoin(API_URL, GET_MANIFEST)
-    r = requests.get(path, headers=HEADERS)
-    manifest = r.json()
+    r = CLIENT.get(path)
+    manifest = r.json()["Response"]
 
     # mobileWorldContentPaths holds static definitions of objects in Destiny
-    mani_url = urljoin(
-        CONTENT_URL, manifest["Response"]["mobileWorldContentPaths"]["en"]
-    )
-    r = requests.get(mani_url)
+    content_path = manifest["mobileWorldContentPaths"]["en"]
+    version = {"version": manifest["version"], "path": content_path}
+
+    if not force and exists(CONTENT_PATH) and load_json(VERSION_PATH) == version:
+        print(f"Manifest {version['version']} already downloaded")
+        return False
+
+    # The zipped database is tens of MB
+    r = CLIENT.get(urljoin(CONTENT_URL, content_path), timeout=120)
 
     save_path = join(DATA_DIR, "manifest.zip")
     with open(save_path, "wb") as f:
@@ -50,121 +49,52 @@ def get_manifest():
     print("Downloaded zipped manifest")
 
     # Extract contents
-    os.chdir(DATA_DIR)
     with zipfile.ZipFile(save_path) as zip:
-        name = zip.namelist()
-        zip.extractall()
+        name = zip.namelist()[0]
+        zip.extract(name, DATA_DIR)
+
+    # The database is named after its md5, e.g. world_sql_content_<md5>.content
+    extracted = join(DATA_DIR, name)
+    expected = splitext(name)[0].rsplit("_", 1)[-1]
+    if len(expected) == 32 and file_md5(extracted) != expected:
+        raise RuntimeError(f"Manifest {name} failed md5 verification")
 
-    # TODO can check name and verify it using md5sum
-    os.rename(name[0], "Manifest.content")
+    os.replace(extracted, CONTENT_PATH)
+    dump_json(version, VERSION_PATH)
 
     print("Extracted manifest")
+    return True
+
+
+def file_md5(path):
+    md5 = hashlib.md5()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            md5.update(block)
+    return md5.hexdigest()
 
 
-def get_tables(cursor):
-    cursor.execute("SELECT name FROM sqlite_master WHERE type='table';")
-    tables = cursor.fetchall()
-    tables = [t[0] for t in tables]
-    tables = sorted(tables)
-    return tables
-
-
-def build_index(tables):
-    # XXX How does it find the db file when it's in another folder?
-    os.chdir(DATA_DIR)
-    index = {}
-
-    with sqlite3.connect("Manifest.content") as db:
-        print("Connected to database")
-        cursor = db.cursor()
-
-        for table_name in tables:
-            print(f"Building index for table: {table_name}...")
-
-            cursor.execute(f"SELECT json from {table_name};")
-            items = cursor.fetchall()
-            item_jsons = [json.loads(item[0]) for item in items]
-
-            item_dict = {}
-
-            for item in item_jsons:
-                item_dict[item["hash"]] = item
-
-            index[table_name] = item_dict
-
-        cursor.close()
-
-    # TODO pickle the data
-    with open("manifest.pickle", "wb") as f:
-        pickle.dump(index, f)
-        print("Created pickle. Done!")
-
-
-# What tables to process
-tables = [
-    "DestinyAchievementDefinition",
-    "DestinyActivityDefinition",
-    "DestinyActivityGraphDefinition",
-    "DestinyActivityModeDefinition",
-    "DestinyActivityModifierDefinition",
-    "DestinyActivityTypeDefinition",
-    "DestinyArtifactDefinition",
-    "DestinyBondDefinition",
-    "DestinyBreakerTypeDefinition",
-    "DestinyChecklistDefinition",
-    "DestinyClassDefinition",
-    "DestinyCollectibleDefinition",
-    "DestinyDamageTypeDefinition",
-    "DestinyDestinationDefinition",
-    # Table went away 5/12/21
-    # "DestinyEnemyRaceDefinition",
-    "DestinyEnergyTypeDefinition",
-    "DestinyEquipmentSlotDefinition",
-    "DestinyFactionDefinition",
-    "DestinyGenderDefinition",
-    # NOTE items in this hash table DO NOT have a hash code
-    # "DestinyHistoricalStatsDefinition",
-    "DestinyInventoryBucketDefinition",
-    "DestinyInventoryItemDefinition",
-    "DestinyItemCategoryDefinition",
-    "DestinyItemTierTypeDefinition",
-    "DestinyLocationDefinition",
-    "DestinyLoreDefinition",
-    "DestinyMaterialRequirementSetDefinition",
-    "DestinyMedalTierDefinition",
-    "DestinyMetricDefinition",
-    "DestinyMilestoneDefinition",
-    "DestinyObjectiveDefinition",
-    "DestinyPlaceDefinition",
-    "DestinyPlugSetDefinition",
-    "DestinyPowerCapDefinition",
-    "DestinyPresentationNodeDefinition",
-    "DestinyProgressionDefinition",
-    "DestinyProgressionLevelRequirementDefinition",
-    "DestinyRaceDefinition",
-    "DestinyRecordDefinition",
-    "DestinyReportReasonCategoryDefinition",
-    "DestinyRewardSourceDefinition",
-    "DestinySackRewardItemListDefinition",
-    "DestinySandboxPatternDefinition",
-    "DestinySandboxPerkDefinition",
-    "DestinySeasonDefinition",
-    "DestinySeasonPassDefinition",
-    "DestinySocketCategoryDefinition",
-    "DestinySocketTypeDefinition",
-    "DestinyStatDefinition",
-    "DestinyStatGroupDefinition",
-    "DestinyTalentGridDefinition",
-    "DestinyTraitCategoryDefinition",
-    "DestinyTraitDefinition",
-    "DestinyUnlockDefinition",
-    "DestinyVendorDefinition",
-    "DestinyVendorGroupDefinition",
-]
+def load_json(path):
+    if not exists(path):
+        return None
+    with open(path) as f:
+        return json.load(f)
+
+
+def dump_json(obj, path):
+    # Replaced in one step, so it's never seen half-written
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(obj, f, indent=2)
+    os.replace(tmp_path, path)
 
 
 if __name__ == "__main__":
-    # TODO: Don't download the manifest if it already has been downloaded
+    parser = argparse.ArgumentParser(description="Download the manifest")
+    parser.add_argument(
+        "--force", action="store_true", help="Re-download even if up to date"
+    )
+    args = parser.parse_args()
+
     print(f"Data directory: {DATA_DIR}")
-    get_manifest()
-    build_index(tables)
+    get_manifest(force=args.force)
@@ -0,0 +1,97 @@
+"""
+manifest_store.py
+author: garrick
+
+Lazy lookups into the manifest. Rather than unpickling every table up front,
+definitions are read one at a time from the SQLite database that manifest.py
+downloads (Manifest.content), which is already indexed by hash. Only the pages
+holding looked-up rows are ever read, and decoded definitions are kept in an
+LRU cache, so workers only pay for what they use.
+"""
+import json
+import sqlite3
+import threading
+from functools import lru_cache
+from os.path import dirname, exists, join, normpath, realpath
+
+DATA_DIR = normpath(join(dirname(realpath(__file__)), "../data"))
+MANIFEST_PATH = join(DATA_DIR, "Manifest.content")
+
+# Decoded definitions to keep around
+CACHE_SIZE = 4096
+
+
+def to_row_id(hash):
+    """Manifest tables store each definition's hash in the id column as a
+    signed 32-bit integer.
+    """
+    return hash - (1 << 32) if hash >= (1 << 31) else hash
+
+
+class ManifestStore:
+    def __init__(self, path=MANIFEST_PATH, cache_size=CACHE_SIZE):
+        self.path = path
+
+        # sqlite3 connections can't be shared across threads, so each thread
+        # opens its own the first time it looks something up
+        self.local = threading.local()
+        self.get = lru_cache(maxsize=cache_size)(self._get)
+
+    def _connection(self):
+        db = getattr(self.local, "db", None)
+        if db is None:
+            if not exists(self.path):
+                raise FileNotFoundError(
+                    f"No manifest at {self.path}; run manifest.py to download it"
+                )
+            db = sqlite3.connect(f"file:{self.path}?mode=ro", uri=True)
+            self.local.db = db
+        return db
+
+    def _get(self, table, hash):
+        """Look up one definition by hash. Use self.get, which is cached.
+
+        Args:
+          table (str): e.g. "DestinyActivityDefinition".
+          hash (int): The (unsigned) hash of the definition.
+        """
+        # Table names can't be bound as parameters, so only allow real ones
+        if not table.isidentifier():
+            raise ValueError(f"Bad table name: {table}")
+
+        row = (
+            self._connection()
+            .execute(f"SELECT json FROM {table} WHERE id = ?;", (to_row_id(hash),))
+            .fetchone()
+        )
+        if row is None:
+            raise KeyError(f"{table} has no definition with hash {hash}")
+        return json.loads(row[0])
+
+    def hashes_named(self, table, name):
+        """Hashes of every definition in table whose display name is name.
+        Names aren't unique (e.g. each Gambit map has its own activity), so
+        this scans the table; do it once, not per lookup.
+        """
+        if not table.isidentifier():
+            raise ValueError(f"Bad table name: {table}")
+
+        hashes = set()
+        for (definition,) in self._connection().execute(f"SELECT json FROM {table};"):
+            definition = json.loads(definition)
+            if definition.get("displayProperties", {}).get("name") == name:
+                hashes.add(definition["hash"])
+        return hashes
+
+    def __getitem__(self, table):
+        # Allows INDEX-style access: store["DestinyActivityDefinition"][hash]
+        return Table(self, table)
+
+
+class Table:
+    def __init__(self, store, name):
+        self.store = store
+        self.name = name
+
+    def __getitem__(self, hash):
+        return self.store.get(self.name, hash)
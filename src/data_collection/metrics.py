@@ -0,0 +1,220 @@
+"""
+metrics.py
+author: garrick
+
+Counters and latency histograms for the crawlers, cheap enough to leave on.
+Each thread records into its own shard, so recording never takes a lock;
+shards are only merged when a reporter asks for a snapshot.
+
+Reporters periodically publish snapshots: as a log line, to a JSON file, or
+over a local HTTP endpoint (GET /metrics).
+"""
+import json
+import logging
+import os
+import threading
+from bisect import bisect_left
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+logger = logging.getLogger(__name__)
+
+
+# Histogram bucket upper bounds in seconds: 10us, 20us, 40us, ... ~84s
+BUCKETS = [1e-5 * 2 ** i for i in range(24)]
+REPORT_INTERVAL = 10
+
+
+class Histogram:
+    def __init__(self):
+        # One extra bucket for anything above the last bound
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value):
+        self.counts[bisect_left(BUCKETS, value)] += 1
+        self.count += 1
+        self.sum += value
+        if value > self.max:
+            self.max = value
+
+    def merge(self, other):
+        for i, n in enumerate(other.counts):
+            self.counts[i] += n
+        self.count += other.count
+        self.sum += other.sum
+        self.max = max(self.max, other.max)
+
+    def quantile(self, q):
+        """Upper bound of the bucket holding the q-th quantile."""
+        target = q * self.count
+        seen = 0
+        for i, n in enumerate(self.counts):
+            seen += n
+            if seen >= target and n:
+                return min(BUCKETS[i], self.max) if i < len(BUCKETS) else self.max
+        return 0.0
+
+    def summary(self):
+        return {
+            "count": self.count,
+            "mean": self.sum / self.count if self.count else 0.0,
+            "p50": self.quantile(0.5),
+            "p90": self.quantile(0.9),
+            "p99": self.quantile(0.99),
+            "max": self.max,
+        }
+
+
+class Shard:
+    def __init__(self):
+        self.counters = {}
+        self.histograms = {}
+
+
+class Metrics:
+    def __init__(self):
+        self.local = threading.local()
+        self.shards = []
+        self.lock = threading.Lock()
+
+    def _shard(self):
+        shard = getattr(self.local, "shard", None)
+        if shard is None:
+            shard = Shard()
+            self.local.shard = shard
+            with self.lock:
+                self.shards.append(shard)
+        return shard
+
+    def incr(self, name, n=1):
+        counters = self._shard().counters
+        counters[name] = counters.get(name, 0) + n
+
+    def observe(self, name, seconds):
+        histograms = self._shard().histograms
+        histogram = histograms.get(name)
+        if histogram is None:
+            histogram = histograms[name] = Histogram()
+        histogram.observe(seconds)
+
+    def snapshot(self):
+        """Merge every thread's shard. Values from a shard that's being
+        written to at the same time may be off by an update or two, which is
+        fine for monitoring.
+        """
+        counters = {}
+        histograms = {}
+        with self.lock:
+            shards = list(self.shards)
+
+        for shard in shards:
+            for name, n in list(shard.counters.items()):
+                counters[name] = counters.get(name, 0) + n
+            for name, histogram in list(shard.histograms.items()):
+                histograms.setdefault(name, Histogram()).merge(histogram)
+
+        return {
+            "counters": dict(sorted(counters.items())),
+            "histograms": {
+                name: histograms[name].summary() for name in sorted(histograms)
+            },
+        }
+
+
+# Shared by the thread pool and the scrapers unless told otherwise
+METRICS = Metrics()
+
+
+class Reporter:
+    """Publishes snapshots of metrics every interval seconds on a background
+    thread, and once more when stopped. Subclasses implement report.
+    """
+
+    def __init__(self, metrics=METRICS, interval=REPORT_INTERVAL):
+        self.metrics = metrics
+        self.interval = interval
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+
+    def _run(self):
+        while not self.stopped.wait(self.interval):
+            self.report(self.metrics.snapshot())
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+        self.report(self.metrics.snapshot())
+
+    def report(self, snapshot):
+        raise NotImplementedError
+
+
+class LogReporter(Reporter):
+    """Logs one line per interval with counters and p50/p99 latencies."""
+
+    def report(self, snapshot):
+        parts = [f"{name}={n}" for name, n in snapshot["counters"].items()]
+        for name, h in snapshot["histograms"].items():
+            parts.append(
+                f"{name}[n={h['count']} p50={1000 * h['p50']:.1f}ms "
+                f"p99={1000 * h['p99']:.1f}ms]"
+            )
+        logger.info(" ".join(parts))
+
+
+class JSONReporter(Reporter):
+    """Overwrites a JSON file with the latest snapshot."""
+
+    def __init__(self, path, metrics=METRICS, interval=REPORT_INTERVAL):
+        super().__init__(metrics, interval)
+        self.path = path
+
+    def report(self, snapshot):
+        # Write then rename, so readers never see a half-written file
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(snapshot, f, indent=2)
+        os.replace(tmp_path, self.path)
+
+
+class HTTPReporter(Reporter):
+    """Serves the current snapshot as JSON at http://localhost:<port>/metrics.
+    Snapshots are taken on request, so there's nothing to do periodically.
+    """
+
+    def __init__(self, port, metrics=METRICS):
+        super().__init__(metrics, interval=None)
+        self.port = port
+
+        reporter = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path != "/metrics":
+                    self.send_error(404)
+                    return
+                body = json.dumps(reporter.metrics.snapshot()).encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", port), Handler)
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    def stop(self):
+        self.server.shutdown()
+        self.thread.join()
+
+    def report(self, snapshot):
+        pass
@@ -0,0 +1,406 @@
+"""
+mock_server.py
+author: garrick
+
+Local stand-in for the Bungie Platform API, for testing and benchmarking the
+crawlers without touching bungie.net or our rate limit. Serves the
+PostGameCarnageReport, Activities and Manifest endpoints, either from recorded
+responses or synthetic ones, and can inject latency, throttling, timeouts and
+malformed JSON.
+
+    python mock_server.py --port 8080 --latency 0.05 --throttle-rate 0.01
+    python data_collection.py --api-url http://localhost:8080/Platform/
+
+Recorded PGCRs go in a fixtures directory as <instance_id>.json, holding the
+full response body (ErrorCode, Response, etc.).
+"""
+import argparse
+import asyncio
+import datetime
+import hashlib
+import io
+import json
+import os
+import random
+import sqlite3
+import tempfile
+import threading
+import zipfile
+from os.path import exists, join
+
+from aiohttp import web
+
+from manifest_store import to_row_id
+
+# Synthetic PGCRs rotate through these activities
+ACTIVITIES = {
+    3881495763: "Gambit",
+    2259621230: "Control",
+    1202325607: "The Shattered Throne",
+    4148187374: "Prophecy",
+}
+ACTIVITY_HASHES = list(ACTIVITIES)
+
+# PlatformErrorCodes
+SUCCESS = 1
+THROTTLED = 36  # ThrottleLimitExceededMomentarily
+PGCR_NOT_FOUND = 1653  # DestinyPGCRNotFound
+
+
+class Faults:
+    """What to inject into responses. Rates are the fraction of requests
+    affected.
+
+    Args:
+      latency (float): Mean seconds to wait before responding.
+      jitter (float): Latency varies uniformly by up to this many seconds.
+      throttle_rate (float): Respond with ThrottleSeconds set.
+      throttle_seconds (int): ThrottleSeconds to send.
+      timeout_rate (float): Hang for hang_seconds before responding.
+      hang_seconds (float): How long a "timed out" request hangs.
+      malformed_rate (float): Respond with an HTML error page.
+      missing_rate (float): Respond with DestinyPGCRNotFound.
+    """
+
+    def __init__(
+        self,
+        latency=0,
+        jitter=0,
+        throttle_rate=0,
+        throttle_seconds=1,
+        timeout_rate=0,
+        hang_seconds=5,
+        malformed_rate=0,
+        missing_rate=0,
+    ):
+        self.latency = latency
+        self.jitter = jitter
+        self.throttle_rate = throttle_rate
+        self.throttle_seconds = throttle_seconds
+        self.timeout_rate = timeout_rate
+        self.hang_seconds = hang_seconds
+        self.malformed_rate = malformed_rate
+        self.missing_rate = missing_rate
+
+
+def envelope(response=None, error_code=SUCCESS, throttle_seconds=0):
+    return {
+        "Response": response,
+        "ErrorCode": error_code,
+        "ThrottleSeconds": throttle_seconds,
+        "ErrorStatus": "Success" if error_code == SUCCESS else "Error",
+        "Message": "Ok" if error_code == SUCCESS else "Mock error",
+        "MessageData": {},
+    }
+
+
+def stat(value):
+    return {"basic": {"value": float(value), "displayValue": str(value)}}
+
+
+def synthetic_pgcr(instance_id):
+    """A plausible PGCR, generated deterministically from the instance ID."""
+    rng = random.Random(instance_id)
+    activity_hash = ACTIVITY_HASHES[instance_id % len(ACTIVITY_HASHES)]
+    duration = rng.randint(300, 1500)
+
+    entries = []
+    for i in range(rng.choice([6, 8, 12])):
+        kills, deaths, assists = (
+            rng.randint(0, 40),
+            rng.randint(1, 20),
+            rng.randint(0, 20),
+        )
+        team = i % 2
+        entries.append(
+            {
+                "standing": team,
+                "characterId": str(2305843009200000000 + rng.randint(0, 10 ** 7)),
+                "player": {
+                    "destinyUserInfo": {
+                        "membershipType": 3,
+                        "membershipId": str(
+                            4611686018400000000 + rng.randint(0, 10 ** 7)
+                        ),
+                    }
+                },
+                "values": {
+                    "kills": stat(kills),
+                    "deaths": stat(deaths),
+                    "assists": stat(assists),
+                    "killsDeathsRatio": stat(kills / deaths),
+                    "killsDeathsAssists": stat((kills + assists / 2) / deaths),
+                    "efficiency": stat((kills + assists) / deaths),
+                    "score": stat(rng.randint(0, 200)),
+                    "standing": stat(team),
+                    "teamScore": stat(rng.randint(0, 200)),
+                    "completed": stat(1),
+                    "opponentsDefeated": stat(kills + assists),
+                    "activityDurationSeconds": stat(duration),
+                    "team": stat(team),
+                },
+            }
+        )
+
+    # IDs increase with time, roughly one activity per 5ms
+    period = datetime.datetime.fromtimestamp(
+        1620000000 + instance_id // 200, datetime.timezone.utc
+    )
+    return {
+        "period": period.strftime("%Y-%m-%dT%H:%M:%SZ"),
+        "activityDetails": {
+            "referenceId": activity_hash,
+            "directorActivityHash": activity_hash,
+            "instanceId": str(instance_id),
+            "mode": 63,
+            "modes": [63, 7],
+            "isPrivate": False,
+            "membershipType": 3,
+        },
+        "entries": entries,
+        "teams": [],
+    }
+
+
+def write_manifest(path):
+    """Write a tiny Manifest.content holding DestinyActivityDefinitions for
+    the synthetic activities, so ManifestStore can localize them.
+    """
+    with sqlite3.connect(path) as db:
+        db.execute(
+            "CREATE TABLE IF NOT EXISTS DestinyActivityDefinition "
+            "(id INTEGER PRIMARY KEY, json TEXT);"
+        )
+        for hash, name in ACTIVITIES.items():
+            definition = {"hash": hash, "displayProperties": {"name": name}}
+            db.execute(
+                "INSERT OR REPLACE INTO DestinyActivityDefinition VALUES (?, ?);",
+                (to_row_id(hash), json.dumps(definition)),
+            )
+
+
+def zipped_manifest():
+    """Build the zipped manifest database the way bungie.net serves it.
+    Returns (file name, zip bytes); the database inside is named after its
+    md5, like world_sql_content_<md5>.content.
+    """
+    fd, path = tempfile.mkstemp(suffix=".content")
+    os.close(fd)
+    try:
+        write_manifest(path)
+        with open(path, "rb") as f:
+            content = f.read()
+    finally:
+        os.remove(path)
+
+    name = f"world_sql_content_{hashlib.md5(content).hexdigest()}.content"
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, "w", zipfile.ZIP_DEFLATED) as zip:
+        zip.writestr(name, content)
+    return name, buffer.getvalue()
+
+
+class MockServer:
+    """Serve the mock API on localhost, on a background thread.
+
+    The manifest's mobileWorldContentPaths are relative to the server root,
+    as on bungie.net, so point manifest.CONTENT_URL at content_url to
+    download it from here.
+
+    Args:
+      faults (Faults): What to inject.
+      fixtures (str): Directory of recorded <instance_id>.json responses.
+        IDs without a fixture get a synthetic PGCR.
+      port (int): 0 picks a free port.
+    """
+
+    def __init__(self, faults=None, fixtures=None, port=0):
+        self.faults = faults if faults is not None else Faults()
+        self.fixtures = fixtures
+        self.port = port
+        self.n_requests = 0
+        self.manifest_name, self.manifest_zip = zipped_manifest()
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.port}/Platform/"
+
+    @property
+    def content_url(self):
+        return f"http://127.0.0.1:{self.port}/"
+
+    async def _inject(self):
+        """Sleep for the configured latency, then maybe return a faulty
+        response instead of the real one.
+        """
+        self.n_requests += 1
+        faults = self.faults
+
+        delay = faults.latency + random.uniform(-faults.jitter, faults.jitter)
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+        roll = random.random()
+        if roll < faults.timeout_rate:
+            await asyncio.sleep(faults.hang_seconds)
+            return None
+        roll -= faults.timeout_rate
+
+        if roll < faults.throttle_rate:
+            body = envelope(
+                error_code=THROTTLED, throttle_seconds=faults.throttle_seconds
+            )
+            return web.json_response(body)
+        roll -= faults.throttle_rate
+
+        if roll < faults.malformed_rate:
+            return web.Response(
+                status=503,
+                text="<html><body>Service Unavailable</body></html>",
+                content_type="text/html",
+            )
+
+        return None
+
+    async def pgcr(self, request):
+        fault = await self._inject()
+        if fault is not None:
+            return fault
+
+        instance_id = int(request.match_info["activityId"])
+        if random.random() < self.faults.missing_rate:
+            return web.json_response(envelope(error_code=PGCR_NOT_FOUND))
+
+        if self.fixtures is not None:
+            path = join(self.fixtures, f"{instance_id}.json")
+            if exists(path):
+                with open(path) as f:
+                    return web.Response(text=f.read(), content_type="application/json")
+
+        return web.json_response(envelope(synthetic_pgcr(instance_id)))
+
+    async def activities(self, request):
+        fault = await self._inject()
+        if fault is not None:
+            return fault
+
+        count = int(request.query.get("count", 25))
+        page = int(request.query.get("page", 0))
+        # Pretend every character has 100 activities, newest first
+        base = int(request.match_info["characterId"]) % 10 ** 6 * 100
+        newest = base + 99 - page * count
+        ids = range(newest, max(base - 1, newest - count), -1)
+
+        activities = []
+        for instance_id in ids:
+            pgcr = synthetic_pgcr(instance_id)
+            activities.append(
+                {
+                    "period": pgcr["period"],
+                    "activityDetails": pgcr["activityDetails"],
+                    "values": pgcr["entries"][0]["values"],
+                }
+            )
+        return web.json_response(envelope({"activities": activities}))
+
+    async def manifest(self, request):
+        fault = await self._inject()
+        if fault is not None:
+            return fault
+
+        content_path = f"/common/destiny2_content/sqlite/en/{self.manifest_name}"
+        return web.json_response(
+            envelope(
+                {
+                    "version": self.manifest_name,
+                    "mobileWorldContentPaths": {"en": content_path},
+                }
+            )
+        )
+
+    async def manifest_content(self, request):
+        if request.match_info["name"] != self.manifest_name:
+            raise web.HTTPNotFound()
+        return web.Response(
+            body=self.manifest_zip, content_type="application/octet-stream"
+        )
+
+    def app(self):
+        app = web.Application()
+        app.router.add_get(
+            "/Platform/Destiny2/Stats/PostGameCarnageReport/{activityId}/", self.pgcr
+        )
+        app.router.add_get(
+            "/Platform/Destiny2/{membershipType}/Account/{destinyMembershipId}"
+            "/Character/{characterId}/Stats/Activities/",
+            self.activities,
+        )
+        app.router.add_get("/Platform/Destiny2/Manifest/", self.manifest)
+        app.router.add_get(
+            "/common/destiny2_content/sqlite/en/{name}", self.manifest_content
+        )
+        return app
+
+    def start(self):
+        """Start serving on a background thread. Returns once it's up."""
+        started = threading.Event()
+        self.loop = asyncio.new_event_loop()
+
+        async def serve():
+            self.runner = web.AppRunner(self.app(), access_log=None)
+            await self.runner.setup()
+            site = web.TCPSite(self.runner, "127.0.0.1", self.port)
+            await site.start()
+            self.port = site._server.sockets[0].getsockname()[1]
+            started.set()
+
+        def run():
+            asyncio.set_event_loop(self.loop)
+            self.loop.run_until_complete(serve())
+            self.loop.run_forever()
+
+        self.thread = threading.Thread(target=run, daemon=True)
+        self.thread.start()
+        started.wait()
+        return self
+
+    def stop(self):
+        future = asyncio.run_coroutine_threadsafe(self.runner.cleanup(), self.loop)
+        future.result()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+
+
+def serve(faults=None, fixtures=None, port=8080):
+    """Serve on the current thread until interrupted. Handy as the target of
+    a separate process, so the server's CPU time isn't counted against the
+    crawler being measured.
+    """
+    server = MockServer(faults, fixtures=fixtures, port=port)
+    web.run_app(server.app(), host="127.0.0.1", port=port, print=None, access_log=None)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Serve a mock Bungie Platform API")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--fixtures", default=None)
+    parser.add_argument("--latency", type=float, default=0)
+    parser.add_argument("--jitter", type=float, default=0)
+    parser.add_argument("--throttle-rate", type=float, default=0)
+    parser.add_argument("--throttle-seconds", type=int, default=1)
+    parser.add_argument("--timeout-rate", type=float, default=0)
+    parser.add_argument("--malformed-rate", type=float, default=0)
+    parser.add_argument("--missing-rate", type=float, default=0)
+    args = parser.parse_args()
+
+    faults = Faults(
+        latency=args.latency,
+        jitter=args.jitter,
+        throttle_rate=args.throttle_rate,
+        throttle_seconds=args.throttle_seconds,
+        timeout_rate=args.timeout_rate,
+        malformed_rate=args.malformed_rate,
+        missing_rate=args.missing_rate,
+    )
+    print(f"Serving on http://127.0.0.1:{args.port}/Platform/")
+    serve(faults, fixtures=args.fixtures, port=args.port)
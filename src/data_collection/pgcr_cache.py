@@ -0,0 +1,169 @@
+"""
+pgcr_cache.py
+author: garrick
+
+On-disk cache of raw PGCR responses. A PGCR never changes once the activity is
+over, so anything we've downloaded once can be re-extracted later without
+spending any of our request quota.
+
+Responses are zlib-compressed and appended to segment files, one per block of
+SEGMENT_IDS instance IDs, instead of one file per ID. Each record is
+
+    instance_id (u64) | length (u32) | crc32 (u32) | compressed body
+
+A segment's index (ID -> offset) is rebuilt by reading just the record headers
+the first time the segment is touched. Appends take an exclusive lock on the
+segment file, so several crawl processes can share a cache directory.
+"""
+import fcntl
+import logging
+import os
+import struct
+import threading
+import zlib
+
+logger = logging.getLogger(__name__)
+
+
+# Instance IDs per segment file
+SEGMENT_IDS = 1 << 20
+# zlib level; PGCRs are repetitive JSON, so even fast levels shrink them ~10x
+COMPRESSION_LEVEL = 6
+HEADER = struct.Struct("<QII")
+
+
+class Segment:
+    def __init__(self, path):
+        self.path = path
+        self.fd = os.open(path, os.O_RDWR | os.O_CREAT | os.O_APPEND, 0o644)
+        # instance_id -> (offset of body, length of body)
+        self.index = {}
+        self.lock = threading.Lock()
+        self._load()
+
+    def _load(self):
+        fcntl.flock(self.fd, fcntl.LOCK_EX)
+        try:
+            size = os.fstat(self.fd).st_size
+            offset = 0
+            while offset + HEADER.size <= size:
+                instance_id, length, crc = HEADER.unpack(
+                    os.pread(self.fd, HEADER.size, offset)
+                )
+                body = offset + HEADER.size
+                if body + length > size:
+                    break
+                self.index[instance_id] = (body, length)
+                offset = body + length
+
+            if offset < size:
+                # A write was cut off partway; drop it so later appends are
+                # reachable
+                logger.warning(
+                    f"{self.path}: dropping {size - offset} bytes of partial record"
+                )
+                os.ftruncate(self.fd, offset)
+        finally:
+            fcntl.flock(self.fd, fcntl.LOCK_UN)
+
+    def get(self, instance_id):
+        location = self.index.get(instance_id)
+        if location is None:
+            return None
+        offset, length = location
+        data = os.pread(self.fd, length, offset)
+        _, _, crc = HEADER.unpack(os.pread(self.fd, HEADER.size, offset - HEADER.size))
+        if zlib.crc32(data) != crc:
+            logger.warning(f"{self.path}: bad checksum for {instance_id}, ignoring")
+            return None
+        return zlib.decompress(data)
+
+    def put(self, instance_id, data):
+        record = HEADER.pack(instance_id, len(data), zlib.crc32(data)) + data
+        with self.lock:
+            fcntl.flock(self.fd, fcntl.LOCK_EX)
+            try:
+                # O_APPEND, so this lands at the end even if another process
+                # appended since we last looked
+                offset = os.lseek(self.fd, 0, os.SEEK_END)
+                os.write(self.fd, record)
+            finally:
+                fcntl.flock(self.fd, fcntl.LOCK_UN)
+            self.index[instance_id] = (offset + HEADER.size, len(data))
+
+    def close(self):
+        os.close(self.fd)
+
+
+class PGCRCache:
+    """Raw PGCR response bodies by instance ID, kept under a directory.
+
+    Args:
+      path (str): Directory holding the segment files. Created if needed.
+      level (int): zlib compression level for new entries.
+    """
+
+    def __init__(self, path, level=COMPRESSION_LEVEL):
+        self.path = path
+        self.level = level
+        os.makedirs(path, exist_ok=True)
+        self.segments = {}
+        # Segments found not to exist, so lookups in them don't stat the disk
+        # for every ID. One created by another process since is missed until
+        # restart, which only costs refetching.
+        self.missing = set()
+        self.lock = threading.Lock()
+
+    def _segment_path(self, n):
+        return os.path.join(self.path, f"{n:08d}.seg")
+
+    def _segment(self, instance_id, create=False):
+        n = instance_id // SEGMENT_IDS
+        segment = self.segments.get(n)
+        if segment is None:
+            if not create and n in self.missing:
+                return None
+            with self.lock:
+                segment = self.segments.get(n)
+                if segment is None:
+                    if not create and not os.path.exists(self._segment_path(n)):
+                        self.missing.add(n)
+                        return None
+                    segment = self.segments[n] = Segment(self._segment_path(n))
+                    self.missing.discard(n)
+        return segment
+
+    def get(self, instance_id):
+        """Raw response body for instance_id, or None if it isn't cached."""
+        segment = self._segment(instance_id)
+        if segment is None:
+            return None
+        return segment.get(instance_id)
+
+    def put(self, instance_id, content):
+        """Cache a raw response body. Only cache complete, successful PGCRs."""
+        segment = self._segment(instance_id, create=True)
+        if instance_id in segment.index:
+            return
+        segment.put(instance_id, zlib.compress(content, self.level))
+
+    def __contains__(self, instance_id):
+        segment = self._segment(instance_id)
+        return segment is not None and instance_id in segment.index
+
+    def ids(self, start, end):
+        """Cached instance IDs in [start, end), segment by segment in the
+        order they were written, so reading them back is sequential I/O.
+        """
+        for n in range(start // SEGMENT_IDS, (end - 1) // SEGMENT_IDS + 1):
+            segment = self._segment(n * SEGMENT_IDS)
+            if segment is None:
+                continue
+            for instance_id, _ in sorted(segment.index.items(), key=lambda kv: kv[1]):
+                if start <= instance_id < end:
+                    yield instance_id
+
+    def close(self):
+        for segment in self.segments.values():
+            segment.close()
+        self.segments = {}
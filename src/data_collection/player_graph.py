@@ -0,0 +1,344 @@
+"""
+player_graph.py
+author: garrick
+
+Breadth-first crawl of who plays with whom. Starting from seed characters,
+each level of the crawl:
+
+1. pages through the activity history of every character in the frontier,
+   collecting instance IDs we haven't seen, then
+2. fetches the PGCR of each of those activities, writing one edge row per
+   (activity, character) and adding characters we haven't seen to the next
+   frontier.
+
+Both phases run on a ThreadPool under the shared rate limiter, one request per
+token. Seen characters and activities are kept in Bloom filters, and the
+frontier is kept in packed arrays, so memory stays small even for large
+crawls. Edges are streamed to disk as they're found; co-play pairs can be
+built from them by joining on instance_id.
+
+    python player_graph.py --seed 3:4611686018497112157:2305843009574374200 \\
+        --depth 2 --output edges.csv
+"""
+import argparse
+import array
+import json
+import logging
+import threading
+import time
+from urllib.parse import urljoin
+
+import requests
+
+import data_collection as dc
+from bloom import BloomFilter
+from metrics import METRICS, LogReporter
+from pgcr_cache import PGCRCache
+from ratelimit import BURST_SIZE, N_REQUESTS_PER_SECOND, TokenBucket
+from sinks import CHUNK_SIZE, open_sink
+from threadpool import ThreadPool
+
+logger = logging.getLogger(__name__)
+
+
+EDGE_COLUMNS = {
+    "instance_id": "int64",
+    "period": "str",
+    "director_activity_hash": "int64",
+    "character_id": "int64",
+    "membership_id": "int64",
+    "membership_type": "int64",
+    "standing": "int64",
+    # BFS level the activity was found at
+    "depth": "int64",
+}
+# Characters and activities we expect to see, for sizing the Bloom filters
+CAPACITY = 10 ** 7
+# The API allows up to 250 activities per history page
+PAGE_SIZE = 250
+MAX_PAGES = 4
+
+
+class Frontier:
+    """Characters to expand, as packed columns instead of a list of dicts.
+    Appends may come from many threads.
+    """
+
+    def __init__(self):
+        self.membership_types = array.array("B")
+        self.membership_ids = array.array("Q")
+        self.character_ids = array.array("Q")
+        self.lock = threading.Lock()
+
+    def add(self, membership_type, membership_id, character_id):
+        # Appended together so the columns stay lined up
+        with self.lock:
+            self.membership_types.append(membership_type)
+            self.membership_ids.append(membership_id)
+            self.character_ids.append(character_id)
+
+    def __len__(self):
+        return len(self.character_ids)
+
+    def __iter__(self):
+        """Yields the character_data dicts get_activity_history_page takes,
+        one at a time.
+        """
+        for i in range(len(self)):
+            yield {
+                "membershipType": self.membership_types[i],
+                "destinyMembershipId": self.membership_ids[i],
+                "characterId": self.character_ids[i],
+            }
+
+
+def parse_seed(seed):
+    """"membershipType:destinyMembershipId:characterId" to a tuple of ints."""
+    try:
+        membership_type, membership_id, character_id = map(int, seed.split(":"))
+    except ValueError:
+        raise argparse.ArgumentTypeError(
+            f"Expected membershipType:destinyMembershipId:characterId, got {seed}"
+        )
+    return membership_type, membership_id, character_id
+
+
+def fetch_pgcr(instance_id):
+    """The Response of a PGCR, saving it to dc.CACHE if there is one, or
+    None if the request failed.
+    """
+    path = urljoin(
+        dc.API_URL, dc.GET_POST_GAME_CARNAGE_REPORT.format(activityId=instance_id)
+    )
+    try:
+        r = dc.CLIENT.get(path)
+    except requests.RequestException:
+        METRICS.incr("errors.connection")
+        return None
+    try:
+        body = json.loads(r.content)
+    except ValueError:
+        body = None
+
+    pgcr = dc.check_response(instance_id, r.status_code, body)
+    if pgcr is not None and dc.CACHE is not None:
+        dc.CACHE.put(instance_id, r.content)
+    return pgcr
+
+
+class PlayerGraphCrawler:
+    """
+    Args:
+      sink (Sink): Where edge rows go; see EDGE_COLUMNS.
+      capacity (int): Characters (and, separately, activities) the Bloom
+        filters are sized for.
+      max_pages (int): History pages to read per character.
+      page_size (int): Activities per history page.
+      mode (int): Only follow activities of this DestinyActivityModeType.
+      max_characters (int): Stop adding to the frontier after this many
+        characters have been seen.
+      progress (bool): Show a progress bar per phase.
+    """
+
+    def __init__(
+        self,
+        sink,
+        capacity=CAPACITY,
+        max_pages=MAX_PAGES,
+        page_size=PAGE_SIZE,
+        mode=None,
+        max_characters=None,
+        progress=True,
+    ):
+        self.sink = sink
+        self.characters = BloomFilter(capacity)
+        self.instances = BloomFilter(capacity)
+        self.max_pages = max_pages
+        self.page_size = page_size
+        self.mode = mode
+        self.max_characters = max_characters
+        self.progress = progress
+
+    def _full(self):
+        return (
+            self.max_characters is not None
+            and len(self.characters) >= self.max_characters
+        )
+
+    def expand_character(self, character, instances):
+        """Add the character's unseen activities to instances. The pool spends
+        a token on the first page; later pages wait for their own.
+        """
+        for page in range(self.max_pages):
+            if page:
+                dc.RATE_LIMITER.acquire()
+            activities = dc.get_activity_history_page(
+                character, page=page, count=self.page_size, mode=self.mode
+            )
+            if not activities:
+                break
+
+            for activity in activities:
+                instance_id = int(dc.get_activity_instance_id(activity))
+                if self.instances.add(instance_id):
+                    instances.append(instance_id)
+
+            if len(activities) < self.page_size:
+                break
+
+    def expand_instance(self, instance_id, pgcr, frontier, depth):
+        """Write the activity's edges and add its unseen characters to
+        frontier.
+        """
+        if pgcr is None:
+            return
+        details = pgcr["activityDetails"]
+
+        for entry in pgcr["entries"]:
+            info = entry["player"]["destinyUserInfo"]
+            character_id = int(entry["characterId"])
+            membership_id = int(info["membershipId"])
+            membership_type = info["membershipType"]
+
+            self.sink.write(
+                {
+                    "instance_id": instance_id,
+                    "period": pgcr["period"],
+                    "director_activity_hash": details["directorActivityHash"],
+                    "character_id": character_id,
+                    "membership_id": membership_id,
+                    "membership_type": membership_type,
+                    "standing": entry.get("standing"),
+                    "depth": depth,
+                }
+            )
+            if not self._full() and self.characters.add(character_id):
+                frontier.add(membership_type, membership_id, character_id)
+
+    def _uncached(self, instances, frontier, depth):
+        """Expand cached activities right away, and pass on the rest to be
+        fetched, so cache hits don't spend rate limiter tokens.
+        """
+        for instance_id in instances:
+            content = dc.CACHE.get(instance_id) if dc.CACHE is not None else None
+            if content is None:
+                yield instance_id
+                continue
+            METRICS.incr("cache.hit")
+            pgcr = json.loads(content)["Response"]
+            self.expand_instance(instance_id, pgcr, frontier, depth)
+
+    def crawl(self, seeds, depth):
+        """Crawl depth levels out from seeds, a list of (membershipType,
+        destinyMembershipId, characterId) tuples.
+        """
+        frontier = Frontier()
+        for seed in seeds:
+            if self.characters.add(seed[2]):
+                frontier.add(*seed)
+
+        for level in range(depth):
+            if not len(frontier):
+                break
+            logger.info(f"Level {level}: expanding {len(frontier)} characters")
+
+            # Array of IDs rather than a list of ints; appends are atomic
+            instances = array.array("Q")
+            pool = ThreadPool(limiter=dc.RATE_LIMITER, progress=self.progress)
+            pool.map(
+                lambda character: self.expand_character(character, instances),
+                frontier,
+                total=len(frontier),
+            )
+            pool.shutdown()
+
+            logger.info(f"Level {level}: fetching {len(instances)} activities")
+            frontier = Frontier()
+            pool = ThreadPool(limiter=dc.RATE_LIMITER, progress=self.progress)
+            pool.map(
+                lambda instance_id: self.expand_instance(
+                    instance_id, fetch_pgcr(instance_id), frontier, level
+                ),
+                self._uncached(instances, frontier, level),
+                total=len(instances),
+            )
+            pool.shutdown()
+
+        logger.info(
+            f"Saw {len(self.characters)} characters and "
+            f"{len(self.instances)} activities"
+        )
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+
+    parser = argparse.ArgumentParser(
+        description="Crawl the graph of players who've played together"
+    )
+    parser.add_argument(
+        "--seed",
+        type=parse_seed,
+        action="append",
+        required=True,
+        help="membershipType:destinyMembershipId:characterId to start from "
+        "(repeatable)",
+    )
+    parser.add_argument("--depth", type=int, default=2, help="Levels to crawl")
+    parser.add_argument(
+        "--pages", type=int, default=MAX_PAGES, help="History pages per character"
+    )
+    parser.add_argument(
+        "--page-size", type=int, default=PAGE_SIZE, help="Activities per page"
+    )
+    parser.add_argument(
+        "--activity-mode",
+        type=int,
+        default=None,
+        help="Only follow activities of this DestinyActivityModeType",
+    )
+    parser.add_argument(
+        "--max-characters",
+        type=int,
+        default=None,
+        help="Stop growing the frontier after seeing this many characters",
+    )
+    parser.add_argument(
+        "--capacity",
+        type=int,
+        default=CAPACITY,
+        help="Characters/activities to size the visited sets for",
+    )
+    parser.add_argument("--rate", type=float, default=N_REQUESTS_PER_SECOND)
+    parser.add_argument("--burst", type=int, default=BURST_SIZE)
+    parser.add_argument("--api-url", default=dc.API_URL)
+    parser.add_argument(
+        "--cache", default=None, help="Raw PGCR cache directory; see pgcr_cache.py"
+    )
+    parser.add_argument("--output", default="edges.csv")
+    parser.add_argument("--chunk-size", type=int, default=CHUNK_SIZE)
+    args = parser.parse_args()
+
+    dc.API_URL = args.api_url
+    dc.RATE_LIMITER = TokenBucket(rate=args.rate, burst=args.burst)
+    if args.cache is not None:
+        dc.CACHE = PGCRCache(args.cache)
+
+    reporter = LogReporter().start()
+    start_time = time.perf_counter()
+
+    with open_sink(args.output, EDGE_COLUMNS, args.chunk_size) as sink:
+        crawler = PlayerGraphCrawler(
+            sink,
+            capacity=args.capacity,
+            max_pages=args.pages,
+            page_size=args.page_size,
+            mode=args.activity_mode,
+            max_characters=args.max_characters,
+        )
+        crawler.crawl(args.seed, args.depth)
+
+    print(f"perf time: {time.perf_counter() - start_time}")
+    reporter.stop()
+    if dc.CACHE is not None:
+        dc.CACHE.close()
@@ -0,0 +1,148 @@
+"""
+ratelimit.py
+author: garrick
+
+Token bucket rate limiter shared by ThreadPool, AsyncPool, and the scrapers.
+Tokens refill continuously (fractionally) instead of all at once every second,
+so requests go out evenly spaced. When the API tells us we're being throttled,
+the bucket stops handing out tokens for ThrottleSeconds and halves its rate,
+then creeps back up toward the quota as requests succeed (AIMD, like TCP).
+No tokens build up during the pause, so it doesn't end in a burst, and the
+rate is only cut once per throttle window, however many requests that were
+already in flight come back throttled too. Callers already queued for a token
+when the throttle comes in don't go out during the pause either: their
+reservations are void, and they queue again for the end of it.
+"""
+import asyncio
+import logging
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+N_REQUESTS_PER_SECOND = 25
+BURST_SIZE = 5
+
+# Never back off below this many requests per second
+MIN_REQUESTS_PER_SECOND = 1
+# Multiplicative decrease applied on each throttle response
+BACKOFF_FACTOR = 0.5
+# Additive increase, in requests per second, gained per second of successes
+RECOVERY_RATE = 1
+# Throttle responses within this many seconds of a cut (or during the pause it
+# started) are taken as the same event and don't cut the rate again
+BACKOFF_INTERVAL = 1
+
+
+class TokenBucket:
+    def __init__(
+        self,
+        rate=N_REQUESTS_PER_SECOND,
+        burst=BURST_SIZE,
+        min_rate=MIN_REQUESTS_PER_SECOND,
+    ):
+        self.lock = threading.Lock()
+
+        # The quota we ramp back up to, and the rate we're currently allowing
+        self.max_rate = rate
+        self.min_rate = min_rate
+        self.rate = rate
+
+        self.burst = burst
+        self.tokens = burst
+        self.last_refill = time.monotonic()
+
+        # Nothing goes out until this time if the API asked us to back off
+        self.blocked_until = 0
+        self.last_backoff = float("-inf")
+        # Bumped by every throttle, voiding reservations made before it
+        self.generation = 0
+
+    def _refill(self, now):
+        # Tokens only build up from the end of any pause
+        start = max(self.last_refill, self.blocked_until)
+        if now > start:
+            self.tokens = min(self.burst, self.tokens + (now - start) * self.rate)
+            self.last_refill = now
+
+    def _reserve(self):
+        with self.lock:
+            now = time.monotonic()
+            self._refill(now)
+            self.tokens -= 1
+
+            # Reserved tokens are handed out from the end of any pause
+            wait = 0 if self.tokens >= 0 else -self.tokens / self.rate
+            return max(0, self.blocked_until - now) + wait, self.generation
+
+    def _still_valid(self, generation):
+        # Whether a reservation survived any throttle while its holder waited
+        with self.lock:
+            return (
+                generation == self.generation and time.monotonic() >= self.blocked_until
+            )
+
+    def reserve(self):
+        """Take a token and return how many seconds the caller must wait
+        before using it. Tokens may go negative; that's a queue of callers
+        who have reserved future tokens, each waiting their turn. A throttle
+        while waiting voids the reservation; acquire() handles that.
+        """
+        return self._reserve()[0]
+
+    def acquire(self):
+        """Block the calling thread until a request may be sent."""
+        while True:
+            wait, generation = self._reserve()
+            if wait > 0:
+                time.sleep(wait)
+            if self._still_valid(generation):
+                return
+
+    async def acquire_async(self):
+        """Suspend the calling coroutine until a request may be sent."""
+        while True:
+            wait, generation = self._reserve()
+            if wait > 0:
+                await asyncio.sleep(wait)
+            if self._still_valid(generation):
+                return
+
+    def throttled(self, seconds=0):
+        """Report that the API throttled a request. Pauses everyone for the
+        given number of seconds and cuts the rate, unless this is part of a
+        throttle we've already backed off for.
+
+        Args:
+          seconds (float): ThrottleSeconds from the response, if any.
+        """
+        with self.lock:
+            now = time.monotonic()
+            self._refill(now)
+            backoff = now >= max(
+                self.blocked_until, self.last_backoff + BACKOFF_INTERVAL
+            )
+            if backoff:
+                self.rate = max(self.min_rate, self.rate * BACKOFF_FACTOR)
+                self.last_backoff = now
+            # Forget any saved-up burst; we were clearly going too fast. Queued
+            # reservations are void too, so their holders reserve again
+            # rather than going out during the pause
+            self.tokens = 0
+            self.generation += 1
+            self.blocked_until = max(self.blocked_until, now + seconds)
+            self.last_refill = max(self.last_refill, self.blocked_until)
+
+        if backoff:
+            logger.warning(
+                f"Throttled for {seconds}s, backing off to {self.rate:.2f} req/s"
+            )
+
+    def succeeded(self):
+        """Report that a request went through. Nudges the rate back up toward
+        the quota by RECOVERY_RATE requests per second, per second.
+        """
+        with self.lock:
+            if self.rate < self.max_rate:
+                self.rate = min(self.max_rate, self.rate + RECOVERY_RATE / self.rate)
@@ -0,0 +1,338 @@
+"""
+retry.py
+author: garrick
+
+Second (and third...) chances for PGCR fetches that time out, drop their
+connection, or get throttled, so a crawl doesn't quietly lose them.
+
+RetryQueue holds failed IDs until their backoff is up and feeds them back in
+among new IDs. Nothing sleeps on a worker: the thread or coroutine pulling
+IDs is what waits, and only once there's nothing new left to hand out.
+Retries go through the pool like any other job, so each one spends a rate
+limiter token, and they're capped at a fraction of first attempts so a bad
+patch of network can't multiply our request count.
+
+Hedger covers the slow tail instead: if a request hasn't answered after a
+while, it sends a second copy and takes whichever answers first. Hedges also
+spend tokens and are capped at a (smaller) fraction of requests.
+"""
+import asyncio
+import heapq
+import logging
+import random
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from concurrent.futures import wait
+
+from metrics import METRICS
+from threadpool import NUM_WORKERS
+
+logger = logging.getLogger(__name__)
+
+
+# Tries per ID, counting the first
+MAX_ATTEMPTS = 5
+# Seconds before the first retry; doubles with each retry after
+BASE_DELAY = 1
+MAX_DELAY = 60
+# Retries allowed per first attempt, plus a few for free so small crawls
+# aren't held to a ratio
+RETRY_BUDGET = 0.2
+MIN_RETRIES = 10
+# Hedges allowed per request
+HEDGE_BUDGET = 0.05
+# Seconds between checks for due retries in feed_async, and for being stopped
+# while waiting in feed
+POLL_INTERVAL = 0.05
+
+
+def backoff(attempt, base_delay=BASE_DELAY, max_delay=MAX_DELAY):
+    """Seconds to wait before retry number attempt (1 for the first retry):
+    exponential, with the top half jittered so retries of IDs that failed
+    together don't all come back at once.
+    """
+    delay = min(max_delay, base_delay * 2 ** (attempt - 1))
+    return delay / 2 + random.uniform(0, delay / 2)
+
+
+class RetryQueue:
+    """
+    Args:
+      max_attempts (int): Give up on an ID after this many tries.
+      base_delay (float): Seconds before the first retry.
+      max_delay (float): Longest wait between tries.
+      budget (float): Retries allowed per first attempt.
+      metrics (Metrics): Where retry.* counters go.
+    """
+
+    def __init__(
+        self,
+        max_attempts=MAX_ATTEMPTS,
+        base_delay=BASE_DELAY,
+        max_delay=MAX_DELAY,
+        budget=RETRY_BUDGET,
+        metrics=METRICS,
+    ):
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.budget = budget
+        self.metrics = metrics
+
+        self.cv = threading.Condition()
+        # (due time, instance_id), soonest first
+        self.delayed = []
+        # instance_id -> failed tries so far, for IDs that have failed
+        self.failures = {}
+        # IDs in self.delayed
+        self.waiting = set()
+        # IDs handed out but not finished; any of them may still fail
+        self.in_flight = 0
+        self.n_first = 0
+        self.n_retries = 0
+
+    def __len__(self):
+        return len(self.delayed)
+
+    def _pop_due(self, now):
+        """Take the next retry that's due, or None. Call with cv held."""
+        if self.delayed and self.delayed[0][0] <= now:
+            _, instance_id = heapq.heappop(self.delayed)
+            self.waiting.discard(instance_id)
+            self.in_flight += 1
+            self.n_retries += 1
+            self.metrics.incr("retry.sent")
+            return instance_id
+        return None
+
+    def feed(self, ids, stop=None):
+        """Yield ids, with retries mixed in ahead of new IDs as they come due.
+        Once ids runs out, waits for the remaining retries, and returns when
+        nothing is delayed or in flight, or when stop (an Event, e.g. a
+        ThreadPool's cancelled) is set. Every yielded ID must be reported
+        with finished() once it's been tried.
+        """
+        for instance_id in ids:
+            while True:
+                with self.cv:
+                    retry = self._pop_due(time.monotonic())
+                if retry is None:
+                    break
+                yield retry
+
+            with self.cv:
+                self.in_flight += 1
+                self.n_first += 1
+            yield instance_id
+
+        while True:
+            with self.cv:
+                while True:
+                    now = time.monotonic()
+                    retry = self._pop_due(now)
+                    if retry is not None:
+                        break
+                    if not self.delayed and not self.in_flight:
+                        return
+                    if stop is not None and stop.is_set():
+                        return
+                    # Wakes early if a finishing ID adds a retry or ends the
+                    # crawl
+                    timeout = self.delayed[0][0] - now if self.delayed else None
+                    if stop is not None:
+                        timeout = min(timeout or POLL_INTERVAL, POLL_INTERVAL)
+                    self.cv.wait(timeout)
+            yield retry
+
+    async def feed_async(self, ids):
+        """feed(), for AsyncPool: waits on the event loop instead of blocking
+        it, checking for due retries every POLL_INTERVAL once ids runs out.
+        """
+        for instance_id in ids:
+            while True:
+                with self.cv:
+                    retry = self._pop_due(time.monotonic())
+                if retry is None:
+                    break
+                yield retry
+
+            with self.cv:
+                self.in_flight += 1
+                self.n_first += 1
+            yield instance_id
+
+        while True:
+            with self.cv:
+                retry = self._pop_due(time.monotonic())
+                if retry is None and not self.delayed and not self.in_flight:
+                    return
+            if retry is not None:
+                yield retry
+            else:
+                await asyncio.sleep(POLL_INTERVAL)
+
+    def failed(self, instance_id):
+        """Report a retryable failure. Returns True if the ID will be tried
+        again, or False if it has run out of tries or the crawl has run out
+        of retry budget.
+        """
+        with self.cv:
+            attempts = self.failures.get(instance_id, 0) + 1
+            if attempts >= self.max_attempts:
+                self.failures.pop(instance_id, None)
+                self.metrics.incr("retry.exhausted")
+                return False
+
+            pending = self.n_retries + len(self.delayed)
+            if pending >= MIN_RETRIES + self.budget * self.n_first:
+                self.failures.pop(instance_id, None)
+                self.metrics.incr("retry.over_budget")
+                return False
+
+            self.failures[instance_id] = attempts
+            self.waiting.add(instance_id)
+            due = time.monotonic() + backoff(attempts, self.base_delay, self.max_delay)
+            heapq.heappush(self.delayed, (due, instance_id))
+            self.metrics.incr("retry.scheduled")
+            self.cv.notify_all()
+            return True
+
+    def finished(self, instance_id):
+        """Report that a try of an ID from feed() is over, however it went."""
+        with self.cv:
+            self.in_flight -= 1
+            # Failures are reported before the try finishes, so an ID that
+            # isn't waiting for another try is done for good
+            if instance_id not in self.waiting:
+                self.failures.pop(instance_id, None)
+            if not self.in_flight:
+                self.cv.notify_all()
+
+    def summary(self):
+        return f"{self.n_first} first tries, {self.n_retries} retries"
+
+
+class Hedger:
+    """
+    Args:
+      after (float): Seconds to wait on a request before hedging it.
+      limiter (TokenBucket): Hedges wait for a token like any request.
+      budget (float): Hedges allowed per request.
+      workers (int): Threads for call(); each hedged call holds two.
+      metrics (Metrics): Where hedge.* counters go.
+    """
+
+    def __init__(
+        self,
+        after,
+        limiter,
+        budget=HEDGE_BUDGET,
+        workers=2 * NUM_WORKERS,
+        metrics=METRICS,
+    ):
+        self.after = after
+        self.limiter = limiter
+        self.budget = budget
+        self.metrics = metrics
+        self.lock = threading.Lock()
+        self.n_calls = 0
+        self.n_hedges = 0
+        # Only started for threaded calls
+        self.workers = workers
+        self.executor = None
+
+    def _allow(self):
+        with self.lock:
+            if self.n_hedges >= self.budget * self.n_calls:
+                self.metrics.incr("hedge.over_budget")
+                return False
+            self.n_hedges += 1
+            return True
+
+    def _count(self):
+        with self.lock:
+            self.n_calls += 1
+
+    def call(self, func, *args, hedge_with=None, **kwargs):
+        """func(*args, **kwargs), hedged. Exceptions from the first copy to
+        fail are only raised if the other copy fails too.
+
+        A thread can't be cancelled, so the slower copy keeps its worker and
+        connection until it answers or times out; give func a timeout. The
+        hedge should go out on a different connection pool (hedge_with) than
+        the request it's hedging, or with a blocking pool it can sit waiting
+        for a connection held by the very requests that are slow.
+
+        Args:
+          hedge_with (callable): Sent instead of func as the hedge, with the
+            same arguments. Defaults to func.
+        """
+        self._count()
+        if self.executor is None:
+            with self.lock:
+                if self.executor is None:
+                    self.executor = ThreadPoolExecutor(max_workers=self.workers)
+
+        primary = self.executor.submit(func, *args, **kwargs)
+        try:
+            return primary.result(timeout=self.after)
+        except FutureTimeoutError:
+            pass
+        if not self._allow():
+            return primary.result()
+
+        self.limiter.acquire()
+        if primary.done():
+            return primary.result()
+        self.metrics.incr("hedge.sent")
+        hedge = self.executor.submit(hedge_with or func, *args, **kwargs)
+
+        done, pending = wait([primary, hedge], return_when=FIRST_COMPLETED)
+        for future in done:
+            if future.exception() is None:
+                if future is hedge:
+                    self.metrics.incr("hedge.won")
+                return future.result()
+        # The first to finish failed; the other one's all we have
+        return pending.pop().result() if pending else primary.result()
+
+    async def call_async(self, func, *args, hedge_with=None):
+        """await func(*args), hedged. The slower copy is cancelled. As for
+        call(), the hedge should go out on its own connections (hedge_with):
+        an aiohttp timeout includes waiting for a connection.
+
+        Args:
+          hedge_with (coroutine function): Awaited instead of func as the
+            hedge, with the same arguments. Defaults to func.
+        """
+        self._count()
+        primary = asyncio.ensure_future(func(*args))
+        done, _ = await asyncio.wait([primary], timeout=self.after)
+        if done or not self._allow():
+            return await primary
+
+        await self.limiter.acquire_async()
+        if primary.done():
+            return primary.result()
+        self.metrics.incr("hedge.sent")
+        hedge = asyncio.ensure_future((hedge_with or func)(*args))
+
+        try:
+            done, pending = await asyncio.wait(
+                [primary, hedge], return_when=asyncio.FIRST_COMPLETED
+            )
+            for future in done:
+                if future.exception() is None:
+                    if future is hedge:
+                        self.metrics.incr("hedge.won")
+                    return future.result()
+            return await pending.pop() if pending else primary.result()
+        finally:
+            for future in (primary, hedge):
+                future.cancel()
+
+    def close(self):
+        if self.executor is not None:
+            self.executor.shutdown(wait=False)
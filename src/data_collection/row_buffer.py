@@ -0,0 +1,169 @@
+"""
+row_buffer.py
+author: garrick
+
+Typed, column-at-a-time storage for scraped rows, instead of a list of dicts.
+A wide row is around a hundred keys; as a dict of boxed floats that's
+kilobytes per row, all of which pandas copies again to make a DataFrame. Here
+each column is one packed array:
+
+- int64 and float64 columns are array.arrays of machine values, with a mask
+  for missing ints (missing floats are NaN)
+- str columns (activity names, periods) are interned: each distinct value is
+  stored once, and rows hold an int32 code. Character IDs are nearly all
+  distinct, so they're int64 columns instead
+
+A 12-player wide row comes to about 1.1 KB, nearly all of it the 120 float64
+stat slots (empty players' included), against nearly 3 KB as a dict.
+
+take() hands the rows over and starts a new buffer, and the arrays it hands
+over become the DataFrame's or Arrow table's columns directly, without a copy.
+A RowBuffer isn't locked; its Sink serializes appends along with its flushes.
+"""
+import array
+
+import numpy as np
+import pandas as pd
+
+# array.array typecodes per column dtype. Missing ints are 0 in the values
+# and 1 in the mask; missing strs are code -1.
+TYPECODES = {"int64": "q", "float64": "d", "str": "i"}
+NAN = float("nan")
+
+
+class RowBuffer:
+    """
+    Args:
+      columns (dict): Maps column name to dtype ("int64", "float64", or "str"),
+        as for a Sink. Values of other keys aren't kept, but their names are
+        collected in self.unknown.
+    """
+
+    def __init__(self, columns):
+        self.columns = columns
+        self.names = set(columns)
+        self.unknown = set()
+        self._reset()
+
+    def _reset(self):
+        self.n_rows = 0
+        self.values = {
+            name: array.array(TYPECODES[dtype]) for name, dtype in self.columns.items()
+        }
+        self.masks = {
+            name: array.array("B")
+            for name, dtype in self.columns.items()
+            if dtype == "int64"
+        }
+        # value -> code, per str column; codes are in order of first appearance
+        self.interned = {
+            name: {} for name, dtype in self.columns.items() if dtype == "str"
+        }
+        # What append needs per column, looked up once instead of per row
+        self._slots = [
+            (
+                name,
+                dtype,
+                self.values[name],
+                self.masks.get(name),
+                self.interned.get(name),
+            )
+            for name, dtype in self.columns.items()
+        ]
+
+    def __len__(self):
+        return self.n_rows
+
+    def append(self, row):
+        """Add a row (dict). Returns how many rows are buffered."""
+        if not self.names.issuperset(row):
+            self.unknown |= row.keys() - self.names
+
+        for name, dtype, values, mask, interned in self._slots:
+            value = row.get(name)
+            if dtype == "float64":
+                values.append(NAN if value is None else value)
+            elif dtype == "int64":
+                missing = value is None or value != value
+                values.append(0 if missing else int(value))
+                mask.append(missing)
+            elif value is None or value != value:
+                values.append(-1)
+            else:
+                code = interned.get(value)
+                if code is None:
+                    code = interned[value] = len(interned)
+                values.append(code)
+
+        self.n_rows += 1
+        return self.n_rows
+
+    def take(self):
+        """Hand over the buffered rows as a new RowBuffer, and start empty.
+        The returned buffer shouldn't be appended to.
+        """
+        taken = RowBuffer(self.columns)
+        taken.n_rows, taken.values, taken.masks, taken.interned = (
+            self.n_rows,
+            self.values,
+            self.masks,
+            self.interned,
+        )
+        taken._slots = self._slots
+        self._reset()
+        return taken
+
+    def _column(self, name):
+        """A column's values (and mask, for ints) as numpy views of the
+        arrays.
+        """
+        values = np.frombuffer(self.values[name], dtype=self.values[name].typecode)
+        mask = None
+        if name in self.masks:
+            mask = np.frombuffer(self.masks[name], dtype=np.bool_)
+        return values, mask
+
+    def _categories(self, name):
+        # Codes were handed out in order of first appearance, which is dict
+        # order
+        return list(self.interned[name])
+
+    def to_frame(self):
+        """The rows as a DataFrame. Numeric columns share memory with this
+        buffer; str columns are Categoricals over the interned values.
+        """
+        columns = {}
+        for name, dtype in self.columns.items():
+            values, mask = self._column(name)
+            if dtype == "str":
+                columns[name] = pd.Categorical.from_codes(
+                    values, pd.Index(self._categories(name), dtype=object)
+                )
+            elif mask is not None and mask.any():
+                columns[name] = pd.arrays.IntegerArray(values, mask)
+            else:
+                columns[name] = values
+        return pd.DataFrame(columns, copy=False)
+
+    def to_arrow(self):
+        """The rows as a pyarrow Table. Numeric columns share memory with this
+        buffer; str columns are dictionary-encoded over the interned values.
+        """
+        import pyarrow as pa
+
+        arrays = []
+        for name, dtype in self.columns.items():
+            values, mask = self._column(name)
+            if dtype == "str":
+                arrays.append(
+                    pa.DictionaryArray.from_arrays(
+                        pa.array(values, mask=values < 0),
+                        pa.array(self._categories(name), type=pa.string()),
+                    )
+                )
+            elif mask is not None and mask.any():
+                arrays.append(pa.array(values, mask=mask))
+            else:
+                # Missing floats are NaN, as in a DataFrame
+                arrays.append(pa.array(values, from_pandas=True))
+        return pa.Table.from_arrays(arrays, names=list(self.columns))
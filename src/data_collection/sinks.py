@@ -0,0 +1,309 @@
+"""
+sinks.py
+author: garrick
+
+Streaming output for scraped rows. Rows are buffered and written out in
+fixed-size chunks as they arrive, so memory stays bounded and results are on
+disk while the crawl is still running. Every chunk is conformed to a fixed set
+of columns and dtypes so chunks line up no matter which activities they hold.
+Buffered rows are kept in typed columns (see row_buffer.py) rather than as
+dicts, so big chunks stay cheap.
+"""
+import logging
+import os
+import threading
+
+import numpy as np
+import pandas as pd
+
+from row_buffer import RowBuffer
+
+logger = logging.getLogger(__name__)
+
+
+CHUNK_SIZE = 1000
+
+
+def to_int64(column):
+    """A column as nullable Int64. Decimal strings (IDs read back from a CSV,
+    or from outputs that stored them as str) are parsed exactly, never
+    through float64.
+    """
+    if pd.api.types.is_numeric_dtype(column):
+        return column.astype("Int64")
+    mask = column.isna().to_numpy()
+    values = np.zeros(len(column), dtype=np.int64)
+    values[~mask] = column[~mask].to_numpy().astype(str).astype(np.int64)
+    return pd.Series(pd.arrays.IntegerArray(values, mask), index=column.index)
+
+
+def arrow_to_frame(table):
+    """A pyarrow Table or RecordBatch as a DataFrame. int64 columns with
+    nulls (e.g. char_ids of empty player slots) become nullable Int64 instead
+    of float64, which would round the IDs.
+    """
+    import pyarrow as pa
+
+    return table.to_pandas(types_mapper={pa.int64(): pd.Int64Dtype()}.get)
+
+
+class Sink:
+    """Base class for chunked writers. Subclasses implement _write_chunk, and
+    may override _write_buffer to write buffered rows without a DataFrame.
+
+    Args:
+      path (str): Where to write.
+      columns (dict): Maps column name to dtype ("int64", "float64", or "str").
+        Missing columns are filled with nulls and unknown ones are dropped.
+      chunk_size (int): How many rows to buffer before writing.
+      on_flush (callable): Called with each chunk's DataFrame once it has been
+        written.
+    """
+
+    def __init__(self, path, columns, chunk_size=CHUNK_SIZE, on_flush=None):
+        self.path = path
+        self.columns = columns
+        self.chunk_size = chunk_size
+        self.on_flush = on_flush
+
+        # Rows may come in from many worker threads at once. This also guards
+        # the buffer, which has no lock of its own
+        self.lock = threading.Lock()
+        self.buffer = RowBuffer(columns)
+        self.n_written = 0
+        # Index of the first row written, past any rows already at path
+        self.first_index = 0
+        self.warned_columns = set()
+
+    def write(self, row):
+        with self.lock:
+            if self.buffer.append(row) >= self.chunk_size:
+                self._flush()
+
+    def write_frame(self, df):
+        """Write a whole DataFrame of rows at once, e.g. when merging."""
+        with self.lock:
+            self._flush()
+            self._write_frame(df)
+
+    def flush(self):
+        with self.lock:
+            self._flush()
+
+    def close(self):
+        self.flush()
+        logger.debug(f"Wrote {self.n_written} rows to {self.path}")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _flush(self):
+        self._warn_unknown(self.buffer.unknown)
+        if not len(self.buffer):
+            return
+
+        self._write_buffer(self.buffer.take())
+
+    def _write_buffer(self, buffer):
+        self._write_frame(buffer.to_frame())
+
+    def _warn_unknown(self, columns):
+        unknown = set(columns) - set(self.columns) - self.warned_columns
+        if unknown:
+            logger.warning(f"Dropping columns not in schema: {sorted(unknown)}")
+            self.warned_columns |= unknown
+
+    def _write_frame(self, df):
+        self._warn_unknown(df.columns)
+
+        df = df.reindex(columns=list(self.columns))
+        for name, dtype in self.columns.items():
+            if dtype == "str":
+                df[name] = df[name].astype(object).where(df[name].notna(), None)
+            elif dtype == "int64":
+                df[name] = to_int64(df[name])
+            else:
+                df[name] = df[name].astype(dtype)
+        # Keep a running index across chunks, like a single to_csv would
+        start = self.first_index + self.n_written
+        df.index = pd.RangeIndex(start, start + len(df))
+
+        self._write_chunk(df)
+        self.n_written += len(df)
+
+        if self.on_flush is not None:
+            self.on_flush(df)
+
+    def _write_chunk(self, df):
+        raise NotImplementedError
+
+
+class CSVSink(Sink):
+    """Appends chunks to a CSV file. The header is written once, when the file
+    is first created, so a crashed crawl can be picked up by appending to the
+    same file; the index carries on from its last row. A file with different
+    columns (e.g. from another --format or --max-players) is refused rather
+    than appended to out of line. Reads back with pd.read_csv(path, index_col=0).
+    """
+
+    def __init__(self, path, columns, chunk_size=CHUNK_SIZE, on_flush=None):
+        super().__init__(path, columns, chunk_size, on_flush)
+        if os.path.exists(path) and os.path.getsize(path) > 0:
+            header = list(pd.read_csv(path, index_col=0, nrows=0).columns)
+            if header != list(columns):
+                raise ValueError(
+                    f"{path} has different columns than this output; resume "
+                    "with the same --format and --max-players, or use a new path"
+                )
+            self.first_index = last_index(path) + 1
+
+    def _write_chunk(self, df):
+        header = not os.path.exists(self.path) or os.path.getsize(self.path) == 0
+        df.to_csv(self.path, mode="a", header=header)
+
+
+class ParquetSink(Sink):
+    """Writes each chunk as a row group of a single Parquet file. Parquet files
+    can't be appended to, so if path already exists (e.g. when resuming a
+    crawl) rows go to the next free path.part<N>.parquet instead.
+
+    A Parquet file can't be read until it's closed (the footer is written
+    last), so an open file is lost if the crawl dies. With close_chunks, every
+    chunk is closed into a file of its own (path, then parts) before on_flush
+    sees it, so rows a checkpoint marks done are always readable.
+
+    Buffered rows are written straight from the buffer's arrays as an Arrow
+    table, skipping pandas.
+    """
+
+    def __init__(
+        self, path, columns, chunk_size=CHUNK_SIZE, on_flush=None, close_chunks=False
+    ):
+        super().__init__(path, columns, chunk_size, on_flush)
+        self.close_chunks = close_chunks
+
+        # Only needed for columnar output
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        self.pa = pa
+        self.pq = pq
+        types = {"int64": pa.int64(), "float64": pa.float64(), "str": pa.string()}
+        self.schema = pa.schema(
+            [(name, types[dtype]) for name, dtype in columns.items()]
+        )
+        self.base_path = path
+        self.writer = None
+        self._open()
+
+    def _open(self):
+        self.path = next_free_path(self.base_path)
+        self.writer = self.pq.ParquetWriter(self.path, self.schema)
+
+    def _write_buffer(self, buffer):
+        # Only the interned str columns are converted; they're decoded from
+        # dictionaries to plain strings to match the schema
+        self._write_table(buffer.to_arrow().cast(self.schema))
+        self.n_written += len(buffer)
+
+        if self.on_flush is not None:
+            self.on_flush(buffer.to_frame())
+
+    def _write_chunk(self, df):
+        self._write_table(
+            self.pa.Table.from_pandas(df, schema=self.schema, preserve_index=False)
+        )
+
+    def _write_table(self, table):
+        if self.writer is None:
+            self._open()
+        self.writer.write_table(table)
+        if self.close_chunks:
+            self.writer.close()
+            self.writer = None
+
+    def close(self):
+        super().close()
+        if self.writer is not None:
+            self.writer.close()
+
+
+def last_index(path):
+    """The index of the last row of a CSV a sink wrote, or -1 if it only has
+    a header. Reads from the end, so it's quick however big the file is.
+    """
+    with open(path, "rb") as f:
+        size = f.seek(0, os.SEEK_END)
+        block = 1 << 16
+        while True:
+            f.seek(max(0, size - block))
+            lines = f.read().rstrip(b"\r\n").splitlines()
+            if len(lines) > 1 or block >= size:
+                break
+            block *= 2
+    if block >= size and len(lines) <= 1:
+        return -1
+    return int(lines[-1].split(b",", 1)[0])
+
+
+def next_free_path(path):
+    """path, or if that exists, the first path.part<N> that doesn't."""
+    root, ext = os.path.splitext(path)
+    n = 1
+    while os.path.exists(path):
+        path = f"{root}.part{n}{ext}"
+        n += 1
+    return path
+
+
+def output_files(path):
+    """Every file a sink opened at path has written to: path itself, and for
+    Parquet, any path.part<N> after it, in order.
+    """
+    files = [path] if os.path.exists(path) else []
+    if path.endswith(".parquet"):
+        root, ext = os.path.splitext(path)
+        n = 1
+        while os.path.exists(f"{root}.part{n}{ext}"):
+            files.append(f"{root}.part{n}{ext}")
+            n += 1
+    return files
+
+
+def read_chunks(path, columns, chunk_size=CHUNK_SIZE):
+    """Read back what a sink wrote to path (including any Parquet parts),
+    chunk_size rows at a time.
+    """
+    if path.endswith(".parquet"):
+        import pyarrow.parquet as pq
+
+        for part in output_files(path):
+            for batch in pq.ParquetFile(part).iter_batches(batch_size=chunk_size):
+                yield arrow_to_frame(batch)
+    else:
+        # Keep IDs as strings rather than letting them turn into floats where
+        # some are missing; Sink parses int64 ones back exactly
+        dtypes = {
+            name: str for name, dtype in columns.items() if dtype in ("str", "int64")
+        }
+        yield from pd.read_csv(path, index_col=0, dtype=dtypes, chunksize=chunk_size)
+
+
+def merge_outputs(paths, output, columns, chunk_size=CHUNK_SIZE):
+    """Stream several sink outputs into one, a chunk at a time."""
+    with open_sink(output, columns, chunk_size) as sink:
+        for path in paths:
+            for chunk in read_chunks(path, columns, chunk_size):
+                sink.write_frame(chunk)
+
+
+def open_sink(path, columns, chunk_size=CHUNK_SIZE, on_flush=None, close_chunks=False):
+    """Pick a sink based on the file extension of path. close_chunks only
+    matters for Parquet; see ParquetSink.
+    """
+    if path.endswith(".parquet"):
+        return ParquetSink(path, columns, chunk_size, on_flush, close_chunks)
+    return CSVSink(path, columns, chunk_size, on_flush)
@@ -0,0 +1,6 @@
+import os
+import sys
+
+# The crawler's modules import each other by bare name, as scripts run from
+# src/data_collection
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,55 @@
+import asyncio
+import threading
+import time
+
+from ratelimit import TokenBucket
+
+N_CALLERS = 100
+RATE = 100
+PAUSE = 0.5
+
+
+def test_throttle_pauses_queued_callers():
+    limiter = TokenBucket(rate=RATE, burst=5)
+    returned = []
+    lock = threading.Lock()
+
+    def call():
+        limiter.acquire()
+        with lock:
+            returned.append(time.monotonic())
+
+    threads = [threading.Thread(target=call) for _ in range(N_CALLERS)]
+    for thread in threads:
+        thread.start()
+    # Most callers are still queued for a token when the throttle comes in
+    time.sleep(0.2)
+    throttled_at = time.monotonic()
+    limiter.throttled(PAUSE)
+    for thread in threads:
+        thread.join()
+
+    assert len(returned) == N_CALLERS
+    assert not [t for t in returned if throttled_at < t < throttled_at + PAUSE]
+    assert [t for t in returned if t >= throttled_at + PAUSE]
+
+
+def test_throttle_pauses_queued_coroutines():
+    async def run():
+        limiter = TokenBucket(rate=RATE, burst=5)
+        returned = []
+
+        async def call():
+            await limiter.acquire_async()
+            returned.append(time.monotonic())
+
+        tasks = [asyncio.ensure_future(call()) for _ in range(N_CALLERS)]
+        await asyncio.sleep(0.2)
+        throttled_at = time.monotonic()
+        limiter.throttled(PAUSE)
+        await asyncio.gather(*tasks)
+        return throttled_at, returned
+
+    throttled_at, returned = asyncio.run(run())
+    assert len(returned) == N_CALLERS
+    assert not [t for t in returned if throttled_at < t < throttled_at + PAUSE]
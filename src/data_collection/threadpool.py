@@ -3,80 +3,224 @@ threadpool.py
 author: garrick
 
 Threadpool utility for parallelizing network requests. Rate-limits the number
-of jobs that may be initiated each second.
+of jobs that may be initiated each second using a shared TokenBucket.
+
+Jobs are fed through a bounded queue, so scheduling blocks once the queue is
+full. Feeding a generator with map() keeps memory flat no matter how many work
+items there are, and the first job starts right away.
+
+Jobs may have priorities; among queued jobs, the lowest priority number goes
+first (ties in the order scheduled). A pool can be given a deadline or a
+budget of jobs, after which, or after cancel(), it stops taking new jobs and
+drops queued ones, letting jobs already running finish.
+
+Queued jobs sit in a heap behind one plain lock, taken once per schedule()
+and once per job a worker finishes (which is also when it picks up its next
+one). A worker with nothing to do parks on its own lock, and schedule() wakes
+exactly one parked worker, the most recently parked, so no wakeup is ever
+wasted. Each worker counts its own finished jobs, and nothing else is woken
+unless a waiting schedule() or wait() can go on. See bench_threadpool.py for
+what that costs per job.
+
+Time spent queued, waiting on the rate limiter, and running is recorded to
+metrics.METRICS (or the Metrics passed in).
 """
+import heapq
+import itertools
 import logging
 import threading
-from threading import Condition, Event, Semaphore
+import time
+from threading import Event
 
 from tqdm import tqdm
 
+from metrics import METRICS
+from ratelimit import TokenBucket
+
 logger = logging.getLogger(__name__)
 
 
-N_REQUESTS_PER_SECOND = 25
 NUM_WORKERS = 100
+# Jobs waiting on a worker. Enough to keep workers busy between refills.
+QUEUE_SIZE = 4 * NUM_WORKERS
 
 
 class ThreadPool:
-    def __init__(self):
+    """
+    Args:
+      limiter (TokenBucket): Every job waits for a token before it runs.
+      queue_size (int): Jobs to queue before schedule() blocks.
+      metrics (Metrics): Where pool.* timings go.
+      progress (bool): Show a progress bar.
+      deadline (float): Seconds from now after which no more jobs start.
+      max_jobs (int): Start at most this many jobs.
+      num_workers (int): Worker threads.
+    """
+
+    def __init__(
+        self,
+        limiter=None,
+        queue_size=QUEUE_SIZE,
+        metrics=METRICS,
+        progress=True,
+        deadline=None,
+        max_jobs=None,
+        num_workers=NUM_WORKERS,
+    ):
         # Synchronize over whether jobs may be initiated
-        self.cv = threading.Condition()
-        self.n_requests_available = N_REQUESTS_PER_SECOND
+        self.limiter = limiter if limiter is not None else TokenBucket()
+        self.metrics = metrics
 
-        # Synchronize over whether jobs are available
+        # Synchronize over whether jobs are available. Heap of (priority,
+        # sequence number, (func, args, time queued)) tuples, so equal
+        # priorities come out in order.
+        self.lock = threading.Lock()
         self.jobs = []
-        self.n_jobs = Semaphore(0)
+        self.queue_size = queue_size
+        self.sequence = itertools.count()
+        # Jobs scheduled and not yet finished
+        self.unfinished = 0
+        # Wake locks of parked threads, each blocked acquiring its own lock
+        # until someone releases it: idle workers (most recent last), and
+        # schedule() and wait() calls waiting on room or on jobs finishing
+        self.wakes = [self._parked() for _ in range(num_workers)]
+        self.idle = []
+        self.schedulers = []
+        self.waiters = []
+        self.closing = False
+
+        # Set once the pool stops starting jobs: by cancel(), the deadline, or
+        # running out of jobs
+        self.cancelled = Event()
+        self.cancel_reason = None
+        self.deadline = time.monotonic() + deadline if deadline is not None else None
+        self.max_jobs = max_jobs
+        self.started_jobs = 0
+        self.budget_lock = threading.Lock()
 
-        # Synchronize when threadpool is done with all outstanding jobs
-        self.done_cv = Condition()
-        self.completed_jobs = 0
+        # Jobs finished (run or dropped) per worker. Each worker only writes
+        # its own slot, so counting takes no lock.
+        self.completed = [0] * num_workers
+        self.dropped = [0] * num_workers
         self.outstanding_jobs = 0
 
         # Synchronize when threadpool is shutting down
         self.stopped = Event()
+        self.progress = progress
+        self.pbar = None
+        self.progress_updater = None
 
         # Create workers
         self.workers = []
-        for i in range(NUM_WORKERS):
+        for i in range(num_workers):
             t = threading.Thread(target=self._worker, args=(i,))
             t.start()
             self.workers.append(t)
 
-        self.rate_limiter = threading.Thread(target=self._rate_limiter)
-        self.rate_limiter.start()
+    @property
+    def completed_jobs(self):
+        return sum(self.completed)
+
+    @property
+    def dropped_jobs(self):
+        return sum(self.dropped)
+
+    @staticmethod
+    def _parked():
+        wake = threading.Lock()
+        wake.acquire()
+        return wake
+
+    @staticmethod
+    def _wake_all(wakes):
+        for wake in wakes:
+            wake.release()
+        wakes.clear()
+
+    def _next_job(self, i, finished):
+        """Account for a finished job, if any, and take the next one; parks
+        until there is one. None once the pool is shutting down.
+        """
+        wake = self.wakes[i]
+        with self.lock:
+            if finished:
+                self.unfinished -= 1
+                if not self.unfinished:
+                    self._wake_all(self.waiters)
+            while not self.jobs:
+                if self.closing:
+                    return None
+                self.idle.append(wake)
+                self.lock.release()
+                try:
+                    wake.acquire()
+                finally:
+                    self.lock.acquire()
+
+            _, _, job = heapq.heappop(self.jobs)
+            # Let blocked schedule() calls refill half the queue at a time,
+            # rather than waking them for every slot
+            if self.schedulers and len(self.jobs) <= self.queue_size // 2:
+                self._wake_all(self.schedulers)
+            return job
 
     def _worker(self, i):
-        while True:
-            # Wait for a job
-            self.n_jobs.acquire()
-
-            # When signalled, one of two things may be true: (1) there are
-            # actually no jobs, and the thread must exit, or (2) there are jobs.
-            # Handle case (1) first to prevent accessing the empty list.
-            if self.stopped.is_set():
-                break
+        job = self._next_job(i, finished=False)
+        while job is not None:
+            func, args, queued = job
+            dequeued = time.perf_counter()
 
-            func = self.jobs.pop(0)
+            run = self._start()
+            if run:
+                # Make sure we can fire request according to rate-limiter
+                self.limiter.acquire()
+                started = time.perf_counter()
 
-            # Make sure we can fire request according to rate-limiter
-            with self.cv:
-                while not self.n_requests_available:
-                    self.cv.wait()
-                self.n_requests_available -= 1
+                func(*args)
+                finished = time.perf_counter()
 
-            func()
+                self.metrics.observe("pool.queue_wait", dequeued - queued)
+                self.metrics.observe("pool.rate_limit_wait", started - dequeued)
+                self.metrics.observe("pool.job", finished - started)
+            else:
+                self.metrics.incr("pool.dropped")
+                self.dropped[i] += 1
 
-            with self.done_cv:
-                self.completed_jobs += 1
-                self.done_cv.notify_all()
+            self.completed[i] += 1
+            job = self._next_job(i, finished=True)
 
-    def _rate_limiter(self):
-        while not self.stopped.wait(1):
-            # Acquire lock and update requests allowed
-            with self.cv:
-                self.n_requests_available = N_REQUESTS_PER_SECOND
-                self.cv.notify_all()
+    def _start(self):
+        """Whether a dequeued job may run, counting it against max_jobs."""
+        if self.stopping():
+            return False
+        if self.max_jobs is None:
+            return True
+        with self.budget_lock:
+            if self.started_jobs < self.max_jobs:
+                self.started_jobs += 1
+                return True
+        self.cancel(f"ran {self.max_jobs} jobs")
+        return False
+
+    def stopping(self):
+        """Whether the pool has stopped starting jobs, checking the
+        deadline.
+        """
+        if self.deadline is not None and time.monotonic() >= self.deadline:
+            self.cancel("deadline passed")
+        return self.cancelled.is_set()
+
+    def cancel(self, reason="cancelled"):
+        """Stop feeding and starting jobs. Queued jobs are dropped and jobs
+        already running finish; wait() or shutdown() returns once they have.
+        Safe to call from any thread, more than once.
+        """
+        with self.budget_lock:
+            if self.cancelled.is_set():
+                return
+            self.cancel_reason = reason
+            self.cancelled.set()
+        logger.info(f"Stopping early: {reason}")
 
     def _progress_updater(self):
         while not self.stopped.wait(0.25):
@@ -84,37 +228,88 @@ class ThreadPool:
                 # Progress is difference between jobs completed and previous n
                 self.pbar.update(self.completed_jobs - self.pbar.n)
 
-    def schedule(self, func):
-        self.jobs.append(func)
-        self.outstanding_jobs += 1
-        self.n_jobs.release()
+    def _start_progress(self, total=None):
+        if not self.progress or self.pbar is not None:
+            return
+        self.pbar = tqdm(total=total)
+        self.progress_updater = threading.Thread(target=self._progress_updater)
+        self.progress_updater.start()
+
+    def schedule(self, func, *args, priority=0):
+        """Queue func(*args) to run on a worker, ahead of queued jobs with a
+        higher priority number. Blocks while the queue is full.
+        """
+        entry = (priority, next(self.sequence), (func, args, time.perf_counter()))
+        with self.lock:
+            while len(self.jobs) >= self.queue_size:
+                wake = self._parked()
+                self.schedulers.append(wake)
+                self.lock.release()
+                try:
+                    wake.acquire()
+                finally:
+                    self.lock.acquire()
+
+            heapq.heappush(self.jobs, entry)
+            self.unfinished += 1
+            self.outstanding_jobs += 1
+            if self.idle:
+                self.idle.pop().release()
+
+    def map(self, func, items, total=None, priority=None):
+        """Run func(item) for every item. Items are pulled lazily, only as
+        fast as workers free up queue slots, so items may be a generator over
+        an arbitrarily large range. Pass total for a generator to get a
+        progress bar with an ETA. Stops pulling items once the pool stops.
+
+        Args:
+          priority (callable): Maps an item to its priority; lower first.
+        """
+        if total is None and hasattr(items, "__len__"):
+            total = len(items)
+        self._start_progress(total)
+
+        for item in items:
+            if self.stopping():
+                break
+            self.schedule(
+                func, item, priority=priority(item) if priority is not None else 0
+            )
 
     def wait(self):
         logger.debug("Waiting for jobs to finish...")
 
-        self.pbar = tqdm(total=self.outstanding_jobs)
-        self.progress_updater = threading.Thread(target=self._progress_updater)
-        self.progress_updater.start()
+        self._start_progress(self.outstanding_jobs)
 
-        with self.done_cv:
-            while self.outstanding_jobs != self.completed_jobs:
-                self.done_cv.wait()
+        with self.lock:
+            if self.unfinished:
+                wake = self._parked()
+                self.waiters.append(wake)
+                self.lock.release()
+                try:
+                    wake.acquire()
+                finally:
+                    self.lock.acquire()
 
-        self.pbar.update(self.outstanding_jobs - self.pbar.n)
-        self.pbar.close()
+        if self.pbar is not None:
+            self.pbar.update(self.outstanding_jobs - self.pbar.n)
+            self.pbar.close()
+        if self.dropped_jobs:
+            logger.info(f"Dropped {self.dropped_jobs} queued jobs")
 
     def shutdown(self):
         self.wait()
         
         logger.debug("All jobs done. Shutting down...")
         self.stopped.set()
-        for _ in range(len(self.workers)):
-            self.n_jobs.release()
+        with self.lock:
+            self.closing = True
+            self._wake_all(self.idle)
 
         # Wait for threads to terminiate
         for t in self.workers:
             t.join()
-        self.rate_limiter.join()
-        self.progress_updater.join()
+        if self.progress_updater is not None:
+            self.progress_updater.join()
 
         logger.debug("Shut down!")
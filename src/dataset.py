@@ -0,0 +1,193 @@
+"""
+dataset.py
+author: garrick
+
+Typed, columnar copies of crawl output, so the plots and notebook don't
+re-parse CSVs every time. The first load of a crawl output (e.g. all.csv)
+converts it to Parquet with proper dtypes: integer IDs, parsed periods, and
+activity names as a categorical. Later loads read the Parquet copy, which
+takes milliseconds. Common aggregates are computed once and cached alongside.
+
+Everything lives in a directory next to the source (all.csv -> all.dataset/)
+and is rebuilt automatically if the source changes.
+
+    ds = Dataset(join(DATA_DIR, "all.csv"))
+    ds.frame                  # the typed DataFrame
+    ds.activity_counts()      # activities per name, most common first
+    ds.duration_histogram()   # activity durations per name, in 1 minute bins
+"""
+import json
+import os
+
+import numpy as np
+import pandas as pd
+
+# Seconds per bin in duration histograms
+DURATION_BIN = 60
+
+
+def stamp(path):
+    """Identifies a version of a file, to tell when caches are stale."""
+    stat = os.stat(path)
+    return {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+
+
+def to_int_ids(column):
+    """Decimal string IDs (with missing values) to nullable Int64. IDs are too
+    big to round trip through float64, which is what read_csv would use.
+    """
+    mask = column.isna().to_numpy()
+    values = np.zeros(len(column), dtype=np.int64)
+    values[~mask] = column[~mask].to_numpy().astype(str).astype(np.int64)
+    return pd.arrays.IntegerArray(values, mask)
+
+
+def read_source(path):
+    """Read crawl output (wide or long, CSV or Parquet) into typed columns."""
+    if path.endswith(".parquet"):
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        # Keep int64 IDs with nulls exact, rather than as float64
+        df = pq.read_table(path).to_pandas(
+            types_mapper={pa.int64(): pd.Int64Dtype()}.get
+        )
+        id_columns = [c for c in df.columns if c.endswith("char_id")]
+    else:
+        header = pd.read_csv(path, index_col=0, nrows=0).columns
+        id_columns = [c for c in header if c.endswith("char_id")]
+        df = pd.read_csv(
+            path, index_col=0, dtype={c: str for c in id_columns}
+        ).reset_index(drop=True)
+
+    for c in id_columns:
+        df[c] = to_int_ids(df[c])
+    df["instance_id"] = df["instance_id"].astype(np.int64)
+    df["period"] = pd.to_datetime(df["period"], utc=True)
+    df["director_activity_name"] = df["director_activity_name"].astype("category")
+    return df
+
+
+class Dataset:
+    """A crawl output file and its cached typed copy and aggregates.
+
+    Args:
+      source (str): Crawl output, e.g. all.csv or all.parquet.
+    """
+
+    def __init__(self, source):
+        self.source = source
+        root, _ = os.path.splitext(source)
+        self.dir = root + ".dataset"
+        self.data_path = os.path.join(self.dir, "data.parquet")
+        self.aggregates_path = os.path.join(self.dir, "aggregates.json")
+        self.meta_path = os.path.join(self.dir, "meta.json")
+        self._frame = None
+        self._aggregates = None
+
+    def _fresh(self):
+        if not os.path.exists(self.meta_path):
+            return False
+        with open(self.meta_path) as f:
+            return json.load(f)["source"] == stamp(self.source)
+
+    def build(self):
+        """Convert the source and drop any cached aggregates."""
+        os.makedirs(self.dir, exist_ok=True)
+        df = read_source(self.source)
+        df.to_parquet(self.data_path, index=False)
+        if os.path.exists(self.aggregates_path):
+            os.remove(self.aggregates_path)
+        # Written last, so an interrupted build is redone next time
+        with open(self.meta_path, "w") as f:
+            json.dump({"source": stamp(self.source)}, f)
+        self._frame = df
+        self._aggregates = None
+
+    @property
+    def frame(self):
+        """The whole dataset as a typed DataFrame."""
+        if self._frame is None:
+            if not self._fresh():
+                self.build()
+            else:
+                self._frame = pd.read_parquet(self.data_path)
+        return self._frame
+
+    def load(self, columns=None):
+        """Read just some columns, without keeping them around."""
+        if not self._fresh():
+            self.build()
+        return pd.read_parquet(self.data_path, columns=columns)
+
+    def activities(self):
+        """One row per activity. Long-format outputs have a row per player, so
+        keep the first of each.
+        """
+        df = self.frame
+        if "player_index" in df.columns:
+            df = df.drop_duplicates("instance_id")
+        return df
+
+    def _aggregate(self, name, compute):
+        """Compute an aggregate once per version of the source. Aggregates
+        are small, so they're all kept in one JSON file.
+        """
+        if not self._fresh():
+            self.build()
+        if self._aggregates is None:
+            self._aggregates = {}
+            if os.path.exists(self.aggregates_path):
+                with open(self.aggregates_path) as f:
+                    self._aggregates = json.load(f)
+
+        if name not in self._aggregates:
+            self._aggregates[name] = compute()
+            tmp_path = self.aggregates_path + ".tmp"
+            with open(tmp_path, "w") as f:
+                json.dump(self._aggregates, f)
+            os.replace(tmp_path, self.aggregates_path)
+        return self._aggregates[name]
+
+    def activity_counts(self):
+        """Activities played per activity name, most common first."""
+        counts = self._aggregate(
+            "activity_counts",
+            lambda: self.activities()["director_activity_name"]
+            .value_counts()
+            .to_dict(),
+        )
+        return pd.Series(counts, dtype=np.int64).sort_values(
+            ascending=False, kind="stable"
+        )
+
+    def duration_histogram(self, bin_seconds=DURATION_BIN):
+        """Activities per activity name (rows) and duration bin (columns,
+        labeled by each bin's lower edge in seconds).
+        """
+
+        def compute():
+            df = self.activities()
+            duration = (
+                df["activity_duration"]
+                if "activity_duration" in df.columns
+                else df["player1_activity_duration"]
+            )
+            bins = (duration // bin_seconds * bin_seconds).rename("bin")
+            counts = df.groupby(
+                [df["director_activity_name"], bins], observed=True
+            ).size()
+            return {f"{name}\t{int(bin)}": int(n) for (name, bin), n in counts.items()}
+
+        counts = self._aggregate(f"duration_histogram_{bin_seconds}", compute)
+        if not counts:
+            return pd.DataFrame()
+        index = pd.MultiIndex.from_tuples(
+            [(key.split("\t")[0], int(key.split("\t")[1])) for key in counts],
+            names=["director_activity_name", "bin"],
+        )
+        return (
+            pd.Series(list(counts.values()), index=index, dtype=np.int64)
+            .unstack(fill_value=0)
+            .sort_index(axis=1)
+        )
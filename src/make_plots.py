@@ -2,22 +2,19 @@
 
 from os.path import join
 
-import pandas as pd
-from sklearn.linear_model import LinearRegression, Ridge, Lasso
 import matplotlib.pyplot as plt
-from collections import Counter
 import numpy as np
 
+from dataset import Dataset
+
 DATA_DIR = "/Users/garrick/code/cs229/proj/src/data"
 gambit_matches = "gambit.csv"
 all_matches = "all.csv"
 
-df_all = pd.read_csv(join(DATA_DIR, all_matches), index_col=0, parse_dates=["period"])
-
-
-activityCounts = Counter()
-for aname in df_all["director_activity_name"]:
-    activityCounts[aname] += 1
+# Converted to Parquet on first use; after that, loading is near instant and
+# the counts come from a cache
+ds_all = Dataset(join(DATA_DIR, all_matches))
+activity_counts = ds_all.activity_counts()  # Most common first
 
 COLORS = plt.rcParams["axes.prop_cycle"].by_key()["color"]
 pin_activities = [
@@ -35,10 +32,16 @@ pin_activities = [
 ]
 
 
+def bar_colors(names):
+    return [COLORS[1] if name in pin_activities else COLORS[0] for name in names]
+
+
 def histogram():
-    x, y = zip(*activityCounts.most_common())
-    bar_colors = [COLORS[0] if a not in pin_activities else COLORS[1] for a in x]
-    plt.bar(np.arange(len(x)), y, color=bar_colors)
+    plt.bar(
+        np.arange(len(activity_counts)),
+        activity_counts.values,
+        color=bar_colors(activity_counts.index),
+    )
     plt.show()
     plt.clf()
 
@@ -47,17 +50,25 @@ def top_and_bottom():
     plt.figure(figsize=(6.4 * 2, 4.8))
     plt.subplot(1, 2, 1)
 
-    x, y = zip(*activityCounts.most_common(10))
-    bar_colors = [COLORS[0] if a not in pin_activities else COLORS[1] for a in x]
-    plt.bar(np.arange(len(x)), y, tick_label=x, color=bar_colors)
+    top = activity_counts.head(10)
+    plt.bar(
+        np.arange(len(top)),
+        top.values,
+        tick_label=top.index,
+        color=bar_colors(top.index),
+    )
     plt.xticks(rotation=45, ha="right")  # ha - horizontal align
     plt.title("Top 10 Activities")
 
     plt.subplot(1, 2, 2)
 
-    x, y = zip(*activityCounts.most_common()[-10:])
-    bar_colors = [COLORS[0] if a not in pin_activities else COLORS[1] for a in x]
-    plt.bar(np.arange(len(x)), y, tick_label=x, color=bar_colors)
+    bottom = activity_counts.tail(10)
+    plt.bar(
+        np.arange(len(bottom)),
+        bottom.values,
+        tick_label=bottom.index,
+        color=bar_colors(bottom.index),
+    )
     plt.xticks(rotation=45, ha="right")  # ha - horizontal align
     plt.title("Bottom 10 Activities")
     plt.show()
@@ -65,12 +76,10 @@ def top_and_bottom():
 
 
 def histogram_pinned():
-    pins = [(aname, activityCounts[aname]) for aname in pin_activities]
-    pins = sorted(pins, key=lambda t: t[1])[
-        ::-1
-    ]  # Sort according to 2nd entry of tuple
-    x, y = zip(*pins)
-    plt.bar(np.arange(len(x)), y, tick_label=x, color=COLORS[1])
+    pins = activity_counts.reindex(pin_activities, fill_value=0).sort_values(
+        ascending=False, kind="stable"
+    )
+    plt.bar(np.arange(len(pins)), pins.values, tick_label=pins.index, color=COLORS[1])
     plt.xticks(rotation=45, ha="right")  # ha - horizontal align
     plt.show()
     plt.clf()
@@ -0,0 +1,299 @@
+"""
+train.py
+author: garrick
+
+Regularized linear models over the PGCR dataset. Sweeps whole regularization
+paths instead of refitting from scratch per strength:
+
+- Ridge: one SVD of the training data gives the fit for every alpha.
+- Lasso: coordinate descent along the path from strongest to weakest alpha,
+  warm-starting each fit from the last (sklearn's lasso_path).
+
+Folds and models run in parallel across processes. The design matrix is built
+once per dataset and cached as .npy files next to it, which workers
+memory-map instead of each getting a copy.
+
+Columns are centered and scaled to unit norm, as sklearn's normalize=True
+did, so alphas mean the same thing as in the notebook's earlier sweeps.
+
+    python train.py /path/to/gambit.csv --models ridge lasso --folds 5
+"""
+import argparse
+import hashlib
+import json
+import os
+import re
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+from sklearn.linear_model import lasso_path
+from sklearn.model_selection import KFold
+
+from dataset import Dataset, stamp
+
+REG_STRENGTHS = [0.03, 0.1, 0.3, 1, 3, 10]
+N_FOLDS = 5
+# Held out from the sweep entirely, for a final score
+TEST_SIZE = 0.1
+SEED = 229
+# Players whose stats are used as features; later slots are mostly empty
+N_PLAYERS = 8
+LASSO_MAX_ITER = 3000
+
+# Never features: identifiers, labels, and the target's per-player copies
+DROP_COLUMNS = ["instance_id", "period", "director_activity_name", "player_index"]
+DROP_PATTERNS = [r"char_id$", r"activity_duration$"]
+
+
+def feature_columns(columns, n_players=N_PLAYERS):
+    """Which columns of a wide dataset to use as features."""
+    features = []
+    for column in columns:
+        if column in DROP_COLUMNS:
+            continue
+        if any(re.search(pattern, column) for pattern in DROP_PATTERNS):
+            continue
+        player = re.match(r"player(\d+)_", column)
+        if player is not None and int(player.group(1)) > n_players:
+            continue
+        features.append(column)
+    return features
+
+
+def design_matrix(ds, target="activity_duration", n_players=N_PLAYERS, activity=None):
+    """Build (or reuse) the design matrix for a Dataset. Returns the path of
+    a directory holding X.npy, y.npy and columns.json.
+
+    Args:
+      ds (Dataset): A wide-format dataset.
+      target (str): Column to predict. Activity-level stats like
+        activity_duration are read from player1's copy.
+      n_players (int): Use stats of the first n_players players.
+      activity (str): Only use activities with this name.
+    """
+    options = {"target": target, "n_players": n_players, "activity": activity}
+    key = hashlib.md5(json.dumps(options, sort_keys=True).encode()).hexdigest()[:12]
+    path = os.path.join(ds.dir, f"design-{key}")
+    meta_path = os.path.join(path, "columns.json")
+    if os.path.exists(meta_path):
+        with open(meta_path) as f:
+            if json.load(f)["source"] == stamp(ds.source):
+                return path
+
+    df = ds.frame
+    if activity is not None:
+        df = df[df["director_activity_name"] == activity]
+    if target not in df.columns:
+        target = f"player1_{target}"
+    columns = feature_columns(df.columns, n_players)
+
+    # Missing players have no stats; count them as zeros
+    X = df[columns].to_numpy(dtype=np.float64, na_value=0.0)
+    y = df[target].to_numpy(dtype=np.float64, na_value=np.nan)
+    keep = ~np.isnan(y)
+
+    os.makedirs(path, exist_ok=True)
+    np.save(os.path.join(path, "X.npy"), np.asfortranarray(X[keep]))
+    np.save(os.path.join(path, "y.npy"), y[keep])
+    # Written last, so an interrupted build is redone next time
+    with open(meta_path, "w") as f:
+        json.dump(
+            {"source": stamp(ds.source), "options": options, "columns": columns}, f
+        )
+    return path
+
+
+def load_design(path):
+    """Memory-mapped X and y, and the feature names."""
+    X = np.load(os.path.join(path, "X.npy"), mmap_mode="r")
+    y = np.load(os.path.join(path, "y.npy"), mmap_mode="r")
+    with open(os.path.join(path, "columns.json")) as f:
+        columns = json.load(f)["columns"]
+    return X, y, columns
+
+
+def split(n, test_size=TEST_SIZE, seed=SEED):
+    """Shuffled (train, test) row indices."""
+    order = np.random.RandomState(seed).permutation(n)
+    n_test = int(round(n * test_size))
+    return np.sort(order[n_test:]), np.sort(order[:n_test])
+
+
+def normalize(X, y):
+    """Center X and y, and scale X's columns to unit norm. Returns the
+    normalized arrays and (X mean, X scale, y mean) to undo it.
+    """
+    X_mean = X.mean(axis=0)
+    Xc = X - X_mean
+    scale = np.sqrt((Xc ** 2).sum(axis=0))
+    # Constant columns stay zero instead of dividing by zero
+    scale[scale == 0] = 1.0
+    y_mean = y.mean()
+    return Xc / scale, y - y_mean, (X_mean, scale, y_mean)
+
+
+def ridge_path(X, y, alphas):
+    """Ridge weights for every alpha, from one SVD. Returns (n_alphas,
+    n_features).
+    """
+    U, s, Vt = np.linalg.svd(X, full_matrices=False)
+    Uty = U.T @ y
+    d = s / (s[None, :] ** 2 + np.asarray(alphas)[:, None])
+    return (d * Uty) @ Vt
+
+
+def lasso_weights(X, y, alphas):
+    """Lasso weights for every alpha, warm-starting along the path. Returns
+    (n_alphas, n_features) in the order alphas were given.
+    """
+    alphas = np.asarray(alphas)
+    # Strongest first: each solution is a good start for the next
+    order = np.argsort(alphas)[::-1]
+    _, coefs, _ = lasso_path(
+        np.asfortranarray(X),
+        y,
+        alphas=alphas[order],
+        precompute=True,
+        max_iter=LASSO_MAX_ITER,
+    )
+    weights = np.empty((len(alphas), X.shape[1]))
+    weights[order] = coefs.T
+    return weights
+
+
+PATHS = {"ridge": ridge_path, "lasso": lasso_weights}
+
+
+def r2(y, predictions):
+    """R^2 of each row of predictions against y."""
+    residual = ((predictions - y) ** 2).sum(axis=-1)
+    total = ((y - y.mean()) ** 2).sum()
+    return 1 - residual / total
+
+
+def fit_path(model, X, y, alphas):
+    """Fit a whole path on X, y. Returns weights in X's original units and
+    intercepts, one per alpha.
+    """
+    Xn, yc, (X_mean, scale, y_mean) = normalize(X, y)
+    weights = PATHS[model](Xn, yc, alphas) / scale
+    intercepts = y_mean - weights @ X_mean
+    return weights, intercepts
+
+
+def score_fold(design, model, alphas, train, val):
+    """Worker task: fit a path on one fold's training rows and score it on
+    both sides. Returns (train R^2, val R^2), each one per alpha.
+    """
+    X, y, _ = load_design(design)
+    weights, intercepts = fit_path(model, X[train], y[train], alphas)
+
+    def score(rows):
+        predictions = weights @ X[rows].T + intercepts[:, None]
+        return r2(y[rows], predictions)
+
+    return score(train), score(val)
+
+
+def sweep(design, models, alphas=REG_STRENGTHS, folds=N_FOLDS, workers=None):
+    """Cross-validate each model over alphas, with every (model, fold) fit
+    run as its own process. Then refit each model at its best alpha on all
+    non-test rows and score it on the held-out test rows.
+
+    Returns {model: {"alphas", "train_r2", "val_r2", "alpha", "test_r2",
+    "weights", "intercept"}}, with R^2s averaged over folds and weights keyed
+    by feature name.
+    """
+    X, y, columns = load_design(design)
+    train, test = split(len(y))
+    kfold = KFold(n_splits=folds, shuffle=True, random_state=SEED)
+    fold_rows = [(train[t], train[v]) for t, v in kfold.split(train)]
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = {
+            model: [
+                executor.submit(score_fold, design, model, alphas, t, v)
+                for t, v in fold_rows
+            ]
+            for model in models
+        }
+        scores = {
+            model: np.array([future.result() for future in fs])
+            for model, fs in futures.items()
+        }
+
+    results = {}
+    for model in models:
+        # (folds, train/val, alphas) -> mean over folds
+        train_r2, val_r2 = scores[model].mean(axis=0)
+        best = int(np.argmax(val_r2))
+        weights, intercepts = fit_path(model, X[train], y[train], [alphas[best]])
+        test_r2 = r2(y[test], weights @ X[test].T + intercepts[:, None])[0]
+        results[model] = {
+            "alphas": list(alphas),
+            "train_r2": train_r2.tolist(),
+            "val_r2": val_r2.tolist(),
+            "alpha": alphas[best],
+            "test_r2": float(test_r2),
+            "weights": dict(zip(columns, weights[0].tolist())),
+            "intercept": float(intercepts[0]),
+        }
+    return results
+
+
+def report(results):
+    for model, result in results.items():
+        print(f"{model}")
+        print("reg str & train r2 & val r2")
+        for alpha, train_r2, val_r2 in zip(
+            result["alphas"], result["train_r2"], result["val_r2"]
+        ):
+            print(f"{alpha} & {train_r2:.4f} & {val_r2:.4f}")
+        print(f"best alpha: {result['alpha']}, test r2: {result['test_r2']:.4f}")
+
+        weights = sorted(result["weights"].items(), key=lambda t: t[1])[::-1]
+        for name, weight in weights:
+            if weight != 0:
+                print(f"  {name}: {weight:.4f}")
+        print()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Sweep regularized linear models over a PGCR dataset"
+    )
+    parser.add_argument("source", help="Wide-format crawl output (.csv/.parquet)")
+    parser.add_argument("--models", nargs="+", choices=list(PATHS), default=list(PATHS))
+    parser.add_argument("--alphas", type=float, nargs="+", default=REG_STRENGTHS)
+    parser.add_argument("--folds", type=int, default=N_FOLDS)
+    parser.add_argument("--target", default="activity_duration")
+    parser.add_argument("--players", type=int, default=N_PLAYERS)
+    parser.add_argument(
+        "--activity", default=None, help="Only use activities with this name"
+    )
+    parser.add_argument(
+        "--workers", type=int, default=None, help="Processes (default: all cores)"
+    )
+    parser.add_argument("--output", default=None, help="Also save results as JSON")
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    design = design_matrix(
+        Dataset(args.source),
+        target=args.target,
+        n_players=args.players,
+        activity=args.activity,
+    )
+    print(f"design matrix: {time.perf_counter() - start:.2f}s")
+
+    start = time.perf_counter()
+    results = sweep(
+        design, args.models, alphas=args.alphas, folds=args.folds, workers=args.workers
+    )
+    print(f"sweep: {time.perf_counter() - start:.2f}s\n")
+    report(results)
+
+    if args.output is not None:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)